@@ -0,0 +1,139 @@
+"""Database size and checkpoint write latency over a scripted session.
+
+The session runs the real graph topology and state, with scripted nodes in
+place of the LLM calls: each turn appends a paragraph to the piece and a
+reply to the conversation. Run from the repository root with:
+
+    python -m benchmarks.checkpoint_storage --turns 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from typing import Any, Type
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.graph import StateGraph
+
+# the graph module builds its chat model at import time
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from rincewrite.graph import GraphState, PieceUpdate  # noqa: E402
+from rincewrite.storage import (  # noqa: E402
+    CompactSqliteSaver, database_size)
+
+_PARAGRAPH = (
+    "The wizard looked at the luggage, and the luggage looked back. "
+    "Neither of them blinked, mostly because only one of them had eyes. ") * 4
+
+
+def scripted_graph() -> StateGraph:
+    def welcome(state: GraphState) -> dict[str, Any]:
+        return {"messages": [AIMessage(content="Welcome! " + _PARAGRAPH)]}
+
+    def user_action(state: GraphState) -> None:
+        pass
+
+    def update_piece(state: GraphState) -> dict[str, Any]:
+        turn = len(state["messages"]) // 2
+        return {"piece_update": PieceUpdate(
+            new_title=state["piece_title"],
+            new_desc=state["piece_desc"],
+            new_text=state["piece_text"] + f"\n\n## Part {turn}\n\n"
+            + _PARAGRAPH)}
+
+    def chat(state: GraphState) -> dict[str, Any]:
+        return {
+            "piece_text": state["piece_update"].new_text,
+            "piece_title": state["piece_update"].new_title,
+            "piece_desc": state["piece_update"].new_desc,
+            "messages": [AIMessage(content="Done. " + _PARAGRAPH)]}
+
+    def summarize(state: GraphState) -> dict[str, Any]:
+        return {}
+
+    builder = StateGraph(GraphState)
+    builder.add_node("welcome", welcome)
+    builder.add_node("user_action", user_action)
+    builder.add_node("update_piece", update_piece)
+    builder.add_node("chat", chat)
+    builder.add_node("summarize", summarize)
+    builder.set_entry_point("welcome")
+    builder.add_edge("welcome", "user_action")
+    builder.add_edge("user_action", "update_piece")
+    builder.add_edge("update_piece", "chat")
+    builder.add_edge("chat", "summarize")
+    builder.add_edge("summarize", "user_action")
+    return builder
+
+
+async def _session(
+    saver_cls: Type[AsyncSqliteSaver],
+    db_path: str,
+    turns: int
+) -> list[float]:
+    write_times: list[float] = []
+    async with saver_cls.from_conn_string(db_path) as saver:
+        aput = saver.aput
+
+        async def timed_aput(*args: Any, **kwargs: Any) -> RunnableConfig:
+            start = time.perf_counter()
+            try:
+                return await aput(*args, **kwargs)
+            finally:
+                write_times.append((time.perf_counter() - start) * 1000)
+
+        saver.aput = timed_aput  # type: ignore[method-assign]
+        graph = scripted_graph().compile(
+            checkpointer=saver,
+            interrupt_before=["user_action"]
+        )
+        config = RunnableConfig({"configurable": {"thread_id": "benchmark"}})
+        await graph.ainvoke(
+            {
+                "piece_title": "The Colour of Benchmarks",
+                "piece_desc": "A scripted session",
+                "piece_text": "",
+                "messages": [],
+            },
+            config)
+        for turn in range(turns):
+            await graph.aupdate_state(
+                config,
+                {"messages": [f"Please write part {turn}."]},
+                as_node="user_action")
+            await graph.ainvoke(None, config)
+    return write_times
+
+
+def _report(label: str, db_path: str, write_times: list[float]) -> None:
+    write_times = sorted(write_times)
+    p95 = write_times[int(0.95 * (len(write_times) - 1))]
+    print(
+        f"{label:<10} db {database_size(db_path) / 1e6:8.2f} MB  "
+        f"{len(write_times)} writes  "
+        f"mean {statistics.mean(write_times):6.2f} ms  "
+        f"p95 {p95:6.2f} ms")
+
+
+async def main(turns: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, saver_cls in (
+            ("full", AsyncSqliteSaver),
+            ("compact", CompactSqliteSaver),
+        ):
+            db_path = os.path.join(tmp, f"{label}.db")
+            write_times = await _session(saver_cls, db_path, turns)
+            _report(label, db_path, write_times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.turns))
@@ -0,0 +1,67 @@
+"""Worker cold-start time, with prompts pulled from the hub at import time
+versus loaded lazily from the local prompt cache, and import time of the app,
+which leaves the graph to the runtime warm-up.
+
+Each scenario runs in a fresh interpreter and is timed until the three
+prompts are available, or the app is imported. Run from the repository root
+with:
+
+    python -m benchmarks.cold_start --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_SCENARIOS = {
+    # what importing the app used to do
+    "hub at import": (
+        "import rincewrite.graph\n"
+        "from langchain import hub\n"
+        "from rincewrite.prompts import PROMPTS\n"
+        "for ref in PROMPTS.values():\n"
+        "    hub.pull(ref)\n"
+    ),
+    "import only": "import rincewrite.graph\n",
+    "lazy cached": (
+        "import rincewrite.graph\n"
+        "from rincewrite.prompts import PROMPTS, get_prompt\n"
+        "for name in PROMPTS:\n"
+        "    get_prompt(name)\n"
+    ),
+    "app import": "import rincewrite.rincewrite\n",
+}
+
+
+def _run(code: str, offline: bool) -> float:
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    if offline:
+        env["RINCEWRITE_PROMPTS_OFFLINE"] = "true"
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", code], env=env, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def main(runs: int) -> None:
+    for label, code in _SCENARIOS.items():
+        offline = label != "hub at import"
+        try:
+            timings = [_run(code, offline) for _ in range(runs)]
+        except subprocess.CalledProcessError:
+            print(f"{label:<14} failed (is the hub or the cache reachable?)")
+            continue
+        print(
+            f"{label:<14} median {statistics.median(timings) * 1000:8.1f} ms"
+            f"  min {min(timings) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    main(args.runs)
@@ -0,0 +1,181 @@
+"""Checkpoint latency with concurrent sessions over several workers.
+
+Each worker process opens one checkpointer, as a Reflex backend worker does,
+and runs its share of the sessions concurrently. The sessions are the
+scripted ones of `checkpoint_storage`, so only the checkpoint I/O is
+measured. The single-connection checkpointer used before the persistence
+backends is compared with the pooled SQLite backend. Run from the
+repository root with:
+
+    python -m benchmarks.concurrent_sessions --workers 4 --sessions 32
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncContextManager, Awaitable, Callable
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver
+
+# the graph module builds its chat model at import time
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from benchmarks.checkpoint_storage import scripted_graph  # noqa: E402
+from rincewrite.persistence import get_backend  # noqa: E402
+from rincewrite.storage import CompactSqliteSaver  # noqa: E402
+
+Timings = dict[str, list[float]]
+
+
+def _checkpointer(
+    backend: str,
+    db_path: str,
+    pool_size: int
+) -> AsyncContextManager[BaseCheckpointSaver]:
+    if backend == "single":
+        return CompactSqliteSaver.from_conn_string(db_path)
+    return get_backend(f"sqlite:///{db_path}", pool_size).checkpointer()
+
+
+def timed(
+    method: Callable[..., Awaitable[Any]],
+    timings: list[float]
+) -> Callable[..., Awaitable[Any]]:
+    async def timed_method(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            timings.append((time.perf_counter() - start) * 1000)
+    return timed_method
+
+
+async def _session(graph: Any, thread_id: str, turns: int) -> None:
+    config = RunnableConfig({"configurable": {"thread_id": thread_id}})
+    await graph.ainvoke(
+        {
+            "piece_title": "The Colour of Benchmarks",
+            "piece_desc": "A scripted session",
+            "piece_text": "",
+            "messages": [],
+        },
+        config)
+    for turn in range(turns):
+        await graph.aupdate_state(
+            config,
+            {"messages": [f"Please write part {turn}."]},
+            as_node="user_action")
+        await graph.ainvoke(None, config)
+
+
+async def _worker(
+    backend: str,
+    db_path: str,
+    pool_size: int,
+    worker: int,
+    sessions: int,
+    turns: int
+) -> tuple[Timings, int]:
+    timings: Timings = {"write": [], "read": []}
+    async with _checkpointer(backend, db_path, pool_size) as saver:
+        # instance attributes, so that the graph calls the timed methods
+        saver.aput = timed(  # type: ignore[method-assign]
+            saver.aput, timings["write"])
+        saver.aput_writes = timed(  # type: ignore[method-assign]
+            saver.aput_writes, timings["write"])
+        saver.aget_tuple = timed(  # type: ignore[method-assign]
+            saver.aget_tuple, timings["read"])
+        graph = scripted_graph().compile(
+            checkpointer=saver,
+            interrupt_before=["user_action"]
+        )
+        results = await asyncio.gather(
+            *(_session(graph, f"{backend}-{worker}-{i}", turns)
+              for i in range(sessions)),
+            return_exceptions=True)
+    errors = sum(isinstance(result, Exception) for result in results)
+    return timings, errors
+
+
+def _run_worker(*args: Any) -> tuple[Timings, int]:
+    return asyncio.run(_worker(*args))
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))] if values else float("nan")
+
+
+def _run(
+    backend: str,
+    db_path: str,
+    workers: int,
+    sessions: int,
+    turns: int,
+    pool_size: int
+) -> None:
+    # the tables are created up front, as the app does on its first start
+    async def setup() -> None:
+        async with _checkpointer(backend, db_path, pool_size) as saver:
+            with contextlib.suppress(AttributeError):
+                await saver.setup()
+    asyncio.run(setup())
+
+    shares = [sessions // workers + (i < sessions % workers)
+              for i in range(workers)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as executor:
+        results = list(executor.map(
+            _run_worker,
+            [backend] * workers,
+            [db_path] * workers,
+            [pool_size] * workers,
+            range(workers),
+            shares,
+            [turns] * workers))
+    elapsed = time.perf_counter() - start
+
+    writes = [t for timings, _ in results for t in timings["write"]]
+    reads = [t for timings, _ in results for t in timings["read"]]
+    errors = sum(errors for _, errors in results)
+    print(
+        f"{backend:<7} {elapsed:6.2f} s  {errors} failed sessions  "
+        f"write p50 {percentile(writes, 0.5):6.2f} ms "
+        f"p99 {percentile(writes, 0.99):7.2f} ms  "
+        f"read p50 {percentile(reads, 0.5):6.2f} ms "
+        f"p99 {percentile(reads, 0.99):7.2f} ms")
+
+
+def main(
+    workers: int,
+    sessions: int,
+    turns: int,
+    pool_size: int
+) -> None:
+    print(
+        f"{workers} workers, {sessions} sessions of {turns} turns, "
+        f"pool of {pool_size} readers")
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ("single", "pooled"):
+            _run(
+                backend,
+                os.path.join(tmp, f"{backend}.db"),
+                workers,
+                sessions,
+                turns,
+                pool_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--sessions", type=int, default=32)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--pool-size", type=int, default=4)
+    args = parser.parse_args()
+    main(args.workers, args.sessions, args.turns, args.pool_size)
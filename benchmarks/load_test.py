@@ -0,0 +1,244 @@
+"""Load test of the chat handlers with simulated users and a fake model.
+
+Concurrent simulated users go through the `welcome` and
+`handle_user_msg_submit` event handlers, against the real runtime and
+checkpoint database, with the deterministic `FakeChatModel` in place of
+OpenAI. The results are printed as JSON, to be compared across commits:
+throughput, time to the first visible reply token, turn and per-node
+latency, checkpoint I/O time and memory. Run from the repository root with:
+
+    python -m benchmarks.load_test --users 20 --turns 5 > results.json
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from typing import Any, AsyncGenerator
+from uuid import UUID
+
+from langchain_core._api import LangChainBetaWarning
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+# the graph module builds its chat model at import time
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from benchmarks.concurrent_sessions import percentile, timed  # noqa: E402
+from rincewrite.testing import FakeChatModel, use_fake_llm  # noqa: E402
+from rincewrite import runtime  # noqa: E402
+from rincewrite.scheduler import llm_scheduler  # noqa: E402
+from rincewrite.rincewrite import RWState  # noqa: E402
+
+Timings = dict[str, list[float]]
+
+_node_timer: contextvars.ContextVar[Any] = contextvars.ContextVar(
+    "rincewrite_node_timer", default=None)
+register_configure_hook(_node_timer, inheritable=True)
+
+
+class _NodeTimer(AsyncCallbackHandler):
+    """Times the runs of the graph nodes."""
+
+    run_inline = True
+
+    def __init__(self) -> None:
+        self.timings: Timings = {}
+        self._started: dict[UUID, tuple[str, float]] = {}
+
+    async def on_chain_start(
+        self,
+        serialized: dict[str, Any],
+        inputs: dict[str, Any],
+        *,
+        run_id: UUID,
+        metadata: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        node = (metadata or {}).get("langgraph_node")
+        # the run of the node itself, not of the runnables inside it
+        if node is not None and kwargs.get("name") == node:
+            self._started[run_id] = (node, time.perf_counter())
+
+    async def _end(self, run_id: UUID) -> None:
+        if run_id in self._started:
+            node, start = self._started.pop(run_id)
+            self.timings.setdefault(node, []).append(
+                (time.perf_counter() - start) * 1000)
+
+    async def on_chain_end(
+        self,
+        outputs: dict[str, Any],
+        *,
+        run_id: UUID,
+        **kwargs: Any
+    ) -> None:
+        await self._end(run_id)
+
+    async def on_chain_error(
+        self,
+        error: BaseException,
+        *,
+        run_id: UUID,
+        **kwargs: Any
+    ) -> None:
+        await self._end(run_id)
+
+
+def _stats(values: list[float]) -> dict[str, Any]:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 0.5) if values else None,
+        "p95": percentile(values, 0.95) if values else None,
+        "p99": percentile(values, 0.99) if values else None,
+    }
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1e6 if sys.platform == "darwin" else 1e3)
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _drive(
+    handler: AsyncGenerator[None, None],
+    state: RWState,
+    timings: Timings
+) -> None:
+    # times a handler as the user sees it, through the state it yields
+    start = time.perf_counter()
+    ttft = None
+    async for _ in handler:
+        last = state.messages[-1] if state.messages else None
+        if (ttft is None and last and last["type"] == "ai"
+                and last["msg"]):
+            ttft = (time.perf_counter() - start) * 1000
+    timings["turn"].append((time.perf_counter() - start) * 1000)
+    if ttft is not None:
+        timings["ttft"].append(ttft)
+
+
+async def _user(
+    user: int,
+    turns: int,
+    think_time: float,
+    timings: Timings
+) -> None:
+    state = RWState(_reflex_internal_init=True)
+    state.user_name = f"load-test-user-{user}"
+    state.user_desc = "A simulated user."
+    state.piece_title = "The Colour of Benchmarks"
+    state.piece_desc = "A piece written under load."
+    await _drive(RWState.welcome.fn(state, {}), state, timings)
+    for turn in range(turns):
+        await asyncio.sleep(think_time)
+        await _drive(
+            RWState.handle_user_msg_submit.fn(
+                state, {"text_area_input": f"Please write part {turn}."}),
+            state,
+            timings)
+
+
+async def _load_test(args: argparse.Namespace) -> dict[str, Any]:
+    timings: Timings = {"turn": [], "ttft": [], "write": [], "read": []}
+    llm_scheduler.max_concurrency = args.max_concurrency
+    node_timer = _NodeTimer()
+    _node_timer.set(node_timer)
+    rss_before = _peak_rss_mb()
+
+    graph = await runtime.open_runtime()
+    saver: Any = graph.checkpointer
+    # instance attributes, so that the graph calls the timed methods
+    saver.aput = timed(saver.aput, timings["write"])
+    saver.aput_writes = timed(saver.aput_writes, timings["write"])
+    saver.aget_tuple = timed(saver.aget_tuple, timings["read"])
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(_user(user, args.turns, args.think_ms / 1000, timings)
+              for user in range(args.users)),
+            return_exceptions=True)
+        wall_time = time.perf_counter() - start
+    finally:
+        await runtime.close_runtime()
+
+    errors = [repr(r) for r in results if isinstance(r, BaseException)]
+    return {
+        "commit": _commit(),
+        "config": vars(args),
+        "wall_time_s": wall_time,
+        "turns": len(timings["turn"]),
+        "throughput_turns_per_s": len(timings["turn"]) / wall_time,
+        "errors": errors,
+        "ttft_ms": _stats(timings["ttft"]),
+        "turn_ms": _stats(timings["turn"]),
+        "node_ms": {
+            node: _stats(values)
+            for node, values in sorted(node_timer.timings.items())},
+        "checkpoint_ms": {
+            "write": _stats(timings["write"]),
+            "read": _stats(timings["read"]),
+            "total_s": (sum(timings["write"]) + sum(timings["read"])) / 1000,
+        },
+        "llm_wait_ms": llm_scheduler.status()["wait_ms"],
+        "memory_mb": {
+            "peak_rss": _peak_rss_mb(),
+            "peak_rss_increase": _peak_rss_mb() - rss_before,
+        },
+    }
+
+
+def main(args: argparse.Namespace) -> None:
+    warnings.simplefilter("ignore", LangChainBetaWarning)
+    use_fake_llm(FakeChatModel(
+        first_token_delay=args.latency_ms / 1000,
+        token_delay=1 / args.tokens_per_s if args.tokens_per_s else 0,
+        reply_tokens=args.reply_tokens,
+        piece_tokens=args.piece_tokens))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["RINCEWRITE_DATABASE_URL"] = (
+            args.database_url or f"sqlite:///{tmp}/rincewrite.db")
+        results = asyncio.run(_load_test(args))
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument(
+        "--think-ms", type=float, default=0,
+        help="pause of a user between two messages")
+    parser.add_argument(
+        "--latency-ms", type=float, default=300,
+        help="delay before the first token of each model call")
+    parser.add_argument(
+        "--tokens-per-s", type=float, default=100,
+        help="token rate of the model (0 for no delay)")
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--piece-tokens", type=int, default=400)
+    parser.add_argument(
+        "--max-concurrency", type=int, default=8,
+        help="model calls in flight (0 for no limit)")
+    parser.add_argument(
+        "--database-url", default=None,
+        help="checkpoint database (a temporary SQLite file by default)")
+    main(parser.parse_args())
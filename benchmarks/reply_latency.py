@@ -0,0 +1,88 @@
+"""Time to the first token of the chat reply, with the sequential and the
+parallel graph topologies.
+
+The model is the deterministic `FakeChatModel`, streaming a token every
+`--token-ms` milliseconds, so the piece rewrite takes as long as its length.
+Run from the repository root with:
+
+    python -m benchmarks.reply_latency --turns 5 --piece-tokens 400
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import warnings
+
+from langchain_core._api import LangChainBetaWarning
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.memory import MemorySaver
+
+# the graph module builds its chat model at import time
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from rincewrite.testing import FakeChatModel, use_fake_llm  # noqa: E402
+from rincewrite.graph import build_graph  # noqa: E402
+
+
+async def _turns(topology: str, turns: int) -> dict[str, list[float]]:
+    timings: dict[str, list[float]] = {"ttft": [], "piece": [], "turn": []}
+    graph = build_graph(topology).compile(
+        checkpointer=MemorySaver(),
+        interrupt_before=["user_action"]
+    )
+    config = RunnableConfig({"configurable": {"thread_id": topology}})
+    await graph.ainvoke(
+        {
+            "piece_title": "The Colour of Benchmarks",
+            "piece_desc": "A scripted session",
+            "piece_text": "",
+            "messages": [],
+        },
+        config)
+    for turn in range(turns):
+        await graph.aupdate_state(
+            config,
+            {"messages": [f"Please write part {turn}."]},
+            as_node="user_action")
+        start = time.perf_counter()
+        ttft = piece = None
+        async for event in graph.astream_events(None, config, version="v2"):
+            node = event["metadata"].get("langgraph_node")
+            if (ttft is None and event["event"] == "on_chat_model_stream"
+                    and node == "chat" and event["data"]["chunk"].content):
+                ttft = time.perf_counter() - start
+            if (event["event"] == "on_chain_end"
+                    and event["name"] == "update_piece"):
+                piece = time.perf_counter() - start
+        timings["turn"].append(time.perf_counter() - start)
+        timings["ttft"].append(ttft or float("nan"))
+        timings["piece"].append(piece or float("nan"))
+    return timings
+
+
+def main(turns: int, token_ms: float, piece_tokens: int) -> None:
+    warnings.simplefilter("ignore", LangChainBetaWarning)
+    use_fake_llm(FakeChatModel(
+        token_delay=token_ms / 1000,
+        first_token_delay=0.3,
+        piece_tokens=piece_tokens))
+    for topology in ("sequential", "parallel"):
+        timings = asyncio.run(_turns(topology, turns))
+        print(
+            f"{topology:<10} "
+            f"reply ttft {statistics.median(timings['ttft']) * 1000:7.0f} ms"
+            f"  piece done "
+            f"{statistics.median(timings['piece']) * 1000:7.0f} ms"
+            f"  turn {statistics.median(timings['turn']) * 1000:7.0f} ms"
+            f"  (medians over {turns} turns)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--token-ms", type=float, default=10)
+    parser.add_argument("--piece-tokens", type=int, default=400)
+    args = parser.parse_args()
+    main(args.turns, args.token_ms, args.piece_tokens)
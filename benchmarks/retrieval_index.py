@@ -0,0 +1,111 @@
+"""Build and update time of the retrieval index on a large piece.
+
+A piece of `--chapters` chapters and a conversation of `--messages`
+messages are indexed from scratch, as after a worker restart, then a
+chapter is edited and a message added, as after a turn, and the index is
+searched. Only the section index and the BM25 indexes are measured, without
+the graph or a model. Run from the repository root with:
+
+    python -m benchmarks.retrieval_index --chapters 200 --messages 2000
+"""
+
+import argparse
+import os
+import time
+from typing import Any, Callable
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+# the graph module builds its chat model at import time
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from rincewrite.testing import words  # noqa: E402
+from rincewrite.document import (  # noqa: E402
+    changed_sections, index_sections, piece_context)
+from rincewrite.history import estimate_tokens  # noqa: E402
+from rincewrite.retrieval import ThreadIndex, recall  # noqa: E402
+
+
+def _timed(label: str, function: Callable[[], Any], repeat: int = 1) -> Any:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<34} {elapsed * 1000:9.2f} ms")
+    return result
+
+
+def _piece(chapters: int, paragraphs: int) -> str:
+    return "".join(
+        f"## Chapter {i}\n\n"
+        + "".join(
+            f"{words(60 + (i * 7 + j) % 40)} chapter{i} scene{j}.\n\n"
+            for j in range(paragraphs))
+        for i in range(chapters))
+
+
+def main(chapters: int, paragraphs: int, messages: int, budget: int) -> None:
+    text = _piece(chapters, paragraphs)
+    history = [
+        (HumanMessage if i % 2 == 0 else AIMessage)(
+            content=f"{words(30 + i % 20)} decision{i}", id=f"m{i}")
+        for i in range(messages)]
+    print(
+        f"{chapters} chapters, ~{estimate_tokens(text)} tokens, "
+        f"{messages} messages")
+
+    sections = _timed("section index", lambda: index_sections(text))
+    index = ThreadIndex()
+    _timed(
+        "BM25 build (sections)",
+        lambda: index.sync_sections(text, sections))
+    _timed("BM25 build (messages)", lambda: index.sync_messages(history))
+
+    # one paragraph added to a chapter in the middle of the piece
+    middle = f"## Chapter {chapters // 2}\n\n"
+    edited = text.replace(middle, middle + "A new paragraph.\n\n")
+    new_sections = _timed(
+        "section index update", lambda: index_sections(edited, sections))
+    changed = changed_sections(sections, new_sections)
+    print(f"{'changed sections':<34} {changed}")
+    indexed = _timed(
+        "BM25 update (sections)",
+        lambda: index.sync_sections(edited, new_sections, prune=True))
+    print(f"{'sections indexed again':<34} {indexed}")
+    history.append(HumanMessage(
+        content=f"What did we decide in decision{messages // 3}?",
+        id="last"))
+    _timed("BM25 update (message)", lambda: index.sync_messages(history))
+    _timed("BM25 sync, nothing new", lambda: (
+        index.sync_sections(edited, new_sections),
+        index.sync_messages(history)), repeat=20)
+
+    query = f"Rework chapter {chapters // 3}, the scene2 at the station."
+    context = _timed(
+        "piece context", lambda: piece_context(
+            edited, new_sections, query, [], index.sections.scores(query),
+            budget),
+        repeat=20)
+    shown = context.split("\nSections:\n", 1)[1]
+    print(
+        f"{'piece context tokens':<34} {estimate_tokens(context)}, "
+        f"chapter shown: {f'## Chapter {chapters // 3}' in shown}")
+    recalled = _timed(
+        "message recall", lambda: recall(
+            index, history, history[-10:], history[-1].content),
+        repeat=20)
+    found = [line for line in str(recalled.content).splitlines()
+             if f"decision{messages // 3}" in line] if recalled else []
+    print(f"{'recalled the decision':<34} {bool(found)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chapters", type=int, default=200)
+    parser.add_argument("--paragraphs", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument(
+        "--budget", type=int, default=4000,
+        help="token budget of the piece context")
+    args = parser.parse_args()
+    main(args.chapters, args.paragraphs, args.messages, args.budget)
@@ -0,0 +1,118 @@
+"""Per-message graph setup overhead, before and after the shared runtime.
+
+Only the non-LLM part of a turn is measured: opening the checkpointer,
+compiling the graph and recording the user message. Run from the repository
+root with:
+
+    python -m benchmarks.runtime_overhead --messages 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+# the graph module builds its chat model at import time
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from rincewrite.graph import graph_builder  # noqa: E402
+
+
+def _config(thread_id: str) -> RunnableConfig:
+    return RunnableConfig({"configurable": {"thread_id": thread_id}})
+
+
+async def _seed(db_path: str, thread_id: str) -> None:
+    async with AsyncSqliteSaver.from_conn_string(db_path) as memory:
+        graph = graph_builder.compile(
+            checkpointer=memory,
+            interrupt_before=["user_action"]
+        )
+        await graph.aupdate_state(
+            _config(thread_id),
+            {
+                "piece_title": "Benchmark",
+                "piece_desc": "A piece used to benchmark the runtime",
+                "piece_text": "",
+                "messages": [],
+            },
+            as_node="welcome")
+
+
+async def _per_event_setup(db_path: str, thread_id: str, text: str) -> None:
+    # what `handle_user_msg_submit` did before: two saver/compile rounds
+    async with AsyncSqliteSaver.from_conn_string(db_path) as memory:
+        graph = graph_builder.compile(
+            checkpointer=memory,
+            interrupt_before=["user_action"]
+        )
+        await graph.aupdate_state(
+            _config(thread_id), {"messages": [text]}, as_node="user_action")
+    async with AsyncSqliteSaver.from_conn_string(db_path) as memory:
+        graph = graph_builder.compile(
+            checkpointer=memory,
+            interrupt_before=["user_action"]
+        )
+        await graph.aget_state(_config(thread_id))
+
+
+async def _measure(
+    messages: int,
+    turn: Callable[[int], Awaitable[None]]
+) -> list[float]:
+    timings = []
+    for i in range(messages):
+        start = time.perf_counter()
+        await turn(i)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _report(label: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    p95 = timings[int(0.95 * (len(timings) - 1))]
+    print(
+        f"{label:<12} mean {statistics.mean(timings):7.2f} ms  "
+        f"p50 {statistics.median(timings):7.2f} ms  p95 {p95:7.2f} ms")
+
+
+async def main(messages: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        await _seed(db_path, "before")
+        await _seed(db_path, "after")
+
+        before = await _measure(
+            messages,
+            lambda i: _per_event_setup(db_path, "before", f"message {i}"))
+
+        async with AsyncSqliteSaver.from_conn_string(db_path) as memory:
+            graph = graph_builder.compile(
+                checkpointer=memory,
+                interrupt_before=["user_action"]
+            )
+
+            async def shared(i: int) -> None:
+                await graph.aupdate_state(
+                    _config("after"),
+                    {"messages": [f"message {i}"]},
+                    as_node="user_action")
+                await graph.aget_state(_config("after"))
+
+            after = await _measure(messages, shared)
+
+    _report("per-event", before)
+    _report("shared", after)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages))
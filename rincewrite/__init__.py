@@ -0,0 +1,6 @@
+import os
+
+if os.getenv("RINCEWRITE_STARTUP_PROFILE") == "true":
+    # before anything else of the app is imported (see `startup`)
+    from . import startup
+    startup.install()
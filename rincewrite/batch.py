@@ -0,0 +1,310 @@
+"""Headless batch runs of the graph over many pieces.
+
+Each job is a user, a piece and scripted user messages, run through the
+same graph as the app, without Reflex: the welcome turn, then one turn per
+message. Jobs are read from a JSON lines file, one job per line, or from a
+directory of `.json` files, one job per file:
+
+    {"id": "wizard", "user_desc": "...", "piece_title": "...",
+     "piece_desc": "...", "piece_text": "", "messages": ["...", "..."]}
+
+Only `messages` is needed; `id` defaults to the line number or the file
+name. Each job has its own checkpoint thread (`batch:<id>` by default) in
+the configured database, so that a run stopped midway goes on from the
+last checkpoint of each job when started again, and the jobs already done
+in the output file are skipped.
+
+A line per job (the replies, the final piece, turn latencies and tokens,
+or the error) is appended to the output file as soon as the job is over,
+and a summary (throughput, turn latency and time to the first reply token,
+tokens) is printed as JSON at the end. With `--fake-model`, the
+deterministic model of the benchmarks stands in for OpenAI, without
+network. Run from the repository root with:
+
+    python -m rincewrite.batch jobs.jsonl --output results.jsonl \
+        --concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import warnings
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, TextIO
+
+from langchain_core._api import LangChainBetaWarning
+from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.runnables import RunnableConfig
+
+from . import metrics
+
+if TYPE_CHECKING:
+    from langgraph.graph.state import CompiledStateGraph
+
+# nodes whose model output is the assistant's reply, as in the app
+_REPLY_NODES = ("welcome", "chat", "chat_only")
+
+
+class BatchJob(BaseModel):
+    id: str
+    user_name: str = "batch"
+    user_desc: str = ""
+    piece_title: str = ""
+    piece_desc: str = ""
+    piece_text: str = ""
+    messages: list[str] = []
+
+
+def load_jobs(path: Path) -> list[BatchJob]:
+    if path.is_dir():
+        sources = [
+            (file.stem, file.read_text(encoding="utf-8"))
+            for file in sorted(path.glob("*.json"))]
+    else:
+        sources = [
+            (f"line-{number}", line)
+            for number, line in enumerate(
+                path.read_text(encoding="utf-8").splitlines(), 1)
+            if line.strip()]
+    jobs = []
+    for default_id, source in sources:
+        try:
+            jobs.append(BatchJob(**{"id": default_id, **json.loads(source)}))
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid job {default_id}: {e}") from e
+    ids = [job.id for job in jobs]
+    duplicates = sorted({i for i in ids if ids.count(i) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate job ids: {', '.join(duplicates)}")
+    return jobs
+
+
+def done_jobs(output: Path) -> set[str]:
+    # jobs of a previous run already written out
+    if not output.exists():
+        return set()
+    done = set()
+    for line in output.read_text(encoding="utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # the last line of a run that was killed
+            continue
+        if record.get("status") == "done":
+            done.add(record["id"])
+    return done
+
+
+async def _run_turn(
+    graph: "CompiledStateGraph",
+    graph_input: dict[str, Any] | None,
+    config: RunnableConfig,
+    kind: str
+) -> metrics.TurnMetrics:
+    # runs the graph until it waits for the next user message
+    turn = metrics.start_turn(kind, config["configurable"]["thread_id"])
+    started = time.perf_counter()
+    try:
+        async for event in graph.astream_events(
+            graph_input,
+            config,
+            version="v2"
+        ):
+            event_kind = event["event"]
+            node = event["metadata"].get("langgraph_node")
+            if node is not None and event["name"] == node:
+                if event_kind == "on_chain_start":
+                    turn.node_start(node)
+                elif event_kind == "on_chain_end":
+                    turn.node_end(node)
+            if (event_kind == "on_chat_model_stream"
+                    and node in _REPLY_NODES and turn.ttft_ms is None
+                    and event["data"]["chunk"].content):
+                turn.ttft_ms = (time.perf_counter() - started) * 1000
+            if event_kind == "on_chat_model_end":
+                turn.add_usage(event["data"]["output"])
+    except Exception as e:
+        turn.error = repr(e)
+        raise
+    finally:
+        metrics.end_turn(turn)
+    return turn
+
+
+async def run_job(
+    graph: "CompiledStateGraph",
+    job: BatchJob,
+    thread_prefix: str
+) -> dict[str, Any]:
+    config = RunnableConfig({
+        "configurable": {
+            "thread_id": f"{thread_prefix}{job.id}",
+            "user_name": job.user_name,
+            "user_desc": job.user_desc}})
+    turns: list[metrics.TurnMetrics] = []
+    state = await graph.aget_state(config)
+    if not state.values:
+        turns.append(await _run_turn(
+            graph,
+            {
+                "piece_title": job.piece_title,
+                "piece_desc": job.piece_desc,
+                "piece_text": job.piece_text,
+                "messages": [],
+            },
+            config,
+            "welcome"))
+    elif state.next and "user_action" not in state.next:
+        # a turn stopped midway, run again from its last checkpoint
+        turns.append(await _run_turn(graph, None, config, "message"))
+    state = await graph.aget_state(config)
+    sent = sum(
+        message.type == "human" for message in state.values["messages"])
+    for message in job.messages[sent:]:
+        await graph.aupdate_state(
+            config, {"messages": [message]}, as_node="user_action")
+        turns.append(await _run_turn(graph, None, config, "message"))
+
+    values = (await graph.aget_state(config)).values
+    # the welcome message, then the reply to each message
+    replies = [""]
+    for message in values["messages"]:
+        if message.type == "human":
+            replies.append("")
+        elif message.type == "ai":
+            replies[-1] = str(message.content)
+    return {
+        "id": job.id,
+        "thread_id": config["configurable"]["thread_id"],
+        "status": "done",
+        "welcome": replies[0],
+        "replies": replies[1:],
+        "piece_title": values["piece_title"],
+        "piece_desc": values["piece_desc"],
+        "piece_text": values["piece_text"],
+        # the turns run this time, not the ones of a previous run
+        "turns": [
+            {
+                "kind": turn.kind,
+                "total_ms": turn.total_ms,
+                "ttft_ms": turn.ttft_ms,
+                "prompt_tokens": turn.prompt_tokens,
+                "completion_tokens": turn.completion_tokens,
+            }
+            for turn in turns],
+    }
+
+
+async def run_batch(
+    jobs: list[BatchJob],
+    output: TextIO,
+    concurrency: int = 4,
+    thread_prefix: str = "batch:"
+) -> dict[str, Any]:
+    from . import runtime
+
+    graph = await runtime.open_runtime()
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    records: list[dict[str, Any]] = []
+
+    async def run(job: BatchJob) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                record = await run_job(graph, job, thread_prefix)
+            except Exception as e:
+                record = {"id": job.id, "status": "error", "error": repr(e)}
+            record["elapsed_ms"] = (time.perf_counter() - started) * 1000
+        records.append(record)
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(run(job) for job in jobs))
+    finally:
+        wall_time = time.perf_counter() - started
+        await runtime.close_runtime()
+
+    turns = [
+        turn for record in records for turn in record.get("turns", [])]
+    return {
+        "jobs": len(jobs),
+        "done": sum(record["status"] == "done" for record in records),
+        "errors": [
+            f"{record['id']}: {record['error']}" for record in records
+            if record["status"] == "error"],
+        "turns": len(turns),
+        "wall_time_s": round(wall_time, 2),
+        "jobs_per_s": round(len(records) / wall_time, 3) if wall_time else 0,
+        "turns_per_s": round(len(turns) / wall_time, 3) if wall_time else 0,
+        "turn_ms": metrics.stats([turn["total_ms"] for turn in turns]),
+        "ttft_ms": metrics.stats([
+            turn["ttft_ms"] for turn in turns
+            if turn["ttft_ms"] is not None]),
+        "tokens": {
+            "prompt": sum(turn["prompt_tokens"] for turn in turns),
+            "completion": sum(turn["completion_tokens"] for turn in turns),
+        },
+    }
+
+
+def _use_fake_model(args: argparse.Namespace) -> None:
+    # the graph module builds its chat model at import time
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    from .testing import FakeChatModel, use_fake_llm
+
+    use_fake_llm(FakeChatModel(
+        first_token_delay=args.fake_latency_ms / 1000,
+        token_delay=(
+            1 / args.fake_tokens_per_s if args.fake_tokens_per_s else 0)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m rincewrite.batch",
+        description="Headless batch runs of the Rincewrite graph.")
+    parser.add_argument(
+        "jobs", type=Path,
+        help="JSON lines file of jobs, or directory of .json jobs")
+    parser.add_argument(
+        "--output", type=Path, default=Path("batch-results.jsonl"),
+        help="JSON lines file the results are appended to")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="jobs run at a time")
+    parser.add_argument(
+        "--thread-prefix", default="batch:",
+        help="prefix of the checkpoint thread ids of the jobs")
+    parser.add_argument(
+        "--database-url", default=None,
+        help="checkpoint database (RINCEWRITE_DATABASE_URL by default)")
+    parser.add_argument(
+        "--fake-model", action="store_true",
+        help="use the deterministic fake model, without network")
+    parser.add_argument("--fake-latency-ms", type=float, default=0)
+    parser.add_argument(
+        "--fake-tokens-per-s", type=float, default=0,
+        help="token rate of the fake model (0 for no delay)")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", LangChainBetaWarning)
+    if args.database_url:
+        os.environ["RINCEWRITE_DATABASE_URL"] = args.database_url
+    if args.fake_model:
+        _use_fake_model(args)
+    jobs = load_jobs(args.jobs)
+    done = done_jobs(args.output)
+    todo = [job for job in jobs if job.id not in done]
+    with args.output.open("a", encoding="utf-8") as output:
+        summary = asyncio.run(run_batch(
+            todo, output, args.concurrency, args.thread_prefix))
+    summary["skipped"] = len(jobs) - len(todo)
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
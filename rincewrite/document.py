@@ -0,0 +1,238 @@
+"""Section index of the piece text.
+
+The piece stays one markdown text, indexed by its headings: each section
+(the text under a heading, up to the next heading) gets a stable id, kept
+across updates as long as the section keeps its content or its heading, and
+a content hash. The index only holds lengths, so the entry of a section is
+unchanged, and stored once by the checkpointer, until the section itself
+changes.
+
+Long pieces are not sent whole to the prompts: past
+`RINCEWRITE_PIECE_CONTEXT_TOKENS` estimated tokens (0, the default, always
+sends the whole piece), prompts get an outline of the piece and the full
+text of the sections most relevant to the last message only.
+"""
+
+import hashlib
+import os
+import re
+from typing import Iterator
+
+from langchain_core.messages.base import BaseMessage
+from langchain_core.pydantic_v1 import BaseModel
+
+from .history import estimate_tokens
+
+PIECE_CONTEXT_TOKENS = int(os.getenv("RINCEWRITE_PIECE_CONTEXT_TOKENS", "0"))
+
+_HEADING = re.compile(r"^(#{1,6})\s+\S.*$", re.MULTILINE)
+_WORD = re.compile(r"\w+")
+_PARAGRAPH_END = re.compile(r"(?<=\n\n)")
+_LABEL_END = re.compile(r"[:.\-\u2013\u2014]")
+_HASH_SIZE = 8
+
+
+class Section(BaseModel):
+    id: str
+    # heading line, empty for the text before the first heading
+    heading: str
+    # heading level, 0 for the text before the first heading
+    level: int
+    length: int
+    words: int
+    hash: str
+
+
+def _hash(text: str) -> str:
+    return hashlib.blake2b(
+        text.encode(), digest_size=_HASH_SIZE).hexdigest()
+
+
+def _split(text: str) -> Iterator[tuple[str, int, int, int]]:
+    # heading, level, start and end of each section
+    start, heading, level = 0, "", 0
+    for m in _HEADING.finditer(text):
+        if m.start() > start or heading:
+            yield heading, level, start, m.start()
+        start, heading, level = m.start(), m.group(0).strip(), len(m.group(1))
+    if len(text) > start or heading:
+        yield heading, level, start, len(text)
+
+
+def split_sections(text: str) -> list[str]:
+    return [text[start:end] for _, _, start, end in _split(text)]
+
+
+def index_sections(
+    text: str,
+    previous: list[Section] | None = None
+) -> list[Section]:
+    # a section keeps its id if its content, or else its heading, is found
+    # in the previous index
+    previous = previous or []
+    by_hash: dict[str, list[Section]] = {}
+    by_heading: dict[str, list[Section]] = {}
+    for section in previous:
+        by_hash.setdefault(section.hash, []).append(section)
+        by_heading.setdefault(section.heading, []).append(section)
+    used: set[str] = set()
+    next_id = 1 + max(
+        (int(s.id[1:]) for s in previous if s.id[1:].isdigit()), default=0)
+
+    def reuse(candidates: list[Section]) -> Section | None:
+        for candidate in candidates:
+            if candidate.id not in used:
+                used.add(candidate.id)
+                return candidate
+        return None
+
+    spans = list(_split(text))
+    hashes = [_hash(text[start:end]) for _, _, start, end in spans]
+    matches = [reuse(by_hash.get(h, [])) for h in hashes]
+    sections = []
+    for (heading, level, start, end), hash_, match in zip(
+            spans, hashes, matches):
+        if match is None:
+            match = reuse(by_heading.get(heading, []))
+        if match is None:
+            section_id = f"s{next_id}"
+            next_id += 1
+        else:
+            section_id = match.id
+        if (match is not None and match.hash == hash_
+                and match.heading == heading and match.level == level):
+            # unchanged
+            sections.append(match)
+            continue
+        sections.append(Section(
+            id=section_id, heading=heading, level=level, length=end - start,
+            words=len(_WORD.findall(text, start, end)), hash=hash_))
+    return sections
+
+
+def ensure_index(
+    text: str,
+    sections: list[Section] | None
+) -> list[Section]:
+    # the index of a text, reindexed if it was made for another text
+    if sections is None or sum(s.length for s in sections) != len(text):
+        return index_sections(text, sections)
+    return sections
+
+
+def section_texts(text: str, sections: list[Section]) -> list[str]:
+    texts, start = [], 0
+    for section in sections:
+        texts.append(text[start:start + section.length])
+        start += section.length
+    return texts
+
+
+def changed_sections(
+    previous: list[Section],
+    sections: list[Section]
+) -> list[str]:
+    # ids of the sections added or modified
+    hashes = {section.id: section.hash for section in previous}
+    return [
+        section.id for section in sections
+        if hashes.get(section.id) != section.hash]
+
+
+def outline(sections: list[Section]) -> str:
+    lines = []
+    for section in sections:
+        heading = section.heading or "(before the first heading)"
+        lines.append(
+            f"{'  ' * max(section.level - 1, 0)}- {heading} "
+            f"({section.words} words)")
+    return "\n".join(lines)
+
+
+def relevant_sections(
+    sections: list[Section],
+    query: str,
+    scores: dict[str, float] | None = None,
+    recent: list[str] | None = None
+) -> list[int]:
+    # positions of the sections, the most relevant first: the ones whose
+    # heading is quoted in the query, then by retrieval score of their hash
+    # (see `retrieval`), then the ones changed last
+    lowered = query.lower()
+    scores = scores or {}
+    recent = recent or []
+    ranks = []
+    for i, section in enumerate(sections):
+        # "chapter 2" stands for "## Chapter 2: The Luggage"
+        label = _LABEL_END.split(
+            section.heading.lstrip("#").strip().lower(), 1)[0].strip()
+        quoted = bool(label) and re.search(
+            rf"\b{re.escape(label)}\b", lowered) is not None
+        ranks.append((
+            not quoted,
+            -scores.get(section.hash, 0.0),
+            section.id not in recent,
+            i))
+    return [rank[-1] for rank in sorted(ranks)]
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    # the first paragraphs of the text that fit
+    kept = []
+    for paragraph in _PARAGRAPH_END.split(text):
+        max_tokens -= estimate_tokens(paragraph)
+        if max_tokens < 0:
+            break
+        kept.append(paragraph)
+    return "".join(kept) + "[...]\n\n" if kept else ""
+
+
+def piece_context(
+    text: str,
+    sections: list[Section] | None,
+    query: str,
+    recent: list[str] | None = None,
+    scores: dict[str, float] | None = None,
+    max_tokens: int = PIECE_CONTEXT_TOKENS
+) -> str:
+    # the piece text as sent to a prompt
+    if not max_tokens or estimate_tokens(text) <= max_tokens:
+        return text
+    sections = ensure_index(text, sections)
+    texts = section_texts(text, sections)
+    head = (
+        "The piece is long, only its outline and the sections most "
+        "relevant to the conversation are shown. A heading line of the "
+        "outline stands for its whole section.\n\nOutline:\n"
+        f"{outline(sections)}\n\nSections:\n\n")
+    budget = max_tokens - estimate_tokens(head)
+    shown = []
+    for i in relevant_sections(sections, query, scores, recent):
+        cost = estimate_tokens(texts[i])
+        if cost > budget:
+            if not shown:
+                # the most relevant section is shown, as far as it fits
+                texts[i] = _truncate(texts[i], budget)
+                shown.append(i)
+                break
+            continue
+        shown.append(i)
+        budget -= cost
+    parts, last = [], -1
+    for i in sorted(shown):
+        if i != last + 1:
+            # sections left out
+            parts.append("[...]\n\n")
+        parts.append(texts[i])
+        last = i
+    if last != len(texts) - 1:
+        parts.append("\n\n[...]")
+    return head + "".join(parts)
+
+
+def last_query(messages: list[BaseMessage]) -> str:
+    # the user's message the turn answers
+    for message in reversed(messages):
+        if message.type == "human":
+            return str(message.content)
+    return ""
@@ -0,0 +1,603 @@
+"""LangGraph definition of the Rincewrite writing assistant."""
+
+import asyncio
+import functools
+import logging
+import os
+from typing import Annotated, Any
+from typing_extensions import TypedDict
+from langchain_core.pydantic_v1 import BaseModel, Field, ValidationError
+from langgraph.graph import StateGraph
+from langgraph.graph.message import add_messages
+from langgraph.graph.state import CompiledStateGraph
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import HumanMessage
+from langchain_core.messages.base import BaseMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from . import retrieval, router, scheduler
+from .document import (
+    Section, changed_sections, ensure_index, last_query, piece_context)
+from .history import (
+    estimate_tokens, prompt_history, report_prompt, summary_chain,
+    to_summarize)
+from .patches import (
+    PATCH_INSTRUCTIONS, EditOperation, PatchError, PiecePatch, apply_patch,
+    text_diff)
+from .prompts import PROMPTS, get_prompt
+from .response_cache import (
+    WELCOME_CACHE, ReplayChatModel, cache_key, welcome_cache)
+from .speculation import speculative_config
+
+logger = logging.getLogger(__name__)
+
+model_name = "gpt-4o-mini"
+model = ChatOpenAI(
+    model=model_name, temperature=0.7, streaming=True, stream_usage=True)
+
+# 'rewrite' regenerates the whole piece on each turn, 'patch' asks for
+# targeted edit operations and falls back to a rewrite when they don't apply
+PIECE_UPDATE_MODE = os.getenv("RINCEWRITE_PIECE_UPDATE_MODE", "rewrite")
+
+# 'sequential' replies once the piece is updated, 'parallel' replies while
+# the piece is being updated, knowing only the user's request
+GRAPH_TOPOLOGY = os.getenv("RINCEWRITE_GRAPH_TOPOLOGY", "sequential")
+
+# stands for the new text in the chat prompt, in the 'parallel' topology
+PIECE_IN_PROGRESS = "(The piece is being updated according to the last \
+message, while you answer. Do not comment on changes you have not seen.)"
+
+
+class PieceUpdate(BaseModel):
+    new_title: str = Field(
+        ...,
+        title="New title for the piece")
+    new_desc: str = Field(
+        ...,
+        title="New description for the piece")
+    new_text: str = Field(
+        ...,
+        title="New text for the piece")
+
+
+class GraphState(TypedDict):
+    piece_title: str
+    piece_desc: str
+    piece_text: str
+    # section index of the piece text, and the sections changed last
+    piece_sections: list[Section]
+    piece_changes: list[str]
+    piece_update: PieceUpdate
+    # unified diff of the last patch, empty after a full rewrite
+    piece_diff: str
+    messages: Annotated[list[BaseMessage], add_messages]
+    # rolling summary of the first `summarized_count` messages
+    summary: str
+    summarized_count: int
+    # whether the last turn updated the piece (see `router`)
+    turn_route: str
+
+
+# 'welcome' Node
+
+
+@functools.cache
+def _welcome_chain() -> Runnable:
+    return get_prompt("welcome") | model
+
+
+async def _welcome(
+    state: GraphState,
+    config: RunnableConfig
+) -> dict[str, Any]:
+
+    inputs = {
+        "user_name":    config["configurable"].get(
+            "user_name",
+            "UNKNOWN_USER"),
+        "user_desc":    config["configurable"].get(
+            "user_desc",
+            "NO_USER_DESC"),
+        "piece_title":   state["piece_title"],
+        "piece_desc":   state["piece_desc"],
+    }
+    if not WELCOME_CACHE:
+        return {"messages": [await scheduler.ainvoke(
+            _welcome_chain(), inputs, config, "welcome")]}
+
+    # the welcome message only depends on its inputs, so a returning user
+    # gets it again, replayed through the same streaming path
+    key = cache_key(f"{PROMPTS['welcome']}/{model_name}", inputs)
+    cached = await welcome_cache.aget(key)
+    if cached is not None:
+        logger.info("Welcome message replayed from the cache")
+        welcome_msg = await ReplayChatModel(response=cached).ainvoke([])
+    else:
+        welcome_msg = await scheduler.ainvoke(
+            _welcome_chain(), inputs, config, "welcome")
+        if isinstance(welcome_msg.content, str) and welcome_msg.content:
+            await welcome_cache.aset(key, welcome_msg.content)
+
+    return {"messages": [welcome_msg]}
+
+# 'user_action' Node
+
+
+def _user_action(state: GraphState) -> None:
+    # this is a 'fake' node, serving as en entry point for the user's actions
+    pass
+
+
+# 'route' Node
+
+
+@functools.cache
+def _route_chain() -> Runnable:
+    if router.ROUTER_MODEL and router.ROUTER_MODEL != model_name:
+        return router.route_chain(
+            ChatOpenAI(model=router.ROUTER_MODEL, temperature=0))
+    return router.route_chain(model)
+
+
+async def _turn_route(
+    state: GraphState,
+    config: RunnableConfig
+) -> tuple[str, str]:
+    messages = state["messages"]
+    last_reply = next(
+        (m.content for m in reversed(messages[:-1]) if m.type == "ai"), "")
+    route, reason = router.classify(
+        str(messages[-1].content), str(last_reply))
+    if route is None and router.INTENT_ROUTER == "model":
+        router.router_stats.model_calls += 1
+        try:
+            turn_route = await scheduler.ainvoke(
+                _route_chain(),
+                {
+                    "piece_title": state["piece_title"],
+                    "messages": messages[-2:],
+                },
+                config,
+                "route",
+                completion_estimate=8)
+        except Exception as e:
+            logger.warning("Routing call failed, updating the piece: %s", e)
+        else:
+            route = router.EDIT if turn_route.needs_edit else router.CHAT
+            reason = "model"
+    # when in doubt, the piece is updated, as it is without a router
+    return route or router.EDIT, reason
+
+
+def _update_piece_cost(state: GraphState) -> int:
+    # estimated prompt and completion tokens of a piece update
+    piece_tokens = estimate_tokens(state["piece_text"])
+    completion = scheduler.COMPLETION_ESTIMATE
+    if PIECE_UPDATE_MODE != "patch" or not state["piece_text"].strip():
+        completion += piece_tokens
+    return estimate_tokens(prompt_history(state)) + piece_tokens + completion
+
+
+def _piece_as_is(state: GraphState) -> dict[str, Any]:
+    return {
+        "piece_update": PieceUpdate(
+            new_title=state["piece_title"],
+            new_desc=state["piece_desc"],
+            new_text=state["piece_text"]),
+        "piece_diff": router.NO_CHANGE}
+
+
+async def _route(
+    state: GraphState,
+    config: RunnableConfig
+) -> dict[str, Any]:
+    route, reason = await _turn_route(state, config)
+    saved_ms = router.update_piece_ms()
+    saved_tokens = _update_piece_cost(state)
+    router.router_stats.record(route, reason, saved_ms, saved_tokens)
+    if route == router.EDIT:
+        logger.info("Turn routed to a piece update (%s)", reason)
+        return {"turn_route": route}
+
+    logger.info(
+        "Turn routed to a reply only (%s), ~%d tokens and ~%.0f ms saved",
+        reason, saved_tokens, saved_ms)
+    # the piece goes on as it is
+    return {"turn_route": route, **_piece_as_is(state)}
+
+
+def _next_sequential(state: GraphState) -> str:
+    return "update_piece" if state["turn_route"] == router.EDIT else "chat"
+
+
+def _next_parallel(state: GraphState) -> list[str] | str:
+    if state["turn_route"] == router.EDIT:
+        return ["update_piece", "chat"]
+    return "chat_only"
+
+
+# 'update_piece_text' Node
+
+
+@functools.cache
+def _update_piece_chain() -> Runnable:
+    return get_prompt("update_piece") | model.with_structured_output(
+        PieceUpdate)
+
+
+@functools.cache
+def _patch_piece_chain() -> Runnable:
+    prompt = get_prompt("update_piece") + [("system", PATCH_INSTRUCTIONS)]
+    return prompt | model.with_structured_output(PiecePatch)
+
+
+async def _update_piece(
+    state: GraphState,
+    config: RunnableConfig
+) -> dict[str, Any]:
+    inputs = {
+        "user_name":    config["configurable"].get(
+            "user_name",
+            "UNKNOWN_USER"),
+        "user_desc":    config["configurable"].get(
+            "user_desc",
+            "NO_USER_DESC"),
+        "piece_title":   state["piece_title"],
+        "piece_desc":   state["piece_desc"],
+        "piece_text":   state["piece_text"],
+        "messages":     _prompt_history(state, config),
+    }
+
+    # there is nothing to patch in an empty piece
+    if PIECE_UPDATE_MODE == "patch" and state["piece_text"].strip():
+        # edits are local, so the model only needs to see part of a long
+        # piece
+        patch_inputs = {
+            **inputs, "piece_text": _piece_context(state, config)}
+        report_prompt("update_piece", patch_inputs)
+        piece_patch = await scheduler.ainvoke(
+            _patch_piece_chain(), patch_inputs, config, "update_piece")
+        try:
+            new_text = apply_patch(state["piece_text"], piece_patch.edits)
+        except PatchError as e:
+            logger.warning("Patch failed, rewriting the piece: %s", e)
+        else:
+            return {
+                "piece_update": PieceUpdate(
+                    new_title=piece_patch.new_title,
+                    new_desc=piece_patch.new_desc,
+                    new_text=new_text),
+                "piece_diff": (
+                    text_diff(state["piece_text"], new_text)
+                    or router.NO_CHANGE)}
+
+    # the whole text is written again
+    report_prompt("update_piece", inputs)
+    piece_update = await scheduler.ainvoke(
+        _update_piece_chain(), inputs, config, "update_piece",
+        scheduler.COMPLETION_ESTIMATE + estimate_tokens(state["piece_text"]))
+
+    return {
+        "piece_update": piece_update,
+        "piece_diff": ""}
+
+
+def preview_piece_update(
+    args: dict[str, Any],
+    state: dict[str, Any]
+) -> PieceUpdate:
+    # best guess of the piece update from the partial arguments of the
+    # update_piece model call, falling back to the current piece
+    new_text = state["piece_text"]
+    if "new_text" in args:
+        new_text = str(args["new_text"])
+    elif args.get("edits"):
+        # the last edit operation may still be incomplete
+        try:
+            new_text = apply_patch(
+                new_text,
+                [EditOperation(**edit) for edit in args["edits"][:-1]])
+        except (PatchError, ValidationError, TypeError):
+            pass
+    return PieceUpdate(
+        new_title=str(args.get("new_title") or state["piece_title"]),
+        new_desc=str(args.get("new_desc") or state["piece_desc"]),
+        new_text=new_text)
+
+
+# 'chat' Node
+
+
+@functools.cache
+def _chat_chain() -> Runnable:
+    return get_prompt("chat") | model
+
+
+def _thread_index(
+    state: GraphState,
+    config: RunnableConfig,
+    text: str,
+    sections: list[Section],
+    prune: bool = False
+) -> retrieval.ThreadIndex:
+    return retrieval.indexes.sync(
+        str(config["configurable"].get("thread_id", "")),
+        text,
+        sections,
+        state["messages"],
+        prune)
+
+
+def _piece_context(
+    state: GraphState,
+    config: RunnableConfig,
+    text: str | None = None,
+    sections: list[Section] | None = None,
+    changes: list[str] | None = None
+) -> str:
+    # the piece, or a given version of it, as sent to the prompts
+    if text is None:
+        text = state["piece_text"]
+        sections = state.get("piece_sections")
+        changes = state.get("piece_changes")
+    sections = ensure_index(text, sections)
+    query = last_query(state["messages"])
+    index = _thread_index(state, config, text, sections)
+    return piece_context(
+        text, sections, query, changes, index.sections.scores(query))
+
+
+def _prompt_history(
+    state: GraphState,
+    config: RunnableConfig
+) -> list[BaseMessage]:
+    # the history window, after the earlier messages relevant to the last
+    # one
+    history = prompt_history(state)
+    index = _thread_index(
+        state,
+        config,
+        state["piece_text"],
+        ensure_index(state["piece_text"], state.get("piece_sections")))
+    recalled = retrieval.recall(
+        index, state["messages"], history, last_query(state["messages"]))
+    return [recalled, *history] if recalled else history
+
+
+def _piece_index(
+    state: GraphState,
+    piece_update: PieceUpdate
+) -> dict[str, Any]:
+    previous = ensure_index(state["piece_text"], state.get("piece_sections"))
+    if piece_update.new_text == state["piece_text"]:
+        # the sections changed last stay the ones of the last edit
+        return {
+            "piece_sections": previous,
+            "piece_changes": state.get("piece_changes") or []}
+    sections = ensure_index(piece_update.new_text, previous)
+    return {
+        "piece_sections": sections,
+        "piece_changes": changed_sections(previous, sections)}
+
+
+def _chat_inputs(
+    state: GraphState,
+    config: RunnableConfig,
+    new_piece_text: str,
+    new_piece_title: str,
+    new_piece_desc: str
+) -> dict[str, Any]:
+    return {
+        "user_name":    config["configurable"].get(
+            "user_name",
+            "UNKNOWN_USER"),
+        "user_desc":    config["configurable"].get(
+            "user_desc",
+            "NO_USER_DESC"),
+        "piece_title":   state["piece_title"],
+        "piece_desc":   state["piece_desc"],
+        "piece_text":   _piece_context(state, config),
+        "messages":     _prompt_history(state, config),
+        "new_piece_text": new_piece_text,
+        "new_piece_title": new_piece_title,
+        "new_piece_desc": new_piece_desc,
+    }
+
+
+async def _chat(
+    state: GraphState,
+    config: RunnableConfig
+) -> dict[str, Any]:
+
+    piece_update = state["piece_update"]
+    piece_index = _piece_index(state, piece_update)
+    inputs = _chat_inputs(
+        state,
+        config,
+        # after a patch, the changes are enough to comment on the new text
+        state.get("piece_diff") or _piece_context(
+            state,
+            config,
+            piece_update.new_text,
+            piece_index["piece_sections"],
+            piece_index["piece_changes"]),
+        piece_update.new_title,
+        piece_update.new_desc)
+    report_prompt("chat", inputs)
+    chat_msg = await scheduler.ainvoke(_chat_chain(), inputs, config, "chat")
+    # the retrieval index follows the piece as updated
+    _thread_index(
+        state,
+        config,
+        piece_update.new_text,
+        piece_index["piece_sections"],
+        prune=True)
+
+    return {
+        "piece_text": piece_update.new_text,
+        "piece_title": piece_update.new_title,
+        "piece_desc": piece_update.new_desc,
+        **piece_index,
+        "messages": [chat_msg]}
+
+
+# 'chat' Node, 'parallel' topology
+
+
+async def _concurrent_chat(
+    state: GraphState,
+    config: RunnableConfig
+) -> dict[str, Any]:
+    # runs alongside 'update_piece', so the piece update is not known yet
+    inputs = _chat_inputs(
+        state,
+        config,
+        PIECE_IN_PROGRESS,
+        state["piece_title"],
+        state["piece_desc"])
+    report_prompt("chat", inputs)
+    chat_msg = await scheduler.ainvoke(_chat_chain(), inputs, config, "chat")
+
+    return {"messages": [chat_msg]}
+
+
+# 'apply_piece' Node, 'parallel' topology
+
+
+def _apply_piece(
+    state: GraphState,
+    config: RunnableConfig
+) -> dict[str, Any]:
+    # joins the two branches, once both are done
+    piece_update = state["piece_update"]
+    piece_index = _piece_index(state, piece_update)
+    # the retrieval index follows the piece as updated
+    _thread_index(
+        state,
+        config,
+        piece_update.new_text,
+        piece_index["piece_sections"],
+        prune=True)
+    return {
+        "piece_text": piece_update.new_text,
+        "piece_title": piece_update.new_title,
+        "piece_desc": piece_update.new_desc,
+        **piece_index}
+
+
+# 'summarize' Node
+
+
+@functools.cache
+def _summary_chain() -> Runnable:
+    return summary_chain(model)
+
+
+async def _summarize(
+    state: GraphState,
+    config: RunnableConfig
+) -> dict[str, Any]:
+    # folds the messages that fell out of the history window into the
+    # summary, starting from the previous summary
+    messages = to_summarize(state)
+    if not messages:
+        return {}
+    summary = await scheduler.ainvoke(
+        _summary_chain(),
+        {
+            "summary": state.get("summary") or "(empty)",
+            "messages": messages,
+        },
+        config,
+        "summarize")
+    return {
+        "summary": summary,
+        "summarized_count": state.get("summarized_count", 0) + len(messages)}
+
+
+# speculative turns (see `speculation`)
+
+
+async def speculate(
+    graph: CompiledStateGraph,
+    config: RunnableConfig,
+    action: str
+) -> None:
+    # makes the model calls of the turn a button would start, on a copy of
+    # the last state, without updating the graph
+    state: Any = (await graph.aget_state(config)).values
+    if not state:
+        return
+    config = speculative_config(config, action)
+    state = {
+        **state,
+        "messages": [
+            *state["messages"],
+            HumanMessage(content=action, id=f"speculation-{action}")]}
+    try:
+        if router.INTENT_ROUTER != "off":
+            route, _ = await _turn_route(state, config)
+            if route == router.CHAT:
+                await _chat({**state, **_piece_as_is(state)}, config)
+                return
+        if GRAPH_TOPOLOGY == "parallel":
+            await asyncio.gather(
+                _update_piece(state, config),
+                _concurrent_chat(state, config))
+        else:
+            await _chat(
+                {**state, **await _update_piece(state, config)}, config)
+    finally:
+        retrieval.indexes.discard(config["configurable"]["thread_id"])
+
+
+def build_graph(
+    topology: str = GRAPH_TOPOLOGY,
+    intent_router: str = router.INTENT_ROUTER
+) -> StateGraph:
+    builder = StateGraph(GraphState)
+    builder.add_node("welcome", _welcome)
+    builder.add_node("user_action", _user_action)
+    builder.add_node("update_piece", _update_piece)
+    builder.add_node("summarize", _summarize)
+    builder.set_entry_point("welcome")
+    builder.add_edge("welcome", "user_action")
+    builder.add_edge("summarize", "user_action")
+    routed = intent_router != "off"
+    if routed:
+        builder.add_node("route", _route)
+        builder.add_edge("user_action", "route")
+
+    if topology == "sequential":
+        builder.add_node("chat", _chat)
+        if routed:
+            builder.add_conditional_edges(
+                "route", _next_sequential, ["update_piece", "chat"])
+        else:
+            builder.add_edge("user_action", "update_piece")
+        builder.add_edge("update_piece", "chat")
+        builder.add_edge("chat", "summarize")
+    elif topology == "parallel":
+        builder.add_node("chat", _concurrent_chat)
+        builder.add_node("apply_piece", _apply_piece)
+        if routed:
+            # a turn without a piece update has nothing to wait for
+            builder.add_node("chat_only", _chat)
+            builder.add_conditional_edges(
+                "route",
+                _next_parallel,
+                ["update_piece", "chat", "chat_only"])
+            builder.add_edge("chat_only", "summarize")
+        else:
+            builder.add_edge("user_action", "update_piece")
+            builder.add_edge("user_action", "chat")
+        builder.add_edge(["update_piece", "chat"], "apply_piece")
+        builder.add_edge("apply_piece", "summarize")
+    else:
+        raise ValueError(f"Unknown graph topology: {topology!r}")
+    if intent_router not in ("off", "heuristic", "model"):
+        raise ValueError(f"Unknown intent router: {intent_router!r}")
+    return builder
+
+
+graph_builder = build_graph()
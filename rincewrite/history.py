@@ -0,0 +1,131 @@
+"""Context-window policy for the conversation history sent to the model.
+
+The full history stays in the graph state, but prompts only receive its most
+recent part: at most `RINCEWRITE_HISTORY_MAX_MESSAGES` messages and
+`RINCEWRITE_HISTORY_MAX_TOKENS` estimated tokens (0 disables a limit). With
+`RINCEWRITE_HISTORY_SUMMARY=true`, older messages are folded into a rolling
+summary kept in the graph state, and the summary is sent instead.
+"""
+
+import functools
+import logging
+import os
+from typing import TYPE_CHECKING, Any, Sequence
+
+from langchain_core.messages import SystemMessage
+from langchain_core.messages.base import BaseMessage
+from langchain_core.runnables import Runnable
+
+if TYPE_CHECKING:
+    from langchain_core.prompts import ChatPromptTemplate
+
+logger = logging.getLogger(__name__)
+
+HISTORY_MAX_MESSAGES = int(os.getenv("RINCEWRITE_HISTORY_MAX_MESSAGES", "0"))
+HISTORY_MAX_TOKENS = int(os.getenv("RINCEWRITE_HISTORY_MAX_TOKENS", "0"))
+HISTORY_SUMMARY = os.getenv("RINCEWRITE_HISTORY_SUMMARY") == "true"
+# the summary is updated once this many messages fell out of the window
+HISTORY_SUMMARY_BATCH = int(os.getenv("RINCEWRITE_HISTORY_SUMMARY_BATCH", "4"))
+
+# a rough but offline and deterministic estimate, close enough for budgeting
+_CHARS_PER_TOKEN = 4
+_TOKENS_PER_MESSAGE = 4
+
+
+@functools.cache
+def summary_prompt() -> "ChatPromptTemplate":
+    # langchain_core.prompts is only imported once a summary is needed, as
+    # it weighs on the import of the app
+    from langchain_core.prompts import (
+        ChatPromptTemplate, MessagesPlaceholder)
+
+    return ChatPromptTemplate.from_messages([
+        ("system",
+         "You keep a running summary of a conversation between a writer and "
+         "their writing assistant. Keep every decision, request and "
+         "preference that may matter later, and drop small talk.\n\n"
+         "Current summary:\n{summary}"),
+        MessagesPlaceholder("messages"),
+        ("human",
+         "Update the current summary with the messages above. Answer with "
+         "the updated summary only."),
+    ])
+
+
+def estimate_tokens(value: Any) -> int:
+    if isinstance(value, BaseMessage):
+        return _TOKENS_PER_MESSAGE + estimate_tokens(value.content)
+    if isinstance(value, str):
+        return len(value) // _CHARS_PER_TOKEN
+    if isinstance(value, dict):
+        return sum(estimate_tokens(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_tokens(v) for v in value)
+    return 0
+
+
+def window_start(messages: Sequence[BaseMessage]) -> int:
+    # index of the oldest message that fits in the window; the last message
+    # is always kept
+    start = len(messages) - 1 if messages else 0
+    budget = HISTORY_MAX_TOKENS - estimate_tokens(messages[start:])
+    while start > 0:
+        if HISTORY_MAX_MESSAGES and len(messages) - start >= \
+                HISTORY_MAX_MESSAGES:
+            break
+        if HISTORY_MAX_TOKENS:
+            budget -= estimate_tokens(messages[start - 1])
+            if budget < 0:
+                break
+        start -= 1
+    return start
+
+
+def prompt_history(state: dict[str, Any]) -> list[BaseMessage]:
+    messages = state["messages"]
+    if not HISTORY_SUMMARY:
+        return messages[window_start(messages):]
+    # messages that are not summarized yet are all kept, the summary node
+    # keeps them close to the window
+    history = messages[state.get("summarized_count", 0):]
+    if state.get("summary"):
+        history = [SystemMessage(
+            content=f"Summary of the earlier conversation:\n"
+                    f"{state['summary']}")] + history
+    return history
+
+
+def to_summarize(state: dict[str, Any]) -> list[BaseMessage]:
+    if not HISTORY_SUMMARY:
+        return []
+    messages = state["messages"]
+    summarized_count = state.get("summarized_count", 0)
+    start = window_start(messages)
+    if start - summarized_count < HISTORY_SUMMARY_BATCH:
+        return []
+    return messages[summarized_count:start]
+
+
+def summary_chain(model: Runnable) -> Runnable:
+    from langchain_core.output_parsers import StrOutputParser
+
+    return summary_prompt() | model | StrOutputParser()
+
+
+def report_prompt(node: str, inputs: dict[str, Any]) -> None:
+    logger.info(
+        "%s prompt: ~%d tokens, %d history messages",
+        node,
+        estimate_tokens(inputs),
+        len(inputs.get("messages", [])))
+
+
+def report_usage(node: str, message: BaseMessage) -> None:
+    # token counts reported by the provider, when it reports them
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        logger.info(
+            "%s usage: %d prompt tokens, %d completion tokens",
+            node,
+            usage["input_tokens"],
+            usage["output_tokens"])
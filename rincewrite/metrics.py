@@ -0,0 +1,331 @@
+"""Local, offline instrumentation of the chat turns.
+
+Each turn (the welcome message or the answer to a user message) records the
+time spent in each graph node, the time to the first streamed token, the
+prompt and completion tokens reported by the model, the checkpoint reads
+and writes (time and bytes sent to the database), and the time spent
+handing state updates to Reflex. Worker startup (opening the checkpointer,
+compiling the graph) is recorded once.
+
+The last `RINCEWRITE_METRICS_WINDOW` turns are aggregated in memory and,
+with `RINCEWRITE_METRICS_ENDPOINT=true`, served as JSON by the `/metrics`
+endpoint of the backend. The endpoint has no authentication, so it is off
+by default and only meant for a backend port that is not public. With
+`RINCEWRITE_METRICS_LOG=<path>`, every turn is also appended as a JSON line
+to a rolling log file.
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import statistics
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Iterable, Sequence
+
+from langchain_core.messages.base import BaseMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver, ChannelVersions, Checkpoint, CheckpointMetadata,
+    CheckpointTuple)
+
+METRICS_WINDOW = int(os.getenv("RINCEWRITE_METRICS_WINDOW", "500"))
+METRICS_ENDPOINT = os.getenv("RINCEWRITE_METRICS_ENDPOINT") == "true"
+METRICS_LOG = os.getenv("RINCEWRITE_METRICS_LOG")
+METRICS_LOG_MAX_BYTES = int(
+    os.getenv("RINCEWRITE_METRICS_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+METRICS_LOG_BACKUPS = 3
+
+_RECENT_TURNS = 20
+
+_turn_log = logging.getLogger(f"{__name__}.turns")
+
+
+class TurnMetrics:
+    """Measures of one turn, filled as the turn goes."""
+
+    def __init__(self, kind: str, thread_id: str) -> None:
+        self.kind = kind
+        self.thread_id = thread_id
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.total_ms: float | None = None
+        self.ttft_ms: float | None = None
+        self.node_ms: dict[str, float] = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.checkpoint_reads = 0
+        self.checkpoint_writes = 0
+        self.checkpoint_read_ms = 0.0
+        self.checkpoint_write_ms = 0.0
+        self.checkpoint_bytes = 0
+        self.yields = 0
+        self.yield_ms = 0.0
+        # time spent waiting for the model call scheduler
+        self.llm_wait_ms = 0.0
+        self.error: str | None = None
+        self._node_started: dict[str, float] = {}
+        # not part of the metrics, which hold no user data
+        self._checkpoint_id: str | None = None
+
+    @property
+    def checkpoint_id(self) -> str | None:
+        # the last checkpoint written by the turn
+        return self._checkpoint_id
+
+    def node_start(self, node: str) -> None:
+        self._node_started[node] = time.perf_counter()
+
+    def node_end(self, node: str) -> None:
+        if node in self._node_started:
+            elapsed = time.perf_counter() - self._node_started.pop(node)
+            # a node runs at most once per turn, but be safe
+            self.node_ms[node] = self.node_ms.get(node, 0) + elapsed * 1000
+
+    def add_usage(self, message: BaseMessage) -> None:
+        usage = getattr(message, "usage_metadata", None)
+        if usage:
+            self.prompt_tokens += usage["input_tokens"]
+            self.completion_tokens += usage["output_tokens"]
+
+    def as_dict(self, with_thread: bool = False) -> dict[str, Any]:
+        record = {
+            name: value for name, value in vars(self).items()
+            if not name.startswith("_")}
+        if not with_thread:
+            del record["thread_id"]
+        return record
+
+
+def stats(values: Sequence[float]) -> dict[str, float | int | None]:
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None,
+                "max": None}
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 2),
+        "p50": round(ordered[(len(ordered) - 1) // 2], 2),
+        "p95": round(ordered[int(0.95 * (len(ordered) - 1))], 2),
+        "max": round(ordered[-1], 2),
+    }
+
+
+def _values(turns: Iterable[TurnMetrics], name: str) -> list[float]:
+    return [
+        value for value in (getattr(turn, name) for turn in turns)
+        if value is not None]
+
+
+class MetricsRegistry:
+    """Rolling window of the last turns of this worker process."""
+
+    def __init__(self, window: int = METRICS_WINDOW) -> None:
+        self.startup: dict[str, float] = {}
+        self.turns: deque[TurnMetrics] = deque(maxlen=window)
+        self.turn_count = 0
+        self.checkpoint_read_ms: deque[float] = deque(maxlen=window)
+        self.checkpoint_write_ms: deque[float] = deque(maxlen=window)
+        self._sources: dict[str, Callable[[], dict[str, Any]]] = {}
+
+    def add_source(
+        self,
+        name: str,
+        source: Callable[[], dict[str, Any]]
+    ) -> None:
+        # other components add their own state to the snapshot
+        self._sources[name] = source
+
+    def record_startup(self, name: str, elapsed_ms: float) -> None:
+        self.startup[name] = round(elapsed_ms, 2)
+        if METRICS_LOG:
+            _turn_log.info(json.dumps({"startup": {name: elapsed_ms}}))
+
+    def record_turn(self, turn: TurnMetrics) -> None:
+        self.turns.append(turn)
+        self.turn_count += 1
+        if METRICS_LOG:
+            _turn_log.info(json.dumps(turn.as_dict(with_thread=True)))
+
+    def snapshot(self) -> dict[str, Any]:
+        turns = list(self.turns)
+        nodes = sorted({node for turn in turns for node in turn.node_ms})
+        return {
+            "startup_ms": self.startup,
+            "turns": {
+                "count": self.turn_count,
+                "window": len(turns),
+                "errors": sum(turn.error is not None for turn in turns),
+                "total_ms": stats(_values(turns, "total_ms")),
+                "ttft_ms": stats(_values(turns, "ttft_ms")),
+                "yields": stats(_values(turns, "yields")),
+                "yield_ms": stats(_values(turns, "yield_ms")),
+                "llm_wait_ms": stats(_values(turns, "llm_wait_ms")),
+            },
+            "node_ms": {
+                node: stats([
+                    turn.node_ms[node] for turn in turns
+                    if node in turn.node_ms])
+                for node in nodes},
+            "tokens": {
+                "prompt": stats(_values(turns, "prompt_tokens")),
+                "completion": stats(_values(turns, "completion_tokens")),
+            },
+            "checkpoint": {
+                "read_ms": stats(self.checkpoint_read_ms),
+                "write_ms": stats(self.checkpoint_write_ms),
+                "bytes_per_turn": stats(_values(turns, "checkpoint_bytes")),
+            },
+            **{name: source() for name, source in self._sources.items()},
+            "recent_turns": [
+                turn.as_dict() for turn in turns[-_RECENT_TURNS:]],
+        }
+
+
+registry = MetricsRegistry()
+
+# the turn being run by the current task; the graph runs in tasks created
+# from it, which inherit it
+_current_turn: contextvars.ContextVar[TurnMetrics | None] = \
+    contextvars.ContextVar("rincewrite_turn", default=None)
+
+
+def start_turn(kind: str, thread_id: str) -> TurnMetrics:
+    turn = TurnMetrics(kind, thread_id)
+    _current_turn.set(turn)
+    return turn
+
+
+def end_turn(turn: TurnMetrics) -> None:
+    turn.total_ms = (time.perf_counter() - turn._started) * 1000
+    if _current_turn.get() is turn:
+        _current_turn.set(None)
+    registry.record_turn(turn)
+
+
+def current_turn() -> TurnMetrics | None:
+    return _current_turn.get()
+
+
+def add_checkpoint_bytes(size: int) -> None:
+    turn = _current_turn.get()
+    if turn is not None:
+        turn.checkpoint_bytes += size
+
+
+async def meter_yields(
+    updates: AsyncIterator[None],
+    turn: TurnMetrics
+) -> AsyncIterator[None]:
+    # the time a yield is suspended is the time Reflex takes to send the
+    # state update
+    async for _ in updates:
+        started = time.perf_counter()
+        yield
+        turn.yields += 1
+        turn.yield_ms += (time.perf_counter() - started) * 1000
+
+
+class MeteredSaver(BaseCheckpointSaver):
+    """Checkpointer timing the reads and writes of another one."""
+
+    def __init__(self, saver: BaseCheckpointSaver) -> None:
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+
+    def _read(self, started: float) -> None:
+        elapsed = (time.perf_counter() - started) * 1000
+        registry.checkpoint_read_ms.append(elapsed)
+        turn = _current_turn.get()
+        if turn is not None:
+            turn.checkpoint_reads += 1
+            turn.checkpoint_read_ms += elapsed
+
+    def _write(self, started: float) -> None:
+        elapsed = (time.perf_counter() - started) * 1000
+        registry.checkpoint_write_ms.append(elapsed)
+        turn = _current_turn.get()
+        if turn is not None:
+            turn.checkpoint_writes += 1
+            turn.checkpoint_write_ms += elapsed
+
+    async def aget_tuple(
+        self,
+        config: RunnableConfig
+    ) -> CheckpointTuple | None:
+        started = time.perf_counter()
+        try:
+            return await self.saver.aget_tuple(config)
+        finally:
+            self._read(started)
+
+    async def alist(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        started = time.perf_counter()
+        try:
+            async for checkpoint_tuple in self.saver.alist(
+                    config, filter=filter, before=before, limit=limit):
+                yield checkpoint_tuple
+        finally:
+            self._read(started)
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        started = time.perf_counter()
+        try:
+            new_config = await self.saver.aput(
+                config, checkpoint, metadata, new_versions)
+        finally:
+            self._write(started)
+        turn = _current_turn.get()
+        if turn is not None:
+            turn._checkpoint_id = new_config["configurable"].get(
+                "checkpoint_id")
+        return new_config
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        *args: Any,
+        **kwargs: Any
+    ) -> None:
+        started = time.perf_counter()
+        try:
+            await self.saver.aput_writes(
+                config, writes, task_id, *args, **kwargs)
+        finally:
+            self._write(started)
+
+    def get_next_version(self, current: Any, channel: Any) -> Any:
+        return self.saver.get_next_version(current, channel)
+
+
+def snapshot() -> dict[str, Any]:
+    return registry.snapshot()
+
+
+if METRICS_LOG:
+    _handler = logging.handlers.RotatingFileHandler(
+        METRICS_LOG,
+        maxBytes=METRICS_LOG_MAX_BYTES,
+        backupCount=METRICS_LOG_BACKUPS,
+        encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _turn_log.addHandler(_handler)
+    _turn_log.setLevel(logging.INFO)
+    _turn_log.propagate = False
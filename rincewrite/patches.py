@@ -0,0 +1,129 @@
+"""Targeted edit operations on the piece text.
+
+Instead of regenerating the whole piece, the model can return a list of
+replace / insert / delete operations anchored on an exact passage of the
+current text or on a markdown heading (which stands for its whole section).
+The operations are applied locally; any anchor that cannot be resolved
+unambiguously raises a `PatchError`, so that the caller can fall back to a
+full rewrite.
+"""
+
+import difflib
+import re
+from typing import Literal
+
+from langchain_core.pydantic_v1 import BaseModel, Field
+
+PATCH_INSTRUCTIONS = """Do not rewrite the whole text. Describe your changes \
+as a list of edit operations, applied in order:
+- 'replace' replaces the anchor with the given text,
+- 'insert_before' and 'insert_after' insert the given text next to the anchor,
+- 'delete' removes the anchor.
+An anchor is either a passage copied exactly from the current text, long \
+enough to appear only once, or a full markdown heading line (such as \
+'## Chapter 2'), which stands for the whole section under that heading. An \
+empty anchor stands for the start ('insert_before') or the end \
+('insert_after') of the text. Return no operation if the text must not \
+change."""
+
+_HEADING = re.compile(r"^(#{1,6})\s+\S.*$", re.MULTILINE)
+
+
+class PatchError(ValueError):
+    pass
+
+
+class EditOperation(BaseModel):
+    op: Literal["replace", "insert_before", "insert_after", "delete"] = Field(
+        ...,
+        title="Kind of edit")
+    anchor: str = Field(
+        ...,
+        title="Exact passage or heading line of the current text to edit")
+    text: str = Field(
+        "",
+        title="New text to write (empty for 'delete')")
+
+
+class PiecePatch(BaseModel):
+    new_title: str = Field(
+        ...,
+        title="New title for the piece")
+    new_desc: str = Field(
+        ...,
+        title="New description for the piece")
+    edits: list[EditOperation] = Field(
+        ...,
+        title="Edit operations to apply to the text of the piece")
+
+
+def _section_span(text: str, heading: str) -> tuple[int, int] | None:
+    matches = [
+        m for m in _HEADING.finditer(text)
+        if m.group(0).strip() == heading.strip()]
+    if not matches:
+        return None
+    if len(matches) > 1:
+        raise PatchError(f"Heading is not unique: {heading!r}")
+    start = matches[0].start()
+    level = len(matches[0].group(1))
+    # a section ends at the next heading of the same or a higher level
+    for m in _HEADING.finditer(text, matches[0].end()):
+        if len(m.group(1)) <= level:
+            return start, m.start()
+    return start, len(text)
+
+
+def _passage_span(text: str, passage: str) -> tuple[int, int]:
+    count = text.count(passage)
+    if count == 1:
+        start = text.index(passage)
+        return start, start + len(passage)
+    if count > 1:
+        raise PatchError(f"Anchor is not unique: {passage!r}")
+    # models tend to reflow whitespace when quoting
+    pattern = r"\s+".join(re.escape(word) for word in passage.split())
+    matches = list(re.finditer(pattern, text)) if pattern else []
+    if len(matches) != 1:
+        raise PatchError(f"Anchor not found: {passage!r}")
+    return matches[0].span()
+
+
+def _apply(text: str, edit: EditOperation) -> str:
+    if not edit.anchor.strip():
+        if edit.op == "insert_before":
+            return edit.text + text
+        if edit.op == "insert_after":
+            return text + edit.text
+        raise PatchError(f"'{edit.op}' needs an anchor")
+
+    span = None
+    if edit.anchor.lstrip().startswith("#"):
+        span = _section_span(text, edit.anchor)
+    if span is None:
+        span = _passage_span(text, edit.anchor)
+    start, end = span
+
+    if edit.op == "replace":
+        return text[:start] + edit.text + text[end:]
+    if edit.op == "insert_before":
+        return text[:start] + edit.text + text[start:]
+    if edit.op == "insert_after":
+        return text[:end] + edit.text + text[end:]
+    return text[:start] + text[end:]
+
+
+def apply_patch(text: str, edits: list[EditOperation]) -> str:
+    for edit in edits:
+        text = _apply(text, edit)
+    return text
+
+
+def text_diff(old_text: str, new_text: str) -> str:
+    return "\n".join(difflib.unified_diff(
+        old_text.splitlines(),
+        new_text.splitlines(),
+        "before",
+        "after",
+        n=1,
+        lineterm=""))
@@ -0,0 +1,259 @@
+"""Persistence backends for the LangGraph checkpoints.
+
+The backend is chosen by a database URL, read from the
+`RINCEWRITE_DATABASE_URL` environment variable or from a
+`rincewrite_database_url` field of `rxconfig.py` (default
+`sqlite:///rincewrite.db`):
+
+- `sqlite:///<path>` keeps the compact checkpoints in a SQLite file, in WAL
+  mode, with one writer connection and a bounded pool of reader connections,
+  so that several Reflex workers can share the file,
+- `postgresql://...` keeps them in Postgres, through a connection pool. It
+  needs the optional `langgraph-checkpoint-postgres` and `psycopg[pool]`
+  packages.
+
+Other backends can be added with `register_backend`. The pool size is read
+from `RINCEWRITE_DB_POOL_SIZE` or `rincewrite_db_pool_size` (default 4).
+"""
+
+import abc
+import asyncio
+import contextlib
+import os
+from typing import Any, AsyncIterator, Sequence
+from urllib.parse import urlparse
+
+import aiosqlite
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver, ChannelVersions, Checkpoint, CheckpointMetadata,
+    CheckpointTuple)
+
+from .storage import CompactSqliteSaver
+
+DEFAULT_DATABASE_URL = "sqlite:///rincewrite.db"
+DEFAULT_POOL_SIZE = 4
+
+# milliseconds a connection waits for the write lock held by another one
+# (possibly in another worker) before failing
+SQLITE_BUSY_TIMEOUT_MS = int(
+    os.getenv("RINCEWRITE_SQLITE_BUSY_TIMEOUT_MS", "10000"))
+
+# synchronous=NORMAL is safe in WAL mode: a power loss may lose the last
+# transactions, but never corrupts the database
+_SQLITE_PRAGMAS = f"""
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS};
+PRAGMA cache_size=-16000;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+"""
+
+
+def _setting(env_var: str, config_field: str) -> str | None:
+    value = os.getenv(env_var)
+    if value:
+        return value
+    try:
+        from reflex.config import get_config
+        value = getattr(get_config(), config_field, None)
+    except Exception:
+        # no rxconfig.py, e.g. in scripts and benchmarks
+        return None
+    return str(value) if value else None
+
+
+def database_url() -> str:
+    return _setting(
+        "RINCEWRITE_DATABASE_URL",
+        "rincewrite_database_url") or DEFAULT_DATABASE_URL
+
+
+def database_pool_size() -> int:
+    return int(_setting(
+        "RINCEWRITE_DB_POOL_SIZE",
+        "rincewrite_db_pool_size") or DEFAULT_POOL_SIZE)
+
+
+class PersistenceBackend(abc.ABC):
+    """Opens the checkpointer shared by the event handlers of a worker."""
+
+    def __init__(self, url: str, pool_size: int = DEFAULT_POOL_SIZE) -> None:
+        self.url = url
+        self.pool_size = pool_size
+
+    @abc.abstractmethod
+    def checkpointer(
+        self
+    ) -> contextlib.AbstractAsyncContextManager[BaseCheckpointSaver]:
+        """Opens a checkpointer, set up and ready to use, until exit."""
+
+
+class PooledSqliteSaver(BaseCheckpointSaver):
+    """Compact SQLite checkpointer over a pool of connections.
+
+    SQLite has a single writer at a time, so writes go through one
+    connection, while reads are spread over a bounded pool of read-only
+    connections, that WAL mode lets run alongside the writer.
+    """
+
+    def __init__(
+        self,
+        writer: CompactSqliteSaver,
+        readers: Sequence[CompactSqliteSaver]
+    ) -> None:
+        super().__init__(serde=writer.serde)
+        self.writer = writer
+        self._readers: asyncio.Queue[CompactSqliteSaver] = asyncio.Queue()
+        for reader in readers:
+            # messages read from any connection are known to the writer
+            reader._item_blobs = writer._item_blobs
+            self._readers.put_nowait(reader)
+
+    @contextlib.asynccontextmanager
+    async def _reader(self) -> AsyncIterator[CompactSqliteSaver]:
+        reader = await self._readers.get()
+        try:
+            yield reader
+        finally:
+            self._readers.put_nowait(reader)
+
+    async def aget_tuple(
+        self,
+        config: RunnableConfig
+    ) -> CheckpointTuple | None:
+        async with self._reader() as reader:
+            return await reader.aget_tuple(config)
+
+    async def alist(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        # the page is read before it is yielded, so that a caller that stops
+        # early does not keep the reader from the pool
+        async with self._reader() as reader:
+            tuples = [
+                checkpoint_tuple
+                async for checkpoint_tuple in reader.alist(
+                    config, filter=filter, before=before, limit=limit)]
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await self.writer.aput(
+            config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        *args: Any,
+        **kwargs: Any
+    ) -> None:
+        await self.writer.aput_writes(
+            config, writes, task_id, *args, **kwargs)
+
+    def get_next_version(self, current: str | None, channel: None) -> str:
+        return self.writer.get_next_version(current, channel)
+
+
+async def connect_sqlite(
+    exit_stack: contextlib.AsyncExitStack,
+    path: str,
+    read_only: bool
+) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(path)
+    exit_stack.push_async_callback(conn.close)
+    await conn.executescript(_SQLITE_PRAGMAS)
+    if read_only:
+        await conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+class SqliteBackend(PersistenceBackend):
+
+    @property
+    def path(self) -> str:
+        # sqlite:///relative.db and sqlite:////absolute.db, as in SQLAlchemy
+        return self.url.split("://", 1)[1][1:]
+
+    @contextlib.asynccontextmanager
+    async def checkpointer(self) -> AsyncIterator[BaseCheckpointSaver]:
+        async with contextlib.AsyncExitStack() as exit_stack:
+            writer = CompactSqliteSaver(await connect_sqlite(
+                exit_stack, self.path, read_only=False))
+            # the tables must exist before read-only connections use them
+            await writer.setup()
+            readers = []
+            for _ in range(max(self.pool_size, 1)):
+                reader = CompactSqliteSaver(await connect_sqlite(
+                    exit_stack, self.path, read_only=True))
+                reader.is_setup = reader._blobs_ready = True
+                readers.append(reader)
+            yield PooledSqliteSaver(writer, readers)
+
+
+class PostgresBackend(PersistenceBackend):
+
+    @contextlib.asynccontextmanager
+    async def checkpointer(self) -> AsyncIterator[BaseCheckpointSaver]:
+        try:
+            from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+            from psycopg.rows import dict_row
+            from psycopg_pool import AsyncConnectionPool
+        except ImportError as e:
+            raise RuntimeError(
+                "The Postgres backend needs the optional dependencies: "
+                "pip install langgraph-checkpoint-postgres "
+                "'psycopg[binary,pool]'") from e
+        async with AsyncConnectionPool(
+            self.url,
+            max_size=self.pool_size,
+            kwargs={
+                "autocommit": True,
+                "prepare_threshold": 0,
+                "row_factory": dict_row,
+            },
+            open=False,
+        ) as pool:
+            saver = AsyncPostgresSaver(pool)
+            await saver.setup()
+            yield saver
+
+
+_backends: dict[str, type[PersistenceBackend]] = {
+    "sqlite": SqliteBackend,
+    "postgres": PostgresBackend,
+    "postgresql": PostgresBackend,
+}
+
+
+def register_backend(scheme: str, backend: type[PersistenceBackend]) -> None:
+    _backends[scheme] = backend
+
+
+def get_backend(
+    url: str | None = None,
+    pool_size: int | None = None
+) -> PersistenceBackend:
+    url = url or database_url()
+    scheme = urlparse(url).scheme.split("+", 1)[0]
+    if scheme not in _backends:
+        raise ValueError(
+            f"Unsupported database URL {url!r}, expected one of the schemes: "
+            f"{', '.join(sorted(_backends))}")
+    if pool_size is None:
+        pool_size = database_pool_size()
+    return _backends[scheme](url, pool_size)
@@ -0,0 +1,114 @@
+"""Prompt registry backed by a versioned on-disk cache.
+
+Prompts are pinned to LangSmith hub commits and loaded from memory, then
+from the local cache, then from the hub. A pinned commit never changes, so a
+cached prompt is always valid for its commit hash. They are all loaded with
+the runtime, in a thread, so that the graph nodes never wait for the hub on
+the event loop.
+"""
+
+import json
+import logging
+import os
+import threading
+import warnings
+from pathlib import Path
+
+from langchain_core._api import LangChainBetaWarning
+from langchain_core.load import dumpd, load
+from langchain_core.prompts import BasePromptTemplate
+
+logger = logging.getLogger(__name__)
+
+PROMPTS = {
+    "welcome": "bse-guirriecp/rincewrite-welcome:f1e53c7a",
+    "update_piece": "bse-guirriecp/rincewrite-update_piece:c6ea9f37",
+    "chat": "bse-guirriecp/rincewrite-chat:32bcac42",
+}
+
+PROMPT_CACHE_DIR = Path(os.getenv("RINCEWRITE_PROMPT_CACHE", ".prompts"))
+# never reach the hub, only use the on-disk cache
+PROMPTS_OFFLINE = os.getenv("RINCEWRITE_PROMPTS_OFFLINE") == "true"
+
+_prompts: dict[str, BasePromptTemplate] = {}
+_lock = threading.Lock()
+
+
+def _cache_path(ref: str) -> Path:
+    owner_repo, commit = ref.rsplit(":", 1)
+    return PROMPT_CACHE_DIR / f"{owner_repo.replace('/', '__')}@{commit}.json"
+
+
+def _read_cache(ref: str) -> BasePromptTemplate | None:
+    path = _cache_path(ref)
+    if not path.exists():
+        return None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", LangChainBetaWarning)
+            return load(json.loads(path.read_text(encoding="utf-8")))
+    except (ValueError, TypeError, KeyError) as e:
+        logger.warning("Ignoring corrupt prompt cache %s: %s", path, e)
+        return None
+
+
+def _write_cache(ref: str, prompt: BasePromptTemplate) -> None:
+    path = _cache_path(ref)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write then rename, so that a concurrent reader never sees half a file
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(dumpd(prompt)), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def _pull(ref: str) -> BasePromptTemplate:
+    from langchain import hub
+    prompt = hub.pull(ref)
+    _write_cache(ref, prompt)
+    return prompt
+
+
+def get_prompt(name: str) -> BasePromptTemplate:
+    ref = PROMPTS[name]
+    with _lock:
+        if name not in _prompts:
+            prompt = _read_cache(ref)
+            if prompt is None:
+                if PROMPTS_OFFLINE:
+                    raise RuntimeError(
+                        f"Prompt '{ref}' is not in the local cache "
+                        f"({PROMPT_CACHE_DIR}) and prompts are offline. "
+                        "Run once with RINCEWRITE_PROMPTS_OFFLINE unset to "
+                        "fill the cache.")
+                prompt = _pull(ref)
+            _prompts[name] = prompt
+        return _prompts[name]
+
+
+def load_prompts() -> None:
+    # a prompt that cannot be loaded now is loaded again on first use
+    for name, ref in PROMPTS.items():
+        try:
+            get_prompt(name)
+        except Exception as e:
+            logger.warning("Could not load prompt '%s': %s", ref, e)
+
+
+def refresh_prompts() -> None:
+    for name, ref in PROMPTS.items():
+        try:
+            prompt = _pull(ref)
+        except Exception as e:
+            logger.warning("Could not refresh prompt '%s': %s", ref, e)
+            continue
+        with _lock:
+            _prompts[name] = prompt
+
+
+def refresh_in_background() -> threading.Thread | None:
+    if PROMPTS_OFFLINE:
+        return None
+    thread = threading.Thread(
+        target=refresh_prompts, name="rincewrite-prompts", daemon=True)
+    thread.start()
+    return thread
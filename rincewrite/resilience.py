@@ -0,0 +1,322 @@
+"""Deadlines, retries and hedging of the model calls.
+
+A model call that has not streamed its first token
+`RINCEWRITE_LLM_FIRST_TOKEN_TIMEOUT` seconds after it was sent (30 by
+default), or not completed after `RINCEWRITE_LLM_TIMEOUT` seconds (300 by
+default, `RINCEWRITE_LLM_TIMEOUT_<NODE>` for one node, 0 for no limit), is
+cancelled and retried, at most `RINCEWRITE_LLM_MAX_RETRIES` times, after a
+random backoff. Retries draw from a budget shared by the worker: each call
+adds `RINCEWRITE_LLM_RETRY_RATIO` to it, each retry takes one, so that a
+failing provider is not flooded with retries.
+
+With `RINCEWRITE_LLM_HEDGE=true`, a second request is sent, also from the
+budget, when the first has streamed nothing by the 95th percentile of the
+time to first token of its node; the first of the two to stream a token
+wins and the other is cancelled.
+
+Errors of the provider are retried by the OpenAI client itself, only the
+deadlines are handled here. An attempt only returns its result to the node,
+which writes it to the state once, whatever the attempts.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+from uuid import UUID
+
+from langchain_core.callbacks import (
+    AsyncCallbackHandler, adispatch_custom_event)
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import merge_configs
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_FIRST_TOKEN_TIMEOUT = float(
+    os.getenv("RINCEWRITE_LLM_FIRST_TOKEN_TIMEOUT", "30"))
+LLM_TIMEOUT = float(os.getenv("RINCEWRITE_LLM_TIMEOUT", "300"))
+LLM_MAX_RETRIES = int(os.getenv("RINCEWRITE_LLM_MAX_RETRIES", "2"))
+LLM_RETRY_RATIO = float(os.getenv("RINCEWRITE_LLM_RETRY_RATIO", "0.1"))
+LLM_HEDGE = os.getenv("RINCEWRITE_LLM_HEDGE") == "true"
+
+# retries that can be made in a row, before calls refill the budget
+RETRY_BUDGET_MAX = 10.0
+# backoff before the n-th retry, drawn between 0 and min(cap, base * 2^n)
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+# times to first token needed before hedging on their 95th percentile
+HEDGE_MIN_SAMPLES = 20
+
+# name of the event streamed when an attempt is given up for another one
+RETRY_EVENT = "rincewrite_llm_retry"
+
+LLM_TIMEOUTS = {
+    kind: float(os.getenv(
+        f"RINCEWRITE_LLM_TIMEOUT_{kind.upper()}", LLM_TIMEOUT))
+    for kind in ("welcome", "chat", "route", "update_piece", "summarize")
+}
+
+_TTFT_WINDOW = 500
+
+
+class LLMTimeout(TimeoutError):
+    """A model call missed one of its deadlines."""
+
+    def __init__(self, kind: str, deadline: str, seconds: float) -> None:
+        super().__init__(
+            f"{kind} call got no {deadline} within {seconds:g}s")
+        self.kind = kind
+        self.deadline = deadline
+
+
+class RetryBudget:
+    """Retries allowed, as a share of the calls made."""
+
+    def __init__(
+        self,
+        ratio: float = LLM_RETRY_RATIO,
+        max_balance: float = RETRY_BUDGET_MAX
+    ) -> None:
+        self.ratio = ratio
+        self.max_balance = max_balance
+        self.balance = max_balance
+
+    def deposit(self) -> None:
+        self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class _Watch(AsyncCallbackHandler):
+    """Follows the model run of one attempt."""
+
+    run_inline = True
+
+    def __init__(self, on_first_token: Callable[[], None]) -> None:
+        self.sent = asyncio.Event()
+        self.first_token = asyncio.Event()
+        self.sent_at = 0.0
+        self.ttft: float | None = None
+        self._on_first_token = on_first_token
+
+    async def on_chat_model_start(
+        self,
+        serialized: dict[str, Any],
+        messages: list[list[Any]],
+        *,
+        run_id: UUID,
+        **kwargs: Any,
+    ) -> None:
+        # the call left the scheduler queue
+        if not self.sent.is_set():
+            self.sent_at = time.monotonic()
+            self.sent.set()
+
+    async def on_llm_new_token(
+        self,
+        token: str,
+        *,
+        run_id: UUID,
+        **kwargs: Any
+    ) -> None:
+        # any chunk counts, tool call arguments have no text
+        if not self.first_token.is_set():
+            self.ttft = time.monotonic() - self.sent_at
+            self.first_token.set()
+            self._on_first_token()
+
+
+async def _until(
+    task: asyncio.Future[Any],
+    event: asyncio.Event,
+    timeout: float | None
+) -> bool:
+    # whether the task is done or the event set before the timeout
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait(
+            {task, waiter},
+            timeout=timeout or None,
+            return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+    return task.done() or event.is_set()
+
+
+class _Attempt:
+    """One request of a call, within its deadlines."""
+
+    def __init__(
+        self,
+        call: Callable[[RunnableConfig], Awaitable[Any]],
+        config: RunnableConfig,
+        kind: str
+    ) -> None:
+        self.kind = kind
+        # the attempt raced against, cancelled once this one streams
+        self.rival: _Attempt | None = None
+        self.watch = _Watch(self._won)
+        self._call = asyncio.ensure_future(
+            call(merge_configs(config, {"callbacks": [self.watch]})))
+        self.task = asyncio.ensure_future(self._run())
+
+    def _won(self) -> None:
+        rival = self.rival
+        if rival is not None and not rival.watch.first_token.is_set():
+            rival.cancel()
+
+    def cancel(self) -> None:
+        self._call.cancel()
+        self.task.cancel()
+
+    async def _run(self) -> Any:
+        call = self._call
+        try:
+            # no deadline while waiting for the scheduler
+            await _until(call, self.watch.sent, None)
+            if not await _until(
+                    call, self.watch.first_token, LLM_FIRST_TOKEN_TIMEOUT):
+                raise LLMTimeout(
+                    self.kind, "first token", LLM_FIRST_TOKEN_TIMEOUT)
+            limit = LLM_TIMEOUTS.get(self.kind, LLM_TIMEOUT)
+            if limit and not call.done():
+                remaining = limit - (time.monotonic() - self.watch.sent_at)
+                done, _ = await asyncio.wait({call}, timeout=max(remaining, 0))
+                if not done:
+                    raise LLMTimeout(self.kind, "completion", limit)
+            return await call
+        finally:
+            if not call.done():
+                call.cancel()
+
+
+class Resilience:
+    """Deadlines, retries and hedges of the calls of a worker."""
+
+    def __init__(
+        self,
+        max_retries: int = LLM_MAX_RETRIES,
+        hedge: bool = LLM_HEDGE,
+        budget: RetryBudget | None = None
+    ) -> None:
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.budget = budget or RetryBudget()
+        self._ttfts: dict[str, deque[float]] = {}
+        self.timeouts: dict[str, int] = {}
+        self.retries = 0
+        self.retries_denied = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self, kind: str) -> float | None:
+        ttfts = self._ttfts.get(kind)
+        if not self.hedge or not ttfts or len(ttfts) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(ttfts)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def _record(self, attempt: _Attempt) -> None:
+        if attempt.watch.ttft is not None:
+            self._ttfts.setdefault(
+                attempt.kind, deque(maxlen=_TTFT_WINDOW)).append(
+                    attempt.watch.ttft)
+
+    async def _hedged(
+        self,
+        call: Callable[[RunnableConfig], Awaitable[Any]],
+        config: RunnableConfig,
+        kind: str
+    ) -> Any:
+        primary = _Attempt(call, config, kind)
+        attempts = [primary]
+        try:
+            delay = self.hedge_delay(kind)
+            if (delay is not None
+                    and await _until(primary.task, primary.watch.sent, None)
+                    and not await _until(
+                        primary.task, primary.watch.first_token, delay)
+                    and self.budget.withdraw()):
+                self.hedges += 1
+                logger.info(
+                    "%s call streamed nothing in %.1fs, hedging", kind, delay)
+                hedge = _Attempt(call, config, kind)
+                primary.rival, hedge.rival = hedge, primary
+                attempts.append(hedge)
+            results = await asyncio.gather(
+                *(attempt.task for attempt in attempts),
+                return_exceptions=True)
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+                self._record(attempt)
+
+        for attempt, result in zip(attempts, results):
+            if not isinstance(result, BaseException):
+                if attempt is not primary:
+                    self.hedge_wins += 1
+                return result
+        # the primary's failure, unless it was cancelled by the hedge
+        errors = [result for result in results
+                  if not isinstance(result, asyncio.CancelledError)]
+        raise errors[0] if errors else results[0]
+
+    async def ainvoke(
+        self,
+        call: Callable[[RunnableConfig], Awaitable[Any]],
+        config: RunnableConfig,
+        kind: str
+    ) -> Any:
+        # `call` sends the request with the config of the node, extended to
+        # follow the attempt, and returns its result
+        self.budget.deposit()
+        retry = 0
+        while True:
+            try:
+                return await self._hedged(call, config, kind)
+            except LLMTimeout as e:
+                key = f"{e.kind} {e.deadline}"
+                self.timeouts[key] = self.timeouts.get(key, 0) + 1
+                if retry >= self.max_retries:
+                    raise
+                if not self.budget.withdraw():
+                    self.retries_denied += 1
+                    raise
+                retry += 1
+                self.retries += 1
+                backoff = random.uniform(
+                    0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** retry))
+                logger.warning(
+                    "%s, retrying in %.1fs (%d/%d)", e, backoff, retry,
+                    self.max_retries)
+                # what was streamed of the attempt given up is discarded
+                await adispatch_custom_event(
+                    RETRY_EVENT, {"kind": kind, "retry": retry},
+                    config=config)
+                await asyncio.sleep(backoff)
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "retries_denied": self.retries_denied,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "retry_budget": round(self.budget.balance, 2),
+            "ttft_ms": {
+                kind: metrics.stats([ttft * 1000 for ttft in ttfts])
+                for kind, ttfts in self._ttfts.items()},
+        }
+
+
+resilience = Resilience()
+metrics.registry.add_source("llm_resilience", resilience.status)
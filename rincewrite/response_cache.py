@@ -0,0 +1,164 @@
+"""Cache of the model responses that only depend on fixed inputs.
+
+The welcome message only depends on the user and piece descriptions, so it
+is cached under a hash of the prompt version, the model and the normalised
+inputs. The cache has an in-memory LRU tier and, with the SQLite backend, a
+persistent tier in the checkpoint database, shared by the workers. Entries
+expire after `RINCEWRITE_WELCOME_CACHE_TTL` seconds (a week by default);
+`RINCEWRITE_WELCOME_CACHE=false` disables the cache.
+
+A cached response is replayed by `ReplayChatModel`, which streams it like
+a model would, so that it is displayed through the usual streaming path.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, AsyncIterator
+
+import aiosqlite
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun)
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import (
+    ChatGeneration, ChatGenerationChunk, ChatResult)
+
+WELCOME_CACHE = os.getenv("RINCEWRITE_WELCOME_CACHE") != "false"
+WELCOME_CACHE_TTL = float(
+    os.getenv("RINCEWRITE_WELCOME_CACHE_TTL", str(7 * 24 * 3600)))
+WELCOME_CACHE_SIZE = int(os.getenv("RINCEWRITE_WELCOME_CACHE_SIZE", "256"))
+
+_WHITESPACE = re.compile(r"\s+")
+# a replayed response is streamed word by word, with its whitespace
+_REPLAY_TOKEN = re.compile(r"\S+\s*|\s+")
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        value = unicodedata.normalize("NFC", value)
+        return _WHITESPACE.sub(" ", value).strip()
+    return value
+
+
+def cache_key(version: str, inputs: dict[str, Any]) -> str:
+    payload = json.dumps(
+        {
+            "version": version,
+            "inputs": {name: _normalize(v) for name, v in inputs.items()},
+        },
+        sort_keys=True,
+        ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU cache with a TTL, backed by an optional SQLite table."""
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._conn: aiosqlite.Connection | None = None
+        # one transaction at a time on the connection
+        self.lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    async def attach(self, conn: aiosqlite.Connection) -> None:
+        async with conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS rw_response_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            """
+        ):
+            await conn.commit()
+        self._conn = conn
+
+    def detach(self) -> None:
+        self._conn = None
+
+    def _remember(self, key: str, created_at: float, value: str) -> None:
+        self._entries[key] = (created_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def aget(self, key: str) -> str | None:
+        expired_before = time.time() - self.ttl
+        entry = self._entries.get(key)
+        if entry is None and self._conn is not None:
+            async with self._conn.execute(
+                "SELECT created_at, value FROM rw_response_cache "
+                "WHERE key = ?",
+                (key,),
+            ) as cur:
+                row = await cur.fetchone()
+            if row is not None:
+                entry = (row[0], row[1])
+                self._remember(key, *entry)
+        if entry is None or entry[0] < expired_before:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def aset(self, key: str, value: str) -> None:
+        created_at = time.time()
+        self._remember(key, created_at, value)
+        if self._conn is not None:
+            async with self.lock:
+                await self._conn.execute(
+                    "INSERT OR REPLACE INTO rw_response_cache "
+                    "(key, value, created_at) VALUES (?, ?, ?)",
+                    (key, value, created_at))
+                await self._conn.execute(
+                    "DELETE FROM rw_response_cache WHERE created_at < ?",
+                    (created_at - self.ttl,))
+                await self._conn.commit()
+
+
+welcome_cache = ResponseCache(WELCOME_CACHE_SIZE, WELCOME_CACHE_TTL)
+
+
+class ReplayChatModel(BaseChatModel):
+    """Chat model streaming a response known in advance."""
+
+    response: str
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return ChatResult(generations=[
+            ChatGeneration(message=AIMessage(content=self.response))])
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for token in _REPLAY_TOKEN.findall(self.response):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
@@ -0,0 +1,239 @@
+"""Local retrieval over the piece sections and the past conversation.
+
+Each conversation has BM25 indexes over the sections of its piece and over
+its messages, kept in memory by the worker for the last
+`RINCEWRITE_RETRIEVAL_MAX_THREADS` conversations (64 by default). They are
+synced with the graph state after each piece update and before each search:
+only the sections whose hash changed and the new messages are indexed, so an
+index lost with a worker restart is simply rebuilt on first use.
+
+Searches rank the sections sent to the prompts when a long piece is sent in
+part (see `document`), and bring back the `RINCEWRITE_RETRIEVAL_TOP_K`
+earlier messages (3 by default, 0 to disable) most relevant to the last
+message, when the history window leaves them out of the prompts.
+"""
+
+import math
+import os
+import re
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Any, Iterable
+
+from langchain_core.messages import SystemMessage
+from langchain_core.messages.base import BaseMessage
+
+from . import metrics
+from .document import Section
+
+RETRIEVAL_TOP_K = int(os.getenv("RINCEWRITE_RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_MAX_THREADS = int(
+    os.getenv("RINCEWRITE_RETRIEVAL_MAX_THREADS", "64"))
+
+# usual BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN = re.compile(r"\w+")
+_STOPWORDS = frozenset("""
+    about all also and any are but can could did does for from had has have
+    her him his how its just not now off our out she should than that the
+    their them then there these they this those too was were what when which
+    who why will with would you your
+""".split())
+_SYNC_WINDOW = 500
+
+
+def tokenize(text: str) -> list[str]:
+    return [
+        word for word in _TOKEN.findall(text.lower())
+        if len(word) > 1 and word not in _STOPWORDS]
+
+
+class BM25Index:
+    """Incremental BM25 index."""
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B) -> None:
+        self.k1 = k1
+        self.b = b
+        self._postings: dict[str, dict[str, int]] = {}
+        # the terms of each document, to remove it
+        self._terms: dict[str, list[str]] = {}
+        self._lengths: dict[str, int] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._lengths
+
+    def ids(self) -> list[str]:
+        return list(self._lengths)
+
+    def add(self, doc_id: str, text: str) -> None:
+        if doc_id in self._lengths:
+            self.remove(doc_id)
+        counts = Counter(tokenize(text))
+        for term, count in counts.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+        length = sum(counts.values())
+        self._terms[doc_id] = list(counts)
+        self._lengths[doc_id] = length
+        self._total_length += length
+
+    def remove(self, doc_id: str) -> None:
+        self._total_length -= self._lengths.pop(doc_id)
+        for term in self._terms.pop(doc_id):
+            del self._postings[term][doc_id]
+            if not self._postings[term]:
+                del self._postings[term]
+
+    def scores(self, query: str) -> dict[str, float]:
+        if not self._lengths:
+            return {}
+        count = len(self._lengths)
+        average_length = self._total_length / count or 1
+        scores: dict[str, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                norm = 1 - self.b + self.b * (
+                    self._lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * (
+                    frequency * (self.k1 + 1) / (frequency + self.k1 * norm))
+        return scores
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        exclude: Iterable[str] = ()
+    ) -> list[tuple[str, float]]:
+        excluded = set(exclude)
+        ranked = sorted(
+            ((doc_id, score) for doc_id, score in self.scores(query).items()
+             if doc_id not in excluded),
+            key=lambda item: item[1],
+            reverse=True)
+        return ranked[:k]
+
+
+class ThreadIndex:
+    """Indexes of the piece sections and the messages of a conversation."""
+
+    def __init__(self) -> None:
+        # sections are indexed by hash, so that the piece before and after
+        # an update can both be searched during the turn
+        self.sections = BM25Index()
+        self.messages = BM25Index()
+
+    def sync_sections(
+        self,
+        text: str,
+        sections: list[Section],
+        prune: bool = False
+    ) -> int:
+        # indexes the new sections, and with `prune` drops the ones that are
+        # no longer in the piece; returns the number of sections indexed
+        if prune:
+            current = {section.hash for section in sections}
+            for doc_id in self.sections.ids():
+                if doc_id not in current:
+                    self.sections.remove(doc_id)
+        indexed, start = 0, 0
+        for section in sections:
+            if section.hash not in self.sections:
+                self.sections.add(
+                    section.hash, text[start:start + section.length])
+                indexed += 1
+            start += section.length
+        return indexed
+
+    def sync_messages(self, messages: list[BaseMessage]) -> int:
+        # messages never change once in the state
+        indexed = 0
+        for message in messages:
+            if message.id and message.id not in self.messages:
+                self.messages.add(message.id, str(message.content))
+                indexed += 1
+        return indexed
+
+
+class RetrievalIndexes:
+    """Indexes of the last conversations of this worker process."""
+
+    def __init__(self, max_threads: int = RETRIEVAL_MAX_THREADS) -> None:
+        self.max_threads = max_threads
+        self._threads: OrderedDict[str, ThreadIndex] = OrderedDict()
+        self._sync_ms: deque[float] = deque(maxlen=_SYNC_WINDOW)
+        self.builds = 0
+
+    def get(self, thread_id: str) -> ThreadIndex:
+        index = self._threads.get(thread_id)
+        if index is None:
+            index = self._threads[thread_id] = ThreadIndex()
+            self.builds += 1
+            while len(self._threads) > self.max_threads:
+                self._threads.popitem(last=False)
+        self._threads.move_to_end(thread_id)
+        return index
+
+    def discard(self, thread_id: str) -> None:
+        self._threads.pop(thread_id, None)
+
+    def sync(
+        self,
+        thread_id: str,
+        text: str,
+        sections: list[Section],
+        messages: list[BaseMessage],
+        prune: bool = False
+    ) -> ThreadIndex:
+        started = time.perf_counter()
+        index = self.get(thread_id)
+        index.sync_sections(text, sections, prune)
+        index.sync_messages(messages)
+        self._sync_ms.append((time.perf_counter() - started) * 1000)
+        return index
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "threads": len(self._threads),
+            "builds": self.builds,
+            "sync_ms": metrics.stats(list(self._sync_ms)),
+        }
+
+
+indexes = RetrievalIndexes()
+metrics.registry.add_source("retrieval", indexes.status)
+
+
+def recall(
+    index: ThreadIndex,
+    messages: list[BaseMessage],
+    shown: list[BaseMessage],
+    query: str,
+    k: int = RETRIEVAL_TOP_K
+) -> SystemMessage | None:
+    # the earlier messages most relevant to the query, among those left out
+    # of the prompt
+    shown_ids = {message.id for message in shown if message.id}
+    if not k or all(message.id in shown_ids for message in messages):
+        return None
+    found = index.messages.search(query, k, exclude=shown_ids)
+    if not found:
+        return None
+    positions = {message.id: i for i, message in enumerate(messages)}
+    # in the order of the conversation
+    recalled = [
+        messages[i] for i in sorted(
+            positions[doc_id] for doc_id, _ in found if doc_id in positions)]
+    return SystemMessage(content="Earlier messages that may be relevant:\n\n"
+                         + "\n\n".join(
+                             f"{message.type}: {message.content}"
+                             for message in recalled))
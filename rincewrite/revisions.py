@@ -0,0 +1,368 @@
+"""Revision index of the piece of each conversation.
+
+At the end of each turn that changes the piece, a revision is recorded under
+the thread id: its number, the checkpoint of the turn, and the hash and size
+of the piece. The title, description and text are stored once per content
+hash, apart from the checkpoints, so that a revision is read in one lookup,
+without the message history, and outlives the checkpoints pruned by
+retention.
+
+Revisions can be listed, compared, and restored: a restore writes the piece
+of a revision back into the graph state, as one more revision, and drops the
+session head of the conversation, so that the next page load shows the
+restored piece. With the SQLite backend, they are kept in the checkpoint
+database, shared by the workers, and the index of the last
+`RINCEWRITE_REVISIONS_CACHE_SIZE` conversations (256 by default) in memory,
+completed on each read with the revisions other workers recorded since; with
+other backends, only in memory. `RINCEWRITE_REVISIONS=false` disables them.
+
+    python -m rincewrite.revisions list <thread_id>
+    python -m rincewrite.revisions diff <thread_id> 3 5
+    python -m rincewrite.revisions restore <thread_id> 3
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any
+
+import aiosqlite
+from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.runnables import RunnableConfig
+
+from . import metrics
+from .document import ensure_index
+from .patches import text_diff
+from .session import session_heads
+
+if TYPE_CHECKING:
+    from langgraph.graph.state import CompiledStateGraph
+
+REVISIONS = os.getenv("RINCEWRITE_REVISIONS") != "false"
+REVISIONS_CACHE_SIZE = int(os.getenv("RINCEWRITE_REVISIONS_CACHE_SIZE", "256"))
+# contents kept in memory per thread with the SQLite backend, enough for the
+# piece and its undo target, the others are read from the database
+_CONTENTS_PER_THREAD = 2
+
+
+class PieceContent(BaseModel):
+    piece_title: str
+    piece_desc: str
+    piece_text: str
+
+    def content_hash(self) -> str:
+        data = json.dumps(
+            [self.piece_title, self.piece_desc, self.piece_text],
+            ensure_ascii=False)
+        return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+    def render(self) -> str:
+        return (
+            f"# {self.piece_title}\n\n**{self.piece_desc}**\n\n"
+            f"{self.piece_text}")
+
+
+class Revision(BaseModel):
+    revision: int
+    checkpoint_id: str | None
+    content_hash: str
+    # bytes of the text
+    size: int
+    # the revision a restore brought back
+    restored_from: int | None
+    created_at: float
+
+
+class _ThreadRevisions:
+
+    def __init__(self, revisions: list[Revision]) -> None:
+        # revision n at index n - 1
+        self.revisions = revisions
+        self.contents: OrderedDict[str, PieceContent] = OrderedDict()
+
+
+class RevisionIndex:
+    """Revisions of the piece of each thread, backed by an optional SQLite
+    table."""
+
+    def __init__(self, max_size: int = REVISIONS_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._threads: OrderedDict[str, _ThreadRevisions] = OrderedDict()
+        self._conn: aiosqlite.Connection | None = None
+        # one transaction at a time on the connection
+        self.lock = asyncio.Lock()
+        self.recorded = 0
+        self.restored = 0
+
+    async def attach(self, conn: aiosqlite.Connection) -> None:
+        async with conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS rw_revision (
+                thread_id TEXT NOT NULL,
+                revision INTEGER NOT NULL,
+                checkpoint_id TEXT,
+                content_hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                restored_from INTEGER,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (thread_id, revision)
+            );
+            CREATE TABLE IF NOT EXISTS rw_revision_content (
+                content_hash TEXT PRIMARY KEY,
+                piece_title TEXT NOT NULL,
+                piece_desc TEXT NOT NULL,
+                piece_text TEXT NOT NULL
+            );
+            """
+        ):
+            await conn.commit()
+        self._conn = conn
+
+    def detach(self) -> None:
+        self._conn = None
+
+    def _remember(
+        self,
+        thread: _ThreadRevisions,
+        content_hash: str,
+        content: PieceContent
+    ) -> None:
+        thread.contents[content_hash] = content
+        thread.contents.move_to_end(content_hash)
+        # without a database, the contents are only kept here
+        while (self._conn is not None
+               and len(thread.contents) > _CONTENTS_PER_THREAD):
+            thread.contents.popitem(last=False)
+
+    async def _thread(self, thread_id: str) -> _ThreadRevisions:
+        thread = self._threads.get(thread_id)
+        if thread is None:
+            thread = _ThreadRevisions([])
+            self._threads[thread_id] = thread
+            while len(self._threads) > self.max_size:
+                self._threads.popitem(last=False)
+        self._threads.move_to_end(thread_id)
+        if self._conn is not None:
+            # the revisions recorded since, by this worker or another one
+            async with self._conn.execute(
+                "SELECT revision, checkpoint_id, content_hash, size, "
+                "restored_from, created_at FROM rw_revision "
+                "WHERE thread_id = ? AND revision > ? ORDER BY revision",
+                (thread_id, len(thread.revisions)),
+            ) as cur:
+                thread.revisions.extend(
+                    Revision(**dict(zip(Revision.__fields__, row)))
+                    for row in await cur.fetchall())
+        return thread
+
+    async def alist(self, thread_id: str) -> list[Revision]:
+        return list((await self._thread(thread_id)).revisions)
+
+    async def alatest(self, thread_id: str) -> Revision | None:
+        revisions = (await self._thread(thread_id)).revisions
+        return revisions[-1] if revisions else None
+
+    async def aget(
+        self,
+        thread_id: str,
+        revision: int
+    ) -> PieceContent | None:
+        thread = await self._thread(thread_id)
+        if not 0 < revision <= len(thread.revisions):
+            return None
+        content_hash = thread.revisions[revision - 1].content_hash
+        content = thread.contents.get(content_hash)
+        if content is None and self._conn is not None:
+            async with self._conn.execute(
+                "SELECT piece_title, piece_desc, piece_text "
+                "FROM rw_revision_content WHERE content_hash = ?",
+                (content_hash,),
+            ) as cur:
+                row = await cur.fetchone()
+            if row is not None:
+                content = PieceContent(
+                    **dict(zip(PieceContent.__fields__, row)))
+        if content is not None:
+            self._remember(thread, content_hash, content)
+        return content
+
+    async def arecord(
+        self,
+        thread_id: str,
+        content: PieceContent,
+        checkpoint_id: str | None,
+        restored_from: int | None = None
+    ) -> Revision | None:
+        # a new revision, unless the piece is the same as in the last one
+        content_hash = content.content_hash()
+        while True:
+            thread = await self._thread(thread_id)
+            if (restored_from is None and thread.revisions
+                    and thread.revisions[-1].content_hash == content_hash):
+                return None
+            revision = Revision(
+                revision=len(thread.revisions) + 1,
+                checkpoint_id=checkpoint_id,
+                content_hash=content_hash,
+                size=len(content.piece_text.encode()),
+                restored_from=restored_from,
+                created_at=time.time())
+            if not await self._write(thread_id, revision, content):
+                # recorded by another worker meanwhile, read with the index
+                continue
+            if len(thread.revisions) < revision.revision:
+                # unless read from the database meanwhile
+                thread.revisions.append(revision)
+            self._remember(thread, content_hash, content)
+            self.recorded += 1
+            return revision
+
+    async def _write(
+        self,
+        thread_id: str,
+        revision: Revision,
+        content: PieceContent
+    ) -> bool:
+        # False if the revision number is taken
+        if self._conn is None:
+            return True
+        async with self.lock:
+            async with self._conn.execute(
+                "INSERT OR IGNORE INTO rw_revision "
+                "(thread_id, revision, checkpoint_id, content_hash, size, "
+                "restored_from, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, *revision.dict().values()),
+            ) as cur:
+                written = cur.rowcount == 1
+            if written:
+                await self._conn.execute(
+                    "INSERT OR IGNORE INTO rw_revision_content "
+                    "(content_hash, piece_title, piece_desc, piece_text) "
+                    "VALUES (?, ?, ?, ?)",
+                    (revision.content_hash, content.piece_title,
+                     content.piece_desc, content.piece_text))
+            await self._conn.commit()
+        return written
+
+    async def adiff(self, thread_id: str, old: int, new: int) -> str:
+        contents = [await self.aget(thread_id, n) for n in (old, new)]
+        for n, content in zip((old, new), contents):
+            if content is None:
+                raise ValueError(f"No revision {n} of {thread_id!r}")
+        return text_diff(contents[0].render(), contents[1].render())
+
+    async def arestore(
+        self,
+        graph: "CompiledStateGraph",
+        config: RunnableConfig,
+        revision: int
+    ) -> tuple[Revision, PieceContent]:
+        # the piece of a revision back in the graph state, as if the last
+        # turn had written it, and recorded as a new revision
+        from .graph import PieceUpdate
+
+        thread_id = str(config["configurable"]["thread_id"])
+        content = await self.aget(thread_id, revision)
+        if content is None:
+            raise ValueError(f"No revision {revision} of {thread_id!r}")
+        new_config = await graph.aupdate_state(
+            config,
+            {
+                "piece_title": content.piece_title,
+                "piece_desc": content.piece_desc,
+                "piece_text": content.piece_text,
+                "piece_sections": ensure_index(content.piece_text, None),
+                "piece_changes": [],
+                "piece_update": PieceUpdate(
+                    new_title=content.piece_title,
+                    new_desc=content.piece_desc,
+                    new_text=content.piece_text),
+                "piece_diff": "",
+            },
+            as_node="summarize")
+        restored = await self.arecord(
+            thread_id,
+            content,
+            new_config["configurable"].get("checkpoint_id"),
+            restored_from=revision)
+        assert restored is not None
+        # the head would bring the piece of before the restore back
+        await session_heads.adelete(thread_id)
+        self.restored += 1
+        return restored, content
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "threads": len(self._threads),
+            "recorded": self.recorded,
+            "restored": self.restored,
+        }
+
+
+def undo_target(latest: Revision | None) -> int:
+    # the revision before the one displayed, 0 when there is none
+    if latest is None:
+        return 0
+    return (latest.restored_from or latest.revision) - 1
+
+
+revision_index = RevisionIndex()
+metrics.registry.add_source("revisions", revision_index.status)
+
+
+async def _run(args: argparse.Namespace) -> None:
+    from . import runtime
+    # the index the runtime attaches, not the one of `python -m`
+    from .revisions import revision_index
+
+    graph = await runtime.open_runtime()
+    try:
+        if args.command == "list":
+            for revision in await revision_index.alist(args.thread_id):
+                created_at = time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(revision.created_at))
+                restored = (
+                    f" (restored from {revision.restored_from})"
+                    if revision.restored_from else "")
+                print(
+                    f"{revision.revision:>4}  {created_at}  "
+                    f"{revision.content_hash[:12]}  {revision.size:>8} B  "
+                    f"{revision.checkpoint_id}{restored}")
+        elif args.command == "diff":
+            print(await revision_index.adiff(
+                args.thread_id, args.old, args.new))
+        elif args.command == "restore":
+            restored, _ = await revision_index.arestore(
+                graph,
+                RunnableConfig({
+                    "configurable": {"thread_id": args.thread_id}}),
+                args.revision)
+            print(f"revision {args.revision} restored as {restored.revision}")
+    finally:
+        await runtime.close_runtime()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m rincewrite.revisions",
+        description="Revisions of the piece of a conversation.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_revisions = subparsers.add_parser("list", help="list the revisions")
+    list_revisions.add_argument("thread_id")
+    diff = subparsers.add_parser("diff", help="compare two revisions")
+    diff.add_argument("thread_id")
+    diff.add_argument("old", type=int)
+    diff.add_argument("new", type=int)
+    restore = subparsers.add_parser(
+        "restore", help="restore a revision, as a new one")
+    restore.add_argument("thread_id")
+    restore.add_argument("revision", type=int)
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,34 @@
 """Welcome to Reflex! This file outlines the steps to create a basic app."""
 
+import contextlib
+import functools
 import os
-from typing import Annotated, Any, AsyncGenerator
-from typing_extensions import TypedDict
-from langchain_core.pydantic_v1 import BaseModel, Field
-from langgraph.graph import StateGraph
-from langgraph.graph.message import add_messages
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
-from langchain_openai import ChatOpenAI
-from langchain import hub
-from langchain_core.messages.base import BaseMessage
+from typing import TYPE_CHECKING, Any, AsyncGenerator
 from langchain_core.runnables import RunnableConfig
 import reflex as rx  # type: ignore
 # Reflex does not provide type hints at the moment
-
-model_name = "gpt-4o-mini"
-model = ChatOpenAI(model=model_name, temperature=0.7, streaming=True)
-
-SQLITE_CONN_STRING = "rincewrite.db"
+from . import metrics, runtime, startup
+from .document import split_sections
+from .history import report_usage
+from .resilience import RETRY_EVENT
+from .revisions import (
+    REVISIONS, PieceContent, revision_index, undo_target)
+from .session import SESSION_HEAD, SessionHead, session_heads
+from .speculation import ACTION, SPECULATION, speculator
+from .streaming import PartialArgs, TokenBuffer
+from .transcript import (
+    CHAT_MAX_MESSAGES, CHAT_PAGE, CHAT_WINDOW, display_messages)
+from .turns import DuplicateTurn, StaleTurn, Turn, TurnBusy, turns
+
+if TYPE_CHECKING:
+    # the graph is imported with the runtime, once the app is served
+    from langgraph.graph.state import CompiledStateGraph
+
+# nodes whose model output is the assistant's reply to the user
+_CHAT_NODES = ("welcome", "chat", "chat_only")
+# shown when another worker kept the conversation for too long
+_BUSY_NOTICE = (
+    "The conversation is busy in another window, try again in a moment.")
 
 piece_desc_placeholder = "Your piece description here. Any description that \
 can help bootstrap the structuration of your piece is most welcome (title, \
@@ -32,129 +43,6 @@ adressed? ...). But don't waste too much time here: we will build this and \
 the rest along the way, together."
 
 
-class PieceUpdate(BaseModel):
-    new_title: str = Field(
-        ...,
-        title="New title for the piece")
-    new_desc: str = Field(
-        ...,
-        title="New description for the piece")
-    new_text: str = Field(
-        ...,
-        title="New text for the piece")
-
-
-class GraphState(TypedDict):
-    piece_title: str
-    piece_desc: str
-    piece_text: str
-    piece_update: PieceUpdate
-    messages: Annotated[list[BaseMessage], add_messages]
-
-
-# 'welcome' Node
-_welcome_prompt = hub.pull("bse-guirriecp/rincewrite-welcome:f1e53c7a")
-_welcome_chain = _welcome_prompt | model
-
-
-async def _welcome(
-    state: GraphState,
-    config: RunnableConfig
-) -> dict[str, Any]:
-
-    welcome_msg = await _welcome_chain.ainvoke({
-        "user_name":    config["configurable"].get(
-            "user_name",
-            "UNKNOWN_USER"),
-        "user_desc":    config["configurable"].get(
-            "user_desc",
-            "NO_USER_DESC"),
-        "piece_title":   state["piece_title"],
-        "piece_desc":   state["piece_desc"],
-    })
-
-    return {"messages": [welcome_msg]}
-
-# 'user_action' Node
-
-
-def _user_action(state: GraphState) -> None:
-    # this is a 'fake' node, serving as en entry point for the user's actions
-    pass
-
-
-# 'update_piece_text' Node
-_update_piece_prompt = hub.pull(
-    "bse-guirriecp/rincewrite-update_piece:c6ea9f37")
-_update_piece_chain = _update_piece_prompt | model.with_structured_output(
-    PieceUpdate)
-
-
-async def _update_piece(
-    state: GraphState,
-    config: RunnableConfig
-) -> dict[str, Any]:
-    piece_update = await _update_piece_chain.ainvoke({
-        "user_name":    config["configurable"].get(
-            "user_name",
-            "UNKNOWN_USER"),
-        "user_desc":    config["configurable"].get(
-            "user_desc",
-            "NO_USER_DESC"),
-        "piece_title":   state["piece_title"],
-        "piece_desc":   state["piece_desc"],
-        "piece_text":   state["piece_text"],
-        "messages":     state["messages"],
-    })
-
-    return {
-        "piece_update": piece_update}
-
-# 'chat' Node
-_chat_prompt = hub.pull("bse-guirriecp/rincewrite-chat:32bcac42")
-_chat_chain = _chat_prompt | model
-
-
-async def _chat(
-    state: GraphState,
-    config: RunnableConfig
-) -> dict[str, Any]:
-
-    chat_msg = await _chat_chain.ainvoke({
-        "user_name":    config["configurable"].get(
-            "user_name",
-            "UNKNOWN_USER"),
-        "user_desc":    config["configurable"].get(
-            "user_desc",
-            "NO_USER_DESC"),
-        "piece_title":   state["piece_title"],
-        "piece_desc":   state["piece_desc"],
-        "piece_text":   state["piece_text"],
-        "messages":     state["messages"],
-        "new_piece_text": state["piece_update"].new_text,
-        "new_piece_title": state["piece_update"].new_title,
-        "new_piece_desc": state["piece_update"].new_desc,
-    })
-
-    return {
-        "piece_text": state["piece_update"].new_text,
-        "piece_title": state["piece_update"].new_title,
-        "piece_desc": state["piece_update"].new_desc,
-        "messages": [chat_msg]}
-
-graph_builder = StateGraph(GraphState)
-graph_builder.add_node("welcome", _welcome)
-graph_builder.add_node("user_action", _user_action)
-graph_builder.add_node("update_piece", _update_piece)
-graph_builder.add_node("chat", _chat)
-
-graph_builder.set_entry_point("welcome")
-graph_builder.add_edge("welcome", "user_action")
-graph_builder.add_edge("user_action", "update_piece")
-graph_builder.add_edge("update_piece", "chat")
-graph_builder.add_edge("chat", "user_action")
-
-
 class RWState(rx.State):  # type: ignore
     """The app state."""
     # intro dialog
@@ -162,6 +50,14 @@ class RWState(rx.State):  # type: ignore
     user_form_submitted: bool = False
     # main app col 1/3 : chat / workzone
     messages: list[dict[str, str]] = []
+    # index in the graph history of the first message displayed, and whether
+    # the last messages were dropped to display earlier ones
+    history_start: int = 0
+    history_cut: bool = False
+    # version of the conversation displayed (the id of its last checkpoint),
+    # sent with each submission, and why the last one was not sent
+    turn_version: str = ""
+    turn_notice: str = ""
     service_button: str = "answer"  # proposed service will be situational
     # main app col 2/3 : action buttons
     buttons: list[str] = [  # proposed robot actions will be situational
@@ -169,8 +65,12 @@ class RWState(rx.State):  # type: ignore
         "help me structure the thing",
         "i have a draft already"
     ]
-    # main app col 3/3 : render zone
+    # main app col 3/3 : render zone, the piece title and description, then
+    # its text section by section
     renderer_content: str = ""
+    renderer_sections: list[str] = []
+    # revision of the piece an undo brings back, 0 for none
+    undo_revision: int = 0
 
     # local storage state
     user_name: str = rx.LocalStorage()
@@ -188,58 +88,80 @@ class RWState(rx.State):  # type: ignore
         self.show_dialog = False
         yield
 
-        # stream LLM tokens
-        self.messages.append({
-            'type': "ai",
-            'msg': "",
-        })
-
         config = RunnableConfig({
             "configurable": {
                 "thread_id": self.user_name,
                 "user_name": self.user_name,
                 "user_desc": self.user_desc}
         })
-        async with AsyncSqliteSaver.from_conn_string(
-                SQLITE_CONN_STRING) as memory:
-            graph = graph_builder.compile(
-                checkpointer=memory,
-                interrupt_before=["user_action"]
-            )
-
-            # Displays the graph LangGraph if 'SHOW_GRAPH' is true
-            # in the environment variable
-            if os.getenv("SHOW_GRAPH") == "true":
-                try:
-                    from PIL import Image  # type: ignore
-                    from io import BytesIO
-                except ImportError:
-                    raise ImportError(
-                        "Could not import PIL python package. "
-                        "Please install it with `poetry install --with dev`."
-                    )
-                img_data = graph.get_graph().draw_mermaid_png()
-                img = Image.open(BytesIO(img_data))
-                img.show()
-
-            state_snapshot = await graph.aget_state(config)
-            last_state = state_snapshot.values
-            last_piece_text = ""
-            if last_state:
-                self.renderer_content = (
-                    f"# {last_state['piece_title']}\n\n"
-                    f"**{last_state['piece_desc']}**"
-                    f"\n\n{last_state['piece_text']}"
+        graph = await runtime.get_graph()
+        try:
+            async for _ in self._welcome(graph, config):
+                yield
+        except TurnBusy:
+            self.turn_notice = _BUSY_NOTICE
+
+    async def _welcome(
+        self,
+        graph: "CompiledStateGraph",
+        config: RunnableConfig
+    ) -> AsyncGenerator[None, None]:
+        # Displays the graph LangGraph if 'SHOW_GRAPH' is true
+        # in the environment variable
+        if os.getenv("SHOW_GRAPH") == "true":
+            try:
+                from PIL import Image  # type: ignore
+                from io import BytesIO
+            except ImportError:
+                raise ImportError(
+                    "Could not import PIL python package. "
+                    "Please install it with `poetry install --with dev`."
                 )
-                last_piece_text = last_state["piece_text"]
+            img_data = graph.get_graph().draw_mermaid_png()
+            img = Image.open(BytesIO(img_data))
+            img.show()
+
+        # a tab opened during a turn of another one waits for it
+        async with turns.run(self.user_name) as shared:
+            # the workspace as left at the end of the last turn, without the
+            # checkpoint if possible
+            head = await session_heads.aget(self.user_name) \
+                if SESSION_HEAD else None
+            if head is not None:
+                self.messages = [dict(message) for message in head.messages]
+                self.history_start = head.history_start
+                self._render_piece(
+                    head.piece_title,
+                    head.piece_desc,
+                    head.piece_text)
+                last_piece_text = head.piece_text
             else:
-                self.renderer_content = (
-                    f"# {self.piece_title}\n\n"
-                    f"**{self.piece_desc}**"
-                )
+                state_snapshot = await graph.aget_state(config)
+                last_state = state_snapshot.values
+                last_piece_text = ""
+                # earlier messages of the thread can be loaded back
+                self.history_start = len(last_state.get("messages", []))
+                if last_state:
+                    self._render_piece(
+                        last_state["piece_title"],
+                        last_state["piece_desc"],
+                        last_state["piece_text"])
+                    last_piece_text = last_state["piece_text"]
+                else:
+                    self._render_piece(
+                        self.piece_title,
+                        self.piece_desc,
+                        "")
+
+            # stream LLM tokens
+            self.messages.append({
+                'type': "ai",
+                'msg': "",
+            })
             yield
 
-            async for event in graph.astream_events(
+            async for _ in self._stream_graph(
+                graph,
                 {
                     "piece_title":  self.piece_title,
                     "piece_desc":  self.piece_desc,
@@ -247,83 +169,434 @@ class RWState(rx.State):  # type: ignore
                     "messages":    [],
                 },
                 config,
-                version="v2"
+                shared
             ):
-                kind = event["event"]
-                # emitted for each streamed token
-                if kind == "on_chat_model_stream":
-                    content = event["data"]["chunk"].content
-                    # only display non-empty content (not tool calls)h
-                    if content:
-                        self.messages[-1]["msg"] += content
-                        yield
+                yield
+
+        self.turn_version = shared.version \
+            or await self._current_version(graph, config)
 
     async def handle_user_msg_submit(
         self,
         data: dict[str, Any]
     ) -> AsyncGenerator[None, None]:
-        self.messages.append({"type": "user", "msg": data["text_area_input"]})
-        yield
+        async for _ in self._submit(
+            data["text_area_input"],
+            version=data.get("turn_version") or None
+        ):
+            yield
 
-        # manually update graph state with user message
+    async def handle_action(
+        self,
+        action: str,
+        version: str | None = None
+    ) -> AsyncGenerator[None, None]:
+        async for _ in self._submit(
+            action, is_action=True, version=version or None
+        ):
+            yield
+
+    async def _submit(
+        self,
+        text: str,
+        is_action: bool = False,
+        version: str | None = None
+    ) -> AsyncGenerator[None, None]:
         config = RunnableConfig({
             "configurable": {
                 "thread_id": self.user_name,
                 "user_name": self.user_name,
-                "user_desc": self.user_desc}
+                "user_desc": self.user_desc,
+                ACTION: is_action}
         })
-        async with AsyncSqliteSaver.from_conn_string(
-                SQLITE_CONN_STRING) as memory:
-            # found no other way to associate the graph with the memory than
-            # through recompiling it
-            graph = graph_builder.compile(
-                checkpointer=memory,
-                interrupt_before=["user_action"]
-            )
-            await graph.aupdate_state(
-                config,
-                {"messages": [data["text_area_input"]]},
-                as_node="user_action")
+        graph = await runtime.get_graph()
+        current = functools.partial(self._current_version, graph, config)
+        try:
+            # the same submission from another tab is already running
+            shared = turns.join(self.user_name, text, version)
+            if shared is not None:
+                async for _ in self._follow(graph, config, shared, text):
+                    yield
+                return
+
+            async with turns.run(
+                    self.user_name, text, version, current) as shared:
+                self.turn_notice = ""
+                # the precomputed turn of the button clicked goes on
+                speculator.cancel(
+                    self.user_name, keep=text if is_action else None)
+                if self.history_cut:
+                    # the conversation goes on from its last messages
+                    await self._show_latest_messages(graph, config)
+                self.messages.append({"type": "user", "msg": text})
+                yield
 
-        # resume graph execution and stream LLM tokens
-        self.messages.append({
-            'type': "ai",
-            'msg': "",
-        })
-        async with AsyncSqliteSaver.from_conn_string(
-                SQLITE_CONN_STRING) as memory:
-            graph = graph_builder.compile(
-                checkpointer=memory,
-                interrupt_before=["user_action"]
-            )
+                # manually update graph state with user message
+                try:
+                    await graph.aupdate_state(
+                        config,
+                        {"messages": [text]},
+                        as_node="user_action")
+                except Exception:
+                    await self._resync_window(graph, config)
+                    raise
+
+                # resume graph execution and stream LLM tokens
+                self.messages.append({
+                    'type': "ai",
+                    'msg': "",
+                })
+                async for _ in self._stream_graph(
+                        graph, None, config, shared):
+                    yield
+            self.turn_version = shared.version or await current()
+        except DuplicateTurn:
+            # sent twice from the same tab, the first one was run
+            pass
+        except StaleTurn:
+            await self._show_latest_messages(graph, config, render=True)
+            if REVISIONS:
+                await self._show_undo(self.user_name)
+            self.turn_notice = (
+                "The conversation went on in another window, your message "
+                "was not sent.")
+            self.turn_version = await current()
+        except TurnBusy:
+            # a tab that joined the turn displays it, as it was not run
+            await self._show_latest_messages(graph, config)
+            self.turn_notice = _BUSY_NOTICE
+
+    async def _current_version(
+        self,
+        graph: "CompiledStateGraph",
+        config: RunnableConfig
+    ) -> str:
+        # the id of the last checkpoint of the conversation
+        state_snapshot = await graph.aget_state(config)
+        return str(
+            state_snapshot.config["configurable"].get("checkpoint_id") or "")
+
+    async def _follow(
+        self,
+        graph: "CompiledStateGraph",
+        config: RunnableConfig,
+        shared: Turn,
+        text: str
+    ) -> AsyncGenerator[None, None]:
+        # displays a turn run from another tab
+        self.turn_notice = ""
+        if self.history_cut:
+            await self._show_latest_messages(graph, config)
+        self.messages.append({"type": "user", "msg": text})
+        self.messages.append({"type": "ai", "msg": ""})
+        yield
+        async for snapshot in shared.updates():
+            self.messages[-1]["msg"] = snapshot["reply"]
+            self.set_piece_title(snapshot["piece_title"])
+            self.set_piece_desc(snapshot["piece_desc"])
+            self._render_piece(
+                snapshot["piece_title"],
+                snapshot["piece_desc"],
+                snapshot["piece_text"])
+            yield
+        if shared.rejected is not None:
+            # not run, for the tab that sent it first either
+            raise shared.rejected
+        self._cut_window()
+        if REVISIONS:
+            await self._show_undo(self.user_name)
+        self.turn_version = shared.version \
+            or await self._current_version(graph, config)
+
+    def _turn_snapshot(self) -> dict[str, str]:
+        return {
+            "reply": self.messages[-1]["msg"],
+            "piece_title": self.piece_title,
+            "piece_desc": self.piece_desc,
+            "piece_text": "".join(self.renderer_sections),
+        }
+
+    def _cut_window(self) -> bool:
+        # once a turn is over, the window is cut back to its size
+        excess = len(self.messages) - CHAT_WINDOW
+        if excess <= 0:
+            return False
+        self.messages = self.messages[excess:]
+        self.history_start += excess
+        return True
+
+    async def _stream_graph(
+        self,
+        graph: "CompiledStateGraph",
+        graph_input: dict[str, Any] | None,
+        config: RunnableConfig,
+        shared: Turn
+    ) -> AsyncGenerator[None, None]:
+        turn = metrics.start_turn(
+            "welcome" if graph_input is not None else "message",
+            config["configurable"]["thread_id"])
+        try:
+            async for _ in metrics.meter_yields(
+                self._graph_updates(graph, graph_input, config, turn),
+                turn
+            ):
+                # tabs that joined the turn display it too
+                if shared.followers:
+                    shared.publish(self._turn_snapshot())
+                yield
+        except Exception as e:
+            turn.error = repr(e)
+            await self._resync_window(graph, config)
+            raise
+        finally:
+            metrics.end_turn(turn)
+            shared.version = turn.checkpoint_id
+            shared.publish(self._turn_snapshot())
+        if self._cut_window():
+            yield
+        thread_id = config["configurable"]["thread_id"]
+        await self._save_session_head(thread_id)
+        if REVISIONS:
+            await revision_index.arecord(
+                thread_id,
+                PieceContent(
+                    piece_title=self.piece_title,
+                    piece_desc=self.piece_desc,
+                    piece_text="".join(self.renderer_sections)),
+                turn.checkpoint_id)
+            await self._show_undo(thread_id)
+        speculator.invalidate(thread_id)
+        if SPECULATION:
+            from .graph import speculate
+
+            speculator.schedule(
+                thread_id,
+                list(self.buttons),
+                lambda action: speculate(graph, config, action))
+
+    async def _save_session_head(self, thread_id: str) -> None:
+        if SESSION_HEAD:
+            await session_heads.aset(
+                thread_id,
+                SessionHead(
+                    piece_title=self.piece_title,
+                    piece_desc=self.piece_desc,
+                    piece_text="".join(self.renderer_sections),
+                    messages=self.messages,
+                    history_start=self.history_start))
+
+    async def _show_undo(self, thread_id: str) -> None:
+        self.undo_revision = undo_target(
+            await revision_index.alatest(thread_id))
+
+    async def undo_piece(self) -> AsyncGenerator[None, None]:
+        # the piece as it was before its last change, as a new revision
+        config = RunnableConfig({
+            "configurable": {"thread_id": self.user_name}})
+        graph = await runtime.get_graph()
+        try:
+            async for _ in self._undo_piece(graph, config):
+                yield
+        except TurnBusy:
+            self.turn_notice = _BUSY_NOTICE
+            return
+        await self._show_undo(self.user_name)
+        self.turn_version = await self._current_version(graph, config)
+
+    async def _undo_piece(
+        self,
+        graph: "CompiledStateGraph",
+        config: RunnableConfig
+    ) -> AsyncGenerator[None, None]:
+        async with turns.run(self.user_name):
+            target = undo_target(
+                await revision_index.alatest(self.user_name))
+            if target:
+                _, content = await revision_index.arestore(
+                    graph, config, target)
+                self.set_piece_title(content.piece_title)
+                self.set_piece_desc(content.piece_desc)
+                self._render_piece(
+                    content.piece_title,
+                    content.piece_desc,
+                    content.piece_text)
+                yield
+                await self._save_session_head(self.user_name)
+                speculator.invalidate(self.user_name)
+
+    async def load_older_messages(self) -> None:
+        config = RunnableConfig({
+            "configurable": {"thread_id": self.user_name}})
+        graph = await runtime.get_graph()
+        state_snapshot = await graph.aget_state(config)
+        messages = state_snapshot.values.get("messages", [])
+        start = max(self.history_start - CHAT_PAGE, 0)
+        self.messages = (
+            display_messages(messages[start:self.history_start])
+            + self.messages)
+        self.history_start = start
+        if len(self.messages) > CHAT_MAX_MESSAGES:
+            self.messages = self.messages[:CHAT_MAX_MESSAGES]
+            self.history_cut = True
+
+    async def show_latest_messages(self) -> None:
+        config = RunnableConfig({
+            "configurable": {"thread_id": self.user_name}})
+        await self._show_latest_messages(await runtime.get_graph(), config)
+
+    async def _show_latest_messages(
+        self,
+        graph: "CompiledStateGraph",
+        config: RunnableConfig,
+        render: bool = False
+    ) -> None:
+        state_snapshot = await graph.aget_state(config)
+        messages = state_snapshot.values.get("messages", [])
+        start = max(len(messages) - CHAT_WINDOW, 0)
+        self.messages = display_messages(messages[start:])
+        self.history_start = start
+        self.history_cut = False
+        if render and state_snapshot.values:
+            # the piece too, as another tab may have changed it
+            self.set_piece_title(state_snapshot.values["piece_title"])
+            self.set_piece_desc(state_snapshot.values["piece_desc"])
+            self._render_piece(
+                state_snapshot.values["piece_title"],
+                state_snapshot.values["piece_desc"],
+                state_snapshot.values["piece_text"])
+
+    async def _resync_window(
+        self,
+        graph: "CompiledStateGraph",
+        config: RunnableConfig
+    ) -> None:
+        # the window of a failed turn, as checkpointed: its bubbles are not
+        # counted in `history_start` by the next turns
+        with contextlib.suppress(Exception):
+            await self._show_latest_messages(graph, config)
+
+    async def _graph_updates(
+        self,
+        graph: "CompiledStateGraph",
+        graph_input: dict[str, Any] | None,
+        config: RunnableConfig,
+        turn: metrics.TurnMetrics
+    ) -> AsyncGenerator[None, None]:
+        from .graph import preview_piece_update
+
+        # tokens are coalesced so that each yield carries many of them
+        buffer = TokenBuffer()
+        # so are the arguments of the piece update, rendered as they arrive
+        piece_buffer = TokenBuffer()
+        piece_args = PartialArgs()
+        piece_state: dict[str, Any] = {}
+        try:
             async for event in graph.astream_events(
-                None,
+                graph_input,
                 config,
                 version="v2"
             ):
                 kind = event["event"]
+                node = event["metadata"].get("langgraph_node")
+                # the run of a node itself, not of the runnables inside it
+                if node is not None and event["name"] == node:
+                    if kind == "on_chain_start":
+                        turn.node_start(node)
+                    elif kind == "on_chain_end":
+                        turn.node_end(node)
                 # emitted for each streamed token
-                if kind == "on_chat_model_stream":
+                if kind == "on_chat_model_stream" and node in _CHAT_NODES:
                     content = event["data"]["chunk"].content
                     # only display non-empty content (not tool calls)
-                    if content:
-                        self.messages[-1]["msg"] += content
+                    if content and buffer.push(content):
+                        self.messages[-1]["msg"] += buffer.flush()
+                        yield
+                if kind == "on_custom_event" and event["name"] == RETRY_EVENT:
+                    # the call is sent again, what was streamed of it is
+                    # replaced
+                    if node in _CHAT_NODES:
+                        buffer.flush()
+                        self.messages[-1]["msg"] = ""
+                    elif node == "update_piece":
+                        piece_buffer.flush()
+                        piece_args = PartialArgs()
+                if (kind == "on_chain_start"
+                        and event["name"] == "update_piece"):
+                    piece_state = event["data"]["input"]
+                if kind == "on_chat_model_start" and node == "update_piece":
+                    # a patch that does not apply is followed by a rewrite
+                    piece_buffer.flush()
+                    piece_args = PartialArgs()
+                if kind == "on_chat_model_stream" and node == "update_piece":
+                    due = False
+                    for tool_call_chunk in \
+                            event["data"]["chunk"].tool_call_chunks:
+                        if tool_call_chunk["args"]:
+                            due = piece_buffer.push(tool_call_chunk["args"])
+                    if due and piece_state:
+                        piece_args.push(piece_buffer.flush())
+                        preview = preview_piece_update(
+                            piece_args.values, piece_state)
+                        self._render_piece(
+                            preview.new_title,
+                            preview.new_desc,
+                            preview.new_text)
                         yield
                 if kind == "on_chat_model_end":
-                    # using 'functions' / 'tools' / 'structured ouptut'
-                    # creates an event with tool_calls
-                    output = event["data"]["output"]
-                    if output.tool_calls:
-                        piece_update_dict = output.tool_calls[0]['args']
-                        piece_update = PieceUpdate(**piece_update_dict)
-                        self.set_piece_title(piece_update.new_title)
-                        self.set_piece_desc(piece_update.new_desc)
-                        self.renderer_content = (
-                            f"# {piece_update.new_title}\n\n"
-                            f"**{piece_update.new_desc}**\n\n"
-                            f"{piece_update.new_text}"
-                        )
-                yield
+                    report_usage(node, event["data"]["output"])
+                    turn.add_usage(event["data"]["output"])
+                    if node in _CHAT_NODES:
+                        # the end of the reply, without waiting for the
+                        # nodes that run after it
+                        tail = buffer.flush()
+                        if tail:
+                            self.messages[-1]["msg"] += tail
+                            yield
+                if (kind == "on_chain_end"
+                        and event["name"] == "update_piece"):
+                    # the node output holds the piece update, whether the
+                    # model rewrote the piece or returned edit operations
+                    piece_update = event["data"]["output"]["piece_update"]
+                    self.set_piece_title(piece_update.new_title)
+                    self.set_piece_desc(piece_update.new_desc)
+                    self._render_piece(
+                        piece_update.new_title,
+                        piece_update.new_desc,
+                        piece_update.new_text)
+                    yield
+        finally:
+            # whatever happened, what was received must be displayed
+            self.messages[-1]["msg"] += buffer.flush()
+            buffer.log_metrics(config["configurable"]["thread_id"])
+            if buffer.time_to_first_token is not None:
+                turn.ttft_ms = buffer.time_to_first_token * 1000
+            if piece_buffer.chunk_count:
+                piece_buffer.log_metrics(
+                    f"{config['configurable']['thread_id']} piece")
+        yield
+
+    def _render_piece(self, title: str, desc: str, text: str) -> None:
+        # plain strings, so that the handlers do not import the graph before
+        # the runtime is loaded
+        renderer_content = (
+            f"# {title}\n\n"
+            f"**{desc}**"
+        )
+        if renderer_content != self.renderer_content:
+            self.renderer_content = renderer_content
+        # only the sections that changed are replaced, so that the others
+        # are not rendered again
+        sections = split_sections(text)
+        for i, section in enumerate(sections):
+            if i == len(self.renderer_sections):
+                self.renderer_sections.append(section)
+            elif self.renderer_sections[i] != section:
+                self.renderer_sections[i] = section
+        del self.renderer_sections[len(sections):]
+
+
+def piece_section(section: str) -> rx.Component:
+    return rx.markdown(section, width="98%")
 
 
 def welcome_dialog() -> rx.Component:
@@ -460,10 +733,30 @@ def chat_msg(msg: dict[str, str]) -> rx.Component:
 def chat_messages() -> rx.Component:
     return rx.center(
         rx.vstack(
+            rx.cond(
+                RWState.history_start > 0,
+                rx.button(
+                    "earlier messages",
+                    on_click=RWState.load_older_messages,
+                    variant="ghost",
+                    size="1",
+                    align_self="center",
+                ),
+            ),
             rx.foreach(
                 RWState.messages,
                 chat_msg
             ),
+            rx.cond(
+                RWState.history_cut,
+                rx.button(
+                    "latest messages",
+                    on_click=RWState.show_latest_messages,
+                    variant="ghost",
+                    size="1",
+                    align_self="center",
+                ),
+            ),
             spacing="1",
             width="98%",
         ),
@@ -483,6 +776,18 @@ def draft_area() -> rx.Component:
             ),
             rx.form(
                 rx.vstack(
+                    rx.cond(
+                        RWState.turn_notice != "",
+                        rx.text(
+                            RWState.turn_notice,
+                            size="1",
+                            color_scheme="orange"),
+                    ),
+                    # the version the message is written on
+                    rx.el.input(
+                        type="hidden",
+                        name="turn_version",
+                        value=RWState.turn_version),
                     rx.text_area(
                         placeholder="Work from here...",
                         name="text_area_input",
@@ -520,6 +825,7 @@ def draft_area() -> rx.Component:
 def action_button(button: str) -> rx.Component:
     return rx.button(
         button,
+        on_click=RWState.handle_action(button, RWState.turn_version),
         color_scheme="blue",
         width="90%",
         height="auto",
@@ -557,8 +863,26 @@ def app_content() -> rx.Component:
             rx.center(
                 rx.scroll_area(
                     rx.center(
-                        rx.markdown(
-                            RWState.renderer_content,
+                        rx.vstack(
+                            rx.markdown(
+                                RWState.renderer_content,
+                                width="98%",
+                            ),
+                            rx.foreach(
+                                RWState.renderer_sections,
+                                piece_section,
+                            ),
+                            rx.cond(
+                                RWState.undo_revision > 0,
+                                rx.button(
+                                    "undo the last change",
+                                    on_click=RWState.undo_piece,
+                                    variant="ghost",
+                                    size="1",
+                                    align_self="center",
+                                ),
+                            ),
+                            spacing="0",
                             width="98%",
                         ),
                         width="100%",
@@ -592,4 +916,8 @@ def index() -> rx.Component:
 
 
 app = rx.App()
+app.register_lifespan_task(runtime.lifespan)
+if metrics.METRICS_ENDPOINT:
+    app.api.add_api_route("/metrics", metrics.snapshot, methods=["GET"])
 app.add_page(index, title="Rincewrite")
+startup.report()
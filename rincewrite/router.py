@@ -0,0 +1,162 @@
+"""Routing of the user's turns, with or without a piece update.
+
+Every turn used to go through `update_piece`, even a question or a thank
+you that leave the piece as it is. With `RINCEWRITE_INTENT_ROUTER`, a turn
+is first classified from the user's message: `heuristic` routes the turns
+that clearly need no edit (thanks, greetings, questions and brainstorming
+that ask for no change) straight to the reply, and the others to a piece
+update as before; `model` also asks the model (`RINCEWRITE_ROUTER_MODEL`,
+the chat model by default) about the turns the heuristics cannot decide.
+`off`, the default, updates the piece on every turn.
+
+Decisions are logged with the time and tokens the piece update would have
+taken (its median duration on the last turns, and its estimated prompt and
+completion), and counted in the metrics.
+"""
+
+import functools
+import logging
+import os
+import re
+from typing import TYPE_CHECKING, Any
+
+from langchain_core.pydantic_v1 import BaseModel, Field
+from langchain_core.runnables import Runnable
+
+from . import metrics
+
+if TYPE_CHECKING:
+    from langchain_core.language_models import BaseChatModel
+    from langchain_core.prompts import ChatPromptTemplate
+
+logger = logging.getLogger(__name__)
+
+INTENT_ROUTER = os.getenv("RINCEWRITE_INTENT_ROUTER", "off")
+ROUTER_MODEL = os.getenv("RINCEWRITE_ROUTER_MODEL", "")
+
+EDIT = "edit"
+CHAT = "chat"
+
+# the text sent to the chat prompt when the piece is left as it is
+NO_CHANGE = "No change to the text."
+
+_EDIT_WORDS = re.compile(
+    r"\b(write|rewrite|redo|add|insert|append|include|put|change|replace|"
+    r"edit|modify|update|revise|remove|delete|drop|cut|move|swap|rename|"
+    r"retitle|expand|extend|develop|lengthen|shorten|condense|trim|fix|"
+    r"correct|translate|restructure|reorganize|reorder|structure|outline|"
+    r"draft|continue|finish|start|begin|make|turn|apply|use|go ahead|"
+    r"do it|implement)\b",
+    re.IGNORECASE)
+_ACKNOWLEDGEMENT = re.compile(
+    r"^\W*(thanks?( you)?( so much)?|thx|ty|ok(ay)?|cool|great|nice|"
+    r"perfect|good|awesome|excellent|lovely|yes|yeah|yep|sure|no|nope|hi|"
+    r"hello|hey|bye|goodbye|good night|lol|wow)\W*$",
+    re.IGNORECASE)
+_QUESTION_START = re.compile(
+    r"^\W*(what|why|how|who|whom|whose|when|where|which|is|are|was|were|"
+    r"do|does|did|have|has|should|shall|will|am)\b",
+    re.IGNORECASE)
+# "could you rewrite ...?" is a request, not a question
+_REQUEST_START = re.compile(
+    r"^\W*(please|can you|could you|would you|will you|can we|could we)\b",
+    re.IGNORECASE)
+_BRAINSTORM = re.compile(
+    r"\b(ideas?|brainstorm\w*|what if|suggest\w*|think|thoughts|opinion|"
+    r"feedback|advice|recommend\w*|explain\w*)\b",
+    re.IGNORECASE)
+
+
+def classify(message: str, last_reply: str = "") -> tuple[str | None, str]:
+    # the route of a turn from the user's message, and why; None when the
+    # message does not tell
+    text = message.strip()
+    if not text:
+        return CHAT, "empty message"
+    if _ACKNOWLEDGEMENT.match(text):
+        # "yes" to "Shall I add a chapter?" asks for the change
+        if "?" in last_reply:
+            return None, "answer to a proposal"
+        return CHAT, "acknowledgement"
+    asks_edit = _EDIT_WORDS.search(text) is not None
+    if _REQUEST_START.match(text):
+        return (EDIT, "request") if asks_edit else (None, "request")
+    if text.endswith("?") or _QUESTION_START.match(text):
+        return (None, "question about an edit") if asks_edit \
+            else (CHAT, "question")
+    if asks_edit:
+        return EDIT, "edit words"
+    if _BRAINSTORM.search(text):
+        return CHAT, "brainstorming"
+    return None, "no cue"
+
+
+class TurnRoute(BaseModel):
+    needs_edit: bool = Field(
+        ...,
+        title="Whether the piece must be changed to answer the last message")
+
+
+@functools.cache
+def route_prompt() -> "ChatPromptTemplate":
+    from langchain_core.prompts import (
+        ChatPromptTemplate, MessagesPlaceholder)
+
+    return ChatPromptTemplate.from_messages([
+        ("system",
+         "A writer works on a piece titled \"{piece_title}\" with their "
+         "writing assistant. Tell whether the assistant must change the "
+         "title, description or text of the piece to answer the writer's "
+         "last message, or only has to reply."),
+        MessagesPlaceholder("messages"),
+    ])
+
+
+def route_chain(model: "BaseChatModel") -> Runnable:
+    return route_prompt() | model.with_structured_output(TurnRoute)
+
+
+class RouterStats:
+    """Routing decisions of a worker, and what they saved."""
+
+    def __init__(self) -> None:
+        self.routes: dict[str, int] = {}
+        self.reasons: dict[str, int] = {}
+        self.model_calls = 0
+        self.saved_ms = 0.0
+        self.saved_tokens = 0
+
+    def record(
+        self,
+        route: str,
+        reason: str,
+        saved_ms: float,
+        saved_tokens: int
+    ) -> None:
+        self.routes[route] = self.routes.get(route, 0) + 1
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        if route == CHAT:
+            self.saved_ms += saved_ms
+            self.saved_tokens += saved_tokens
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "mode": INTENT_ROUTER,
+            "routes": self.routes,
+            "reasons": self.reasons,
+            "model_calls": self.model_calls,
+            "saved_ms": round(self.saved_ms),
+            "saved_tokens": self.saved_tokens,
+        }
+
+
+router_stats = RouterStats()
+metrics.registry.add_source("router", router_stats.status)
+
+
+def update_piece_ms() -> float:
+    # median duration of the piece updates of the last turns
+    p50 = metrics.stats([
+        turn.node_ms["update_piece"] for turn in metrics.registry.turns
+        if "update_piece" in turn.node_ms])["p50"]
+    return float(p50 or 0.0)
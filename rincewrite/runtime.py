@@ -0,0 +1,140 @@
+"""Process-wide LangGraph runtime.
+
+The checkpointer and the compiled graph are created once per worker process
+and shared by every Reflex event handler. They are closed when the app shuts
+down. The checkpointer comes from the configured persistence backend (see
+`persistence.py`).
+
+The graph, the model client and the checkpointer are heavy to import, so the
+app is served without them. `RINCEWRITE_RUNTIME_WARMUP` decides when they are
+loaded: `background` (the default) once the app has started, without
+delaying it, `startup` before the app is served, and `lazy` by the first
+event handler that needs them.
+"""
+
+import asyncio
+import contextlib
+import importlib
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, AsyncIterator
+
+from . import metrics, startup
+from .session import session_heads
+from .speculation import speculator
+from .turns import turns
+
+if TYPE_CHECKING:
+    from langgraph.graph.state import CompiledStateGraph
+
+logger = logging.getLogger(__name__)
+
+RUNTIME_WARMUP = os.getenv("RINCEWRITE_RUNTIME_WARMUP", "background")
+
+_lock = asyncio.Lock()
+_exit_stack: contextlib.AsyncExitStack | None = None
+_graph: "CompiledStateGraph | None" = None
+
+
+def _import_runtime() -> None:
+    for name in ("graph", "persistence", "response_cache", "revisions"):
+        importlib.import_module(f"{__package__}.{name}")
+    # the prompts too, a hub pull would block the event loop in the nodes
+    from .prompts import load_prompts
+    load_prompts()
+
+
+async def open_runtime() -> "CompiledStateGraph":
+    global _exit_stack, _graph
+    async with _lock:
+        if _graph is None:
+            # the graph, the model client and the checkpointer are only
+            # imported here, so that they do not delay the start of the app,
+            # and in a thread, so that the app keeps serving meanwhile
+            started = time.perf_counter()
+            await asyncio.to_thread(_import_runtime)
+            from . import persistence
+            from .graph import graph_builder
+            from .response_cache import welcome_cache
+            from .revisions import revision_index
+            metrics.registry.record_startup(
+                "graph_import", (time.perf_counter() - started) * 1000)
+            exit_stack = contextlib.AsyncExitStack()
+            started = time.perf_counter()
+            backend = persistence.get_backend()
+            memory = await exit_stack.enter_async_context(
+                backend.checkpointer())
+            metrics.registry.record_startup(
+                "checkpointer_open", (time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            _graph = graph_builder.compile(
+                checkpointer=metrics.MeteredSaver(memory),
+                interrupt_before=["user_action"]
+            )
+            metrics.registry.record_startup(
+                "graph_compile", (time.perf_counter() - started) * 1000)
+            if isinstance(backend, persistence.SqliteBackend):
+                # the persistent tiers of the welcome cache, the session
+                # heads and the revisions, and the leases of the turns, each
+                # on its own connection so that their transactions do not
+                # mix
+                for component in (
+                        welcome_cache, session_heads, revision_index, turns):
+                    await component.attach(await persistence.connect_sqlite(
+                        exit_stack, backend.path, read_only=False))
+                    exit_stack.callback(component.detach)
+            _exit_stack = exit_stack
+            startup.report()
+    return _graph
+
+
+async def close_runtime() -> None:
+    global _exit_stack, _graph
+    async with _lock:
+        if _exit_stack is not None:
+            # the speculative runs use the checkpointer
+            await speculator.aclose()
+            await _exit_stack.aclose()
+        _exit_stack = None
+        _graph = None
+
+
+async def get_graph() -> "CompiledStateGraph":
+    # the graph is normally opened by the app lifespan, but event handlers
+    # may run before it (e.g. when the app is served without lifespan)
+    if _graph is None:
+        return await open_runtime()
+    return _graph
+
+
+async def warm_up() -> None:
+    started = time.perf_counter()
+    await open_runtime()
+    metrics.registry.record_startup(
+        "warmup", (time.perf_counter() - started) * 1000)
+
+
+async def _refresh_prompts() -> None:
+    prompts = await asyncio.to_thread(
+        importlib.import_module, f"{__package__}.prompts")
+    prompts.refresh_in_background()
+
+
+@contextlib.asynccontextmanager
+async def lifespan() -> AsyncIterator[None]:
+    tasks = [asyncio.create_task(_refresh_prompts())]
+    if RUNTIME_WARMUP == "startup":
+        await open_runtime()
+    elif RUNTIME_WARMUP == "background":
+        tasks.append(asyncio.create_task(warm_up()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            # not cancelled, the checkpointer may be half open
+            try:
+                await task
+            except Exception:
+                logger.exception("Startup task failed")
+        await close_runtime()
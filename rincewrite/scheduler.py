@@ -0,0 +1,280 @@
+"""Scheduling of the model calls of all the sessions of a worker.
+
+Every chain call of the graph goes through `llm_scheduler`, which bounds
+the calls in flight (`RINCEWRITE_LLM_MAX_CONCURRENCY`, 8 by default, 0 for
+no limit) and, optionally, the token throughput
+(`RINCEWRITE_LLM_TOKENS_PER_MINUTE`, estimated prompt and completion tokens,
+corrected with the usage reported by the provider).
+
+Waiting calls are queued per conversation (`thread_id`) and served in turn,
+so that one busy conversation cannot hold the others back. Chat replies
+are served before piece updates and summaries, unless one of those has
+waited for more than `RINCEWRITE_LLM_MAX_PRIORITY_WAIT` seconds.
+Speculative calls (see `speculation`) always come last. Queue depths and
+wait times are reported by `status()` and in the metrics.
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator
+
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from . import metrics
+from .history import estimate_tokens
+from .resilience import resilience
+from .speculation import (
+    SpeculationFailed, replay, speculation_for, speculator)
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONCURRENCY = int(os.getenv("RINCEWRITE_LLM_MAX_CONCURRENCY", "8"))
+LLM_TOKENS_PER_MINUTE = int(
+    os.getenv("RINCEWRITE_LLM_TOKENS_PER_MINUTE", "0"))
+LLM_MAX_PRIORITY_WAIT = float(
+    os.getenv("RINCEWRITE_LLM_MAX_PRIORITY_WAIT", "10"))
+
+# lower values are served first
+PRIORITIES = {
+    "welcome": 0,
+    "chat": 0,
+    "route": 0,
+    "update_piece": 1,
+    "summarize": 1,
+    # never served before a call of an actual turn
+    "speculation": 2,
+}
+# expected completion length of a reply, when nothing better is known
+COMPLETION_ESTIMATE = 256
+
+_WAIT_WINDOW = 500
+
+
+class _Waiter:
+
+    __slots__ = ("thread_id", "kind", "cost", "enqueued_at", "future")
+
+    def __init__(
+        self,
+        thread_id: str,
+        kind: str,
+        cost: int,
+        future: asyncio.Future[None]
+    ) -> None:
+        self.thread_id = thread_id
+        self.kind = kind
+        self.cost = cost
+        self.enqueued_at = time.perf_counter()
+        self.future = future
+
+
+class Slot:
+    """A granted model call, to be charged with its actual usage."""
+
+    def __init__(self, scheduler: "LLMScheduler", cost: int) -> None:
+        self._scheduler = scheduler
+        self.cost = cost
+
+    def charge(self, result: Any) -> None:
+        usage = getattr(result, "usage_metadata", None)
+        if usage:
+            self._scheduler._spend(usage["total_tokens"] - self.cost)
+            self.cost = usage["total_tokens"]
+
+
+class LLMScheduler:
+    """Fair, prioritised admission of model calls."""
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+        max_priority_wait: float = LLM_MAX_PRIORITY_WAIT
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_priority_wait = max_priority_wait
+        # one round-robin of conversations per priority
+        self._queues: list[OrderedDict[str, deque[_Waiter]]] = [
+            OrderedDict() for _ in range(max(PRIORITIES.values()) + 1)]
+        self._in_flight = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._timer: asyncio.TimerHandle | None = None
+        self._waits: dict[str, deque[float]] = {}
+
+    # token bucket
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.tokens_per_minute),
+            self._tokens
+            + (now - self._refilled_at) * self.tokens_per_minute / 60)
+        self._refilled_at = now
+
+    def _spend(self, tokens: int) -> None:
+        if self.tokens_per_minute:
+            self._refill()
+            self._tokens -= tokens
+
+    # queues
+
+    def _head(self) -> _Waiter | None:
+        heads = []
+        for queue in self._queues:
+            # drop the calls given up while waiting
+            while queue:
+                thread_id, waiters = next(iter(queue.items()))
+                while waiters and waiters[0].future.done():
+                    waiters.popleft()
+                if waiters:
+                    break
+                del queue[thread_id]
+            heads.append(next(iter(queue.values()))[0] if queue else None)
+        now = time.perf_counter()
+        # a call waiting for too long goes first, whatever its priority
+        for head in heads[1:PRIORITIES["speculation"]]:
+            if (head is not None
+                    and now - head.enqueued_at > self.max_priority_wait):
+                return head
+        return next((head for head in heads if head is not None), None)
+
+    def _pop(self, waiter: _Waiter) -> None:
+        queue = self._queues[PRIORITIES.get(waiter.kind, 0)]
+        waiters = queue[waiter.thread_id]
+        waiters.popleft()
+        if waiters:
+            # the conversation goes back to the end of the round
+            queue.move_to_end(waiter.thread_id)
+        else:
+            del queue[waiter.thread_id]
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while (not self.max_concurrency
+               or self._in_flight < self.max_concurrency):
+            waiter = self._head()
+            if waiter is None:
+                return
+            cost = waiter.cost
+            if self.tokens_per_minute:
+                self._refill()
+                cost = min(cost, self.tokens_per_minute)
+                if self._tokens < cost:
+                    delay = (cost - self._tokens) * 60 / self.tokens_per_minute
+                    self._timer = asyncio.get_running_loop().call_later(
+                        delay, self._dispatch)
+                    return
+                self._tokens -= cost
+            self._pop(waiter)
+            self._in_flight += 1
+            waiter.future.set_result(None)
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self,
+        thread_id: str,
+        kind: str,
+        cost: int
+    ) -> AsyncIterator[Slot]:
+        waiter = _Waiter(
+            thread_id, kind, cost, asyncio.get_running_loop().create_future())
+        queue = self._queues[PRIORITIES.get(kind, 0)]
+        queue.setdefault(thread_id, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # granted just as it was given up
+                self._in_flight -= 1
+            self._dispatch()
+            raise
+
+        wait = time.perf_counter() - waiter.enqueued_at
+        self._waits.setdefault(kind, deque(maxlen=_WAIT_WINDOW)).append(
+            wait * 1000)
+        turn = metrics.current_turn()
+        if turn is not None:
+            turn.llm_wait_ms += wait * 1000
+        if wait > 1:
+            logger.info(
+                "%s call of %s waited %.1fs for the model", kind,
+                thread_id, wait)
+
+        try:
+            yield Slot(self, waiter.cost)
+        finally:
+            self._release()
+
+    def status(self) -> dict[str, Any]:
+        queued: dict[str, int] = {}
+        threads: set[str] = set()
+        for queue in self._queues:
+            for thread_id, waiters in queue.items():
+                for waiter in waiters:
+                    if not waiter.future.done():
+                        queued[waiter.kind] = queued.get(waiter.kind, 0) + 1
+                        threads.add(thread_id)
+        return {
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "queued": queued,
+            "queued_threads": len(threads),
+            "tokens_available": (
+                round(self._tokens) if self.tokens_per_minute else None),
+            "wait_ms": {
+                kind: metrics.stats(list(waits))
+                for kind, waits in self._waits.items()},
+        }
+
+
+llm_scheduler = LLMScheduler()
+metrics.registry.add_source("llm_scheduler", llm_scheduler.status)
+
+
+async def ainvoke(
+    runnable: Runnable,
+    inputs: dict[str, Any],
+    config: RunnableConfig,
+    kind: str,
+    completion_estimate: int = COMPLETION_ESTIMATE
+) -> Any:
+    # runs a chain once the scheduler lets it, each attempt of the call
+    # waiting for its own turn
+    thread_id = str(config["configurable"].get("thread_id", ""))
+    cost = estimate_tokens(inputs) + completion_estimate
+
+    async def attempt(attempt_config: RunnableConfig) -> Any:
+        async with llm_scheduler.slot(
+                thread_id,
+                kind if owner is None else "speculation",
+                cost) as slot:
+            result = await runnable.ainvoke(inputs, attempt_config)
+            slot.charge(result)
+        return result
+
+    owner = speculation_for(config)
+    if owner is not None:
+        # a guess made while the user is idle, not retried
+        return await speculator.run(
+            owner, kind, inputs, cost, lambda: attempt(config))
+    precomputed = speculator.take(thread_id, kind, inputs, config)
+    if precomputed is not None:
+        try:
+            # a turn given up does not cancel the speculative call
+            return await replay(await asyncio.shield(precomputed), config)
+        except SpeculationFailed:
+            pass
+    return await resilience.ainvoke(attempt, config, kind)
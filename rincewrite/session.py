@@ -0,0 +1,144 @@
+"""Session heads, to resume a conversation without its checkpoint.
+
+At the end of each turn, the workspace of the conversation as displayed (the
+piece title, description and text, and the messages of the chat window) is
+written as one small record under its thread id. A user coming back gets it
+in one read instead of deserializing the last checkpoint of the graph.
+
+Heads are kept in an in-memory LRU of `RINCEWRITE_SESSION_HEAD_CACHE_SIZE`
+entries (256 by default) and, with the SQLite backend, in the checkpoint
+database, shared by the workers. There, a head in memory is only used while
+the database holds the same one, so that a worker never serves its own head
+once another worker has saved a newer one. `RINCEWRITE_SESSION_HEAD=false`
+disables them, the workspace is then rebuilt from the checkpoint.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any
+
+import aiosqlite
+from langchain_core.pydantic_v1 import BaseModel
+
+from . import metrics
+
+SESSION_HEAD = os.getenv("RINCEWRITE_SESSION_HEAD") != "false"
+SESSION_HEAD_CACHE_SIZE = int(
+    os.getenv("RINCEWRITE_SESSION_HEAD_CACHE_SIZE", "256"))
+
+
+class SessionHead(BaseModel):
+    piece_title: str
+    piece_desc: str
+    piece_text: str
+    # display messages of the chat window, the first one at `history_start`
+    # in the graph history
+    messages: list[dict[str, str]]
+    history_start: int
+
+
+class SessionHeads:
+    """Last session head of each thread, backed by an optional SQLite
+    table."""
+
+    def __init__(self, max_size: int = SESSION_HEAD_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        # the head of each thread, and when it was saved
+        self._heads: OrderedDict[str, tuple[float, SessionHead]] = \
+            OrderedDict()
+        self._conn: aiosqlite.Connection | None = None
+        # one transaction at a time on the connection
+        self.lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    async def attach(self, conn: aiosqlite.Connection) -> None:
+        async with conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS rw_session_head (
+                thread_id TEXT PRIMARY KEY,
+                head TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            """
+        ):
+            await conn.commit()
+        self._conn = conn
+
+    def detach(self) -> None:
+        self._conn = None
+
+    def _remember(
+        self,
+        thread_id: str,
+        updated_at: float,
+        head: SessionHead
+    ) -> None:
+        self._heads[thread_id] = (updated_at, head)
+        self._heads.move_to_end(thread_id)
+        while len(self._heads) > self.max_size:
+            self._heads.popitem(last=False)
+
+    async def aget(self, thread_id: str) -> SessionHead | None:
+        cached = self._heads.get(thread_id)
+        head = None if cached is None else cached[1]
+        if self._conn is not None:
+            # the head is only read again when another worker saved a newer
+            # one
+            async with self._conn.execute(
+                "SELECT updated_at, CASE WHEN updated_at = ? THEN NULL "
+                "ELSE head END FROM rw_session_head WHERE thread_id = ?",
+                (None if cached is None else cached[0], thread_id),
+            ) as cur:
+                row = await cur.fetchone()
+            if row is None:
+                head = None
+                self._heads.pop(thread_id, None)
+            elif row[1] is not None:
+                head = SessionHead(**json.loads(row[1]))
+                self._remember(thread_id, row[0], head)
+        if head is None:
+            self.misses += 1
+            return None
+        self._heads.move_to_end(thread_id)
+        self.hits += 1
+        return head
+
+    async def aset(self, thread_id: str, head: SessionHead) -> None:
+        updated_at = time.time()
+        self._remember(thread_id, updated_at, head)
+        self.writes += 1
+        if self._conn is not None:
+            async with self.lock:
+                await self._conn.execute(
+                    "INSERT OR REPLACE INTO rw_session_head "
+                    "(thread_id, head, updated_at) VALUES (?, ?, ?)",
+                    (thread_id, head.json(), updated_at))
+                await self._conn.commit()
+
+    async def adelete(self, thread_id: str) -> None:
+        # the workspace changed outside of a turn, it is rebuilt from the
+        # checkpoint
+        self._heads.pop(thread_id, None)
+        if self._conn is not None:
+            async with self.lock:
+                await self._conn.execute(
+                    "DELETE FROM rw_session_head WHERE thread_id = ?",
+                    (thread_id,))
+                await self._conn.commit()
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "heads": len(self._heads),
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+        }
+
+
+session_heads = SessionHeads()
+metrics.registry.add_source("session_heads", session_heads.status)
@@ -0,0 +1,273 @@
+"""Speculative precomputation of the turns of the action buttons.
+
+With `RINCEWRITE_SPECULATION=true`, once a turn is over and the user has been
+idle for `RINCEWRITE_SPECULATION_DELAY` seconds (2 by default), the turn each
+action button would start is run in the background on a copy of the
+conversation state. Its model calls are made last in line of the scheduler,
+at most `RINCEWRITE_SPECULATION_MAX_CONCURRENCY` at a time (2 by default)
+and without retries, and their results kept for `RINCEWRITE_SPECULATION_TTL`
+seconds (300 by default).
+
+Results are keyed by the content of the prompt inputs, so that a change of
+the piece or of the messages leaves them out; they are dropped once the next
+turn is over. When a button is clicked, the calls of its turn take the
+precomputed results, or wait for the ones still in flight, instead of
+calling the model, and the reply is streamed at once.
+
+Speculative calls are capped at `RINCEWRITE_SPECULATION_TOKENS_PER_HOUR`
+estimated tokens per worker (100000 by default). Hits, misses and tokens
+spent are part of the metrics.
+"""
+
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from langchain_core.messages import AIMessage
+from langchain_core.messages.base import BaseMessage
+from langchain_core.runnables import RunnableConfig
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SPECULATION = os.getenv("RINCEWRITE_SPECULATION") == "true"
+SPECULATION_DELAY = float(os.getenv("RINCEWRITE_SPECULATION_DELAY", "2"))
+SPECULATION_TTL = float(os.getenv("RINCEWRITE_SPECULATION_TTL", "300"))
+SPECULATION_MAX_CONCURRENCY = int(
+    os.getenv("RINCEWRITE_SPECULATION_MAX_CONCURRENCY", "2"))
+SPECULATION_TOKENS_PER_HOUR = int(
+    os.getenv("RINCEWRITE_SPECULATION_TOKENS_PER_HOUR", "100000"))
+
+# configurable keys: the conversation a speculative run is made for, and the
+# button that started a turn
+SPECULATION_FOR = "speculation_for"
+ACTION = "action"
+
+
+class SpeculationSkipped(Exception):
+    """A speculative call would exceed the token cap."""
+
+
+class SpeculationFailed(Exception):
+    """A speculative call did not complete."""
+
+
+def speculative_config(
+    config: RunnableConfig,
+    action: str
+) -> RunnableConfig:
+    # the run of a button gets a thread id of its own, for the scheduler and
+    # the retrieval index, and remembers its conversation
+    thread_id = str(config["configurable"]["thread_id"])
+    return RunnableConfig({
+        "configurable": {
+            **config["configurable"],
+            "thread_id": f"{thread_id}#{action}",
+            SPECULATION_FOR: thread_id}})
+
+
+def speculation_for(config: RunnableConfig) -> str | None:
+    return config.get("configurable", {}).get(SPECULATION_FOR)
+
+
+def _plain(value: Any) -> Any:
+    # message ids differ between a speculative run and the actual turn
+    if isinstance(value, BaseMessage):
+        return [value.type, value.content]
+    if isinstance(value, dict):
+        return {name: _plain(v) for name, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def input_key(kind: str, inputs: dict[str, Any]) -> str:
+    payload = json.dumps(
+        {"kind": kind, "inputs": _plain(inputs)},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def replay(result: Any, config: RunnableConfig) -> Any:
+    # a reply is streamed again, so that it is displayed as it would be
+    if isinstance(result, AIMessage) and isinstance(result.content, str):
+        from .response_cache import ReplayChatModel
+
+        return await ReplayChatModel(response=result.content).ainvoke(
+            [], config)
+    return result
+
+
+class Speculator:
+    """Speculative runs and results of the conversations of a worker."""
+
+    def __init__(
+        self,
+        tokens_per_hour: int = SPECULATION_TOKENS_PER_HOUR,
+        ttl: float = SPECULATION_TTL,
+        max_concurrency: int = SPECULATION_MAX_CONCURRENCY
+    ) -> None:
+        self.tokens_per_hour = tokens_per_hour
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        # results, by conversation and input key, with their creation time
+        self._results: dict[
+            str, dict[str, tuple[float, asyncio.Future[Any]]]] = {}
+        # runs, by conversation and button
+        self._tasks: dict[str, dict[str, asyncio.Task[None]]] = {}
+        self._spent: deque[tuple[float, int]] = deque()
+        self.calls = 0
+        self.hits = 0
+        self.joins = 0
+        self.misses = 0
+        self.wasted = 0
+        self.skipped = 0
+
+    # cost cap
+
+    def spent(self) -> int:
+        hour_ago = time.monotonic() - 3600
+        while self._spent and self._spent[0][0] < hour_ago:
+            self._spent.popleft()
+        return sum(tokens for _, tokens in self._spent)
+
+    # results
+
+    async def run(
+        self,
+        thread_id: str,
+        kind: str,
+        inputs: dict[str, Any],
+        cost: int,
+        call: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        # makes a speculative call, its result kept for the conversation
+        if self.spent() + cost > self.tokens_per_hour:
+            self.skipped += 1
+            raise SpeculationSkipped(
+                f"{kind} call of {thread_id} over the speculation cap")
+        self._spent.append((time.monotonic(), cost))
+        self.calls += 1
+        future: asyncio.Future[Any] = (
+            asyncio.get_running_loop().create_future())
+        self._results.setdefault(thread_id, {})[input_key(kind, inputs)] = (
+            time.monotonic(), future)
+        try:
+            async with self._semaphore:
+                result = await call()
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(SpeculationFailed(repr(e)))
+                # nobody may wait for it
+                future.exception()
+            raise
+        future.set_result(result)
+        return result
+
+    def take(
+        self,
+        thread_id: str,
+        kind: str,
+        inputs: dict[str, Any],
+        config: RunnableConfig
+    ) -> asyncio.Future[Any] | None:
+        # the result of the same call made ahead, if any, done or not
+        results = self._results.get(thread_id)
+        entry = results.pop(input_key(kind, inputs), None) \
+            if results else None
+        if entry is not None and entry[0] > time.monotonic() - self.ttl:
+            if entry[1].done():
+                self.hits += 1
+            else:
+                self.joins += 1
+            return entry[1]
+        if config["configurable"].get(ACTION):
+            self.misses += 1
+        return None
+
+    def invalidate(self, thread_id: str) -> None:
+        # once a turn is over, the results made for the previous state can
+        # no longer match
+        results = self._results.pop(thread_id, {})
+        self.wasted += len(results)
+
+    # runs
+
+    def schedule(
+        self,
+        thread_id: str,
+        actions: list[str],
+        run: Callable[[str], Awaitable[None]]
+    ) -> None:
+        self.cancel(thread_id)
+        tasks = self._tasks.setdefault(thread_id, {})
+        for action in actions:
+            # out of the context of the turn that scheduled it
+            tasks[action] = asyncio.create_task(
+                self._run_after_delay(thread_id, action, run),
+                context=contextvars.Context())
+
+    async def _run_after_delay(
+        self,
+        thread_id: str,
+        action: str,
+        run: Callable[[str], Awaitable[None]]
+    ) -> None:
+        try:
+            await asyncio.sleep(SPECULATION_DELAY)
+            await run(action)
+        except SpeculationSkipped as e:
+            logger.info("%s", e)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception(
+                "Speculative run of %r for %s failed", action, thread_id)
+        finally:
+            tasks = self._tasks.get(thread_id, {})
+            if tasks.get(action) is asyncio.current_task():
+                del tasks[action]
+                if not tasks:
+                    del self._tasks[thread_id]
+
+    def cancel(self, thread_id: str, keep: str | None = None) -> None:
+        # the runs of the conversation, but the one of the button clicked
+        for action, task in self._tasks.get(thread_id, {}).items():
+            if action != keep:
+                task.cancel()
+
+    async def aclose(self) -> None:
+        # every run cancelled and over, before the checkpointer they read
+        # and write is closed
+        tasks = [
+            task for tasks in self._tasks.values() for task in tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._results.clear()
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "running": sum(len(tasks) for tasks in self._tasks.values()),
+            "results": sum(len(results) for results in self._results.values()),
+            "calls": self.calls,
+            "hits": self.hits,
+            "joins": self.joins,
+            "misses": self.misses,
+            "wasted": self.wasted,
+            "skipped": self.skipped,
+            "tokens_last_hour": self.spent(),
+        }
+
+
+speculator = Speculator()
+metrics.registry.add_source("speculation", speculator.status)
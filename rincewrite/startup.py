@@ -0,0 +1,132 @@
+"""Startup profile of a worker.
+
+With `RINCEWRITE_STARTUP_PROFILE=true`, the time spent importing each module
+is measured from the import of the `rincewrite` package on, and reported with
+the other startup times of the worker (`startup_ms` of the metrics snapshot,
+and the metrics log): once the app is built, and again once the runtime is
+open. Imports are reported by top-level package, and module by module for the
+app itself, the `RINCEWRITE_STARTUP_PROFILE_TOP` slowest (20 by default).
+
+The import profile of the app can also be printed without starting it:
+
+    python -m rincewrite.startup --top 30
+"""
+
+import argparse
+import importlib
+import importlib.abc
+import importlib.machinery
+import os
+import sys
+import threading
+import time
+from types import ModuleType
+from typing import Any, Sequence
+
+STARTUP_PROFILE_TOP = int(os.getenv("RINCEWRITE_STARTUP_PROFILE_TOP", "20"))
+
+# loaders whose instances are made per module, and can be wrapped
+_FILE_LOADERS = (
+    importlib.machinery.SourceFileLoader,
+    importlib.machinery.SourcelessFileLoader,
+    importlib.machinery.ExtensionFileLoader,
+)
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """Measures the time each module takes to execute, without the modules
+    it imports."""
+
+    def __init__(self) -> None:
+        self.self_ms: dict[str, float] = {}
+        self.started = time.perf_counter()
+        # time spent in nested imports, per import in progress, per thread
+        self._local = threading.local()
+
+    def find_spec(
+        self,
+        fullname: str,
+        path: Sequence[str] | None,
+        target: ModuleType | None = None
+    ) -> importlib.machinery.ModuleSpec | None:
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if isinstance(spec.loader, _FILE_LOADERS):
+            self._wrap(spec.loader, fullname)
+        return spec
+
+    def _wrap(self, loader: Any, fullname: str) -> None:
+        exec_module = loader.exec_module
+
+        def timed_exec_module(module: ModuleType) -> None:
+            stack = self._local.__dict__.setdefault("stack", [])
+            stack.append(0.0)
+            started = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - started
+                self.self_ms[fullname] = (elapsed - stack.pop()) * 1000
+                if stack:
+                    stack[-1] += elapsed
+
+        loader.exec_module = timed_exec_module
+
+    def profile(self) -> dict[str, float]:
+        # import time by top-level package, and by module for the app, the
+        # slowest first
+        totals: dict[str, float] = {}
+        for name, elapsed_ms in self.self_ms.items():
+            if not name.startswith(f"{__package__}."):
+                name = name.split(".", 1)[0]
+            totals[name] = totals.get(name, 0.0) + elapsed_ms
+        return dict(sorted(
+            totals.items(), key=lambda item: item[1], reverse=True))
+
+
+_timer: ImportTimer | None = None
+
+
+def install() -> ImportTimer:
+    global _timer
+    if _timer is None:
+        _timer = ImportTimer()
+        sys.meta_path.insert(0, _timer)
+    return _timer
+
+
+def report(top: int = STARTUP_PROFILE_TOP) -> None:
+    if _timer is None:
+        return
+    from . import metrics
+
+    profile = _timer.profile()
+    metrics.registry.record_startup("imports", sum(profile.values()))
+    for name, elapsed_ms in list(profile.items())[:top]:
+        metrics.registry.record_startup(f"import {name}", elapsed_ms)
+
+
+def main(module: str, top: int) -> None:
+    timer = install()
+    importlib.import_module(module)
+    elapsed = (time.perf_counter() - timer.started) * 1000
+    profile = timer.profile()
+    print(f"{module} imported in {elapsed:.0f} ms")
+    for name, elapsed_ms in list(profile.items())[:top]:
+        print(f"{name:<40} {elapsed_ms:9.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--module", default=f"{__package__}.rincewrite",
+        help="module to import, the app by default")
+    parser.add_argument("--top", type=int, default=STARTUP_PROFILE_TOP)
+    args = parser.parse_args()
+    main(args.module, args.top)
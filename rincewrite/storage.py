@@ -0,0 +1,604 @@
+"""Compact checkpoint storage for `rincewrite.db`.
+
+LangGraph writes the full value of every channel (piece text, piece update,
+whole message list) in each checkpoint, so the database grows roughly
+quadratically with the length of a session. `CompactSqliteSaver` stores
+channel values as content-addressed blobs instead, written once:
+
+- a list (such as `messages`) is stored element by element, plus a small
+  manifest listing the element hashes,
+- a long text is split in paragraphs, stored the same way,
+- a plain pydantic model (such as `PieceUpdate`) is stored field by field,
+- any other value is stored as one blob.
+
+A checkpoint row then only holds references. Retention keeps the last
+`RINCEWRITE_CHECKPOINT_KEEP_LAST` checkpoints of each thread (0 keeps them
+all), and `python -m rincewrite.storage compact` prunes, garbage-collects
+unreferenced blobs and vacuums the database.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import importlib
+import os
+import re
+import zlib
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Iterable, Sequence
+
+from langchain_core.load.serializable import Serializable
+from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple)
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from . import metrics
+
+CHECKPOINT_KEEP_LAST = int(os.getenv("RINCEWRITE_CHECKPOINT_KEEP_LAST", "0"))
+
+_MARKER = "__rincewrite_blob__"
+_KEY_SIZE = 16
+# values shorter than this stay inline in the checkpoint
+_INLINE_MAX = 256
+# texts longer than this are split in paragraphs
+_CHUNK_MIN = 4096
+_COMPRESS_MIN = 512
+_PRUNE_EVERY = 10
+_ITEM_CACHE_SIZE = 10_000
+_KNOWN_BLOBS_SIZE = 100_000
+_SQL_BATCH = 500
+
+_PARAGRAPH_END = re.compile(r"(?<=\n\n)")
+
+
+def _key(kind: str, data: bytes) -> bytes:
+    return hashlib.blake2b(
+        kind.encode() + b"\0" + data, digest_size=_KEY_SIZE).digest()
+
+
+def _split_keys(manifest: bytes) -> list[bytes]:
+    return [
+        manifest[i:i + _KEY_SIZE]
+        for i in range(0, len(manifest), _KEY_SIZE)]
+
+
+def _is_plain_model(value: Any) -> bool:
+    # langchain objects (messages...) have their own serialization
+    return isinstance(value, BaseModel) and not isinstance(value, Serializable)
+
+
+class CompactSqliteSaver(AsyncSqliteSaver):
+    """AsyncSqliteSaver storing channel values as deduplicated blobs."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._blobs_ready = False
+        self._puts_since_prune: dict[str, int] = {}
+        # list items (messages) are the same objects from one checkpoint to
+        # the next, and are never modified once in the state: their blobs are
+        # remembered by identity instead of serializing them again. The cache
+        # holds the items, so that their ids cannot be reused
+        self._item_blobs: OrderedDict[
+            int, tuple[Any, bytes, tuple[str, bytes]]] = OrderedDict()
+        # keys of the blobs known to be in the database, as long as no
+        # garbage collection has run since (its generation)
+        self._known_blobs: OrderedDict[bytes, None] = OrderedDict()
+        self._gc_generation: int | None = None
+
+    async def setup(self) -> None:
+        await super().setup()
+        if self._blobs_ready:
+            return
+        async with self.lock:
+            if self._blobs_ready:
+                return
+            async with self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS rw_blobs (
+                    key BLOB PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    data BLOB NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS rw_blobs_gc (
+                    generation INTEGER NOT NULL
+                );
+                INSERT INTO rw_blobs_gc (generation)
+                SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM rw_blobs_gc);
+                """
+            ):
+                await self.conn.commit()
+            self._blobs_ready = True
+
+    # packing
+
+    def _put_blob(
+        self,
+        blobs: dict[bytes, tuple[str, bytes]],
+        kind: str,
+        data: bytes
+    ) -> bytes:
+        key = _key(kind, data)
+        if key not in blobs:
+            if len(data) >= _COMPRESS_MIN:
+                blobs[key] = (f"z:{kind}", zlib.compress(data))
+            else:
+                blobs[key] = (kind, data)
+        return key
+
+    def _put_value(
+        self,
+        blobs: dict[bytes, tuple[str, bytes]],
+        value: Any
+    ) -> bytes:
+        type_, data = self.serde.dumps_typed(value)
+        return self._put_blob(blobs, f"value:{type_}", data)
+
+    def _remember_item(
+        self,
+        item: Any,
+        key: bytes,
+        blob: tuple[str, bytes]
+    ) -> None:
+        self._item_blobs[id(item)] = (item, key, blob)
+        self._item_blobs.move_to_end(id(item))
+        if len(self._item_blobs) > _ITEM_CACHE_SIZE:
+            self._item_blobs.popitem(last=False)
+
+    def _put_item(
+        self,
+        blobs: dict[bytes, tuple[str, bytes]],
+        item: Any
+    ) -> bytes:
+        if not isinstance(item, Serializable):
+            return self._put_value(blobs, item)
+        cached = self._item_blobs.get(id(item))
+        if cached is not None and cached[0] is item:
+            _, key, blob = cached
+            # passed again, in case it was garbage-collected
+            blobs.setdefault(key, blob)
+            self._item_blobs.move_to_end(id(item))
+            return key
+        key = self._put_value(blobs, item)
+        self._remember_item(item, key, blobs[key])
+        return key
+
+    def _pack(
+        self,
+        value: Any,
+        blobs: dict[bytes, tuple[str, bytes]]
+    ) -> Any:
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, str):
+            if len(value) <= _INLINE_MAX:
+                return value
+            if len(value) < _CHUNK_MIN:
+                key = self._put_blob(blobs, "text", value.encode())
+                return {_MARKER: "text", "ref": key.hex()}
+            keys = [
+                self._put_blob(blobs, "text", chunk.encode())
+                for chunk in _PARAGRAPH_END.split(value) if chunk]
+            manifest = self._put_blob(blobs, "manifest", b"".join(keys))
+            return {_MARKER: "chunks", "ref": manifest.hex()}
+        if isinstance(value, list) and value:
+            keys = [self._put_item(blobs, item) for item in value]
+            manifest = self._put_blob(blobs, "manifest", b"".join(keys))
+            return {_MARKER: "list", "ref": manifest.hex()}
+        if _is_plain_model(value):
+            cls = type(value)
+            return {
+                _MARKER: "model",
+                "cls": f"{cls.__module__}:{cls.__qualname__}",
+                "fields": {
+                    name: self._pack(field, blobs)
+                    for name, field in value.dict().items()},
+            }
+        return {_MARKER: "value", "ref": self._put_value(blobs, value).hex()}
+
+    # unpacking
+
+    @staticmethod
+    def _refs(value: Any) -> Iterable[tuple[bytes, bool]]:
+        # blobs directly referred to by a packed value, and whether each of
+        # them is a manifest
+        if isinstance(value, dict) and _MARKER in value:
+            if value[_MARKER] == "model":
+                for field in value["fields"].values():
+                    yield from CompactSqliteSaver._refs(field)
+            else:
+                yield (
+                    bytes.fromhex(value["ref"]),
+                    value[_MARKER] in ("list", "chunks"))
+
+    async def _select_blobs(
+        self,
+        keys: Iterable[bytes],
+        blobs: dict[bytes, tuple[str, bytes]]
+    ) -> None:
+        missing = list({key for key in keys if key not in blobs})
+        for i in range(0, len(missing), _SQL_BATCH):
+            batch = missing[i:i + _SQL_BATCH]
+            async with self.conn.execute(
+                "SELECT key, type, data FROM rw_blobs WHERE key IN "
+                f"({', '.join('?' * len(batch))})",
+                batch,
+            ) as cur:
+                async for key, type_, data in cur:
+                    if type_.startswith("z:"):
+                        type_, data = type_[2:], zlib.decompress(data)
+                    blobs[key] = (type_, data)
+
+    async def _fetch_blobs(
+        self,
+        keys: Iterable[bytes],
+        blobs: dict[bytes, tuple[str, bytes]]
+    ) -> None:
+        async with self.lock:
+            await self._select_blobs(keys, blobs)
+
+    def _decode(self, blob: tuple[str, bytes]) -> Any:
+        type_, data = blob
+        return self.serde.loads_typed((type_.split(":", 1)[1], data))
+
+    def _unpack(
+        self,
+        value: Any,
+        blobs: dict[bytes, tuple[str, bytes]]
+    ) -> Any:
+        if not (isinstance(value, dict) and _MARKER in value):
+            return value
+        kind = value[_MARKER]
+        if kind == "model":
+            module, qualname = value["cls"].split(":")
+            cls: Any = importlib.import_module(module)
+            for name in qualname.split("."):
+                cls = getattr(cls, name)
+            return cls(**{
+                name: self._unpack(field, blobs)
+                for name, field in value["fields"].items()})
+        type_, data = blobs[bytes.fromhex(value["ref"])]
+        if kind == "text":
+            return data.decode()
+        if kind == "chunks":
+            return "".join(
+                blobs[key][1].decode() for key in _split_keys(data))
+        if kind == "list":
+            items = []
+            for key in _split_keys(data):
+                item = self._decode(blobs[key])
+                if isinstance(item, Serializable):
+                    self._remember_item(item, key, blobs[key])
+                items.append(item)
+            return items
+        return self._decode((type_, data))
+
+    # the metadata of a checkpoint repeats the writes of its step
+
+    def _pack_metadata(
+        self,
+        metadata: CheckpointMetadata,
+        blobs: dict[bytes, tuple[str, bytes]]
+    ) -> CheckpointMetadata:
+        writes = metadata.get("writes")
+        if not isinstance(writes, dict):
+            return metadata
+        return {**metadata, "writes": {
+            node: (
+                {channel: self._pack(value, blobs)
+                 for channel, value in output.items()}
+                if isinstance(output, dict)
+                else self._pack(output, blobs))
+            for node, output in writes.items()}}
+
+    @staticmethod
+    def _metadata_values(metadata: CheckpointMetadata) -> list[Any]:
+        writes = metadata.get("writes")
+        if not isinstance(writes, dict):
+            return []
+        return [
+            value
+            for output in writes.values()
+            for value in (
+                output.values()
+                if isinstance(output, dict) and _MARKER not in output
+                else [output])]
+
+    def _unpack_metadata(
+        self,
+        metadata: CheckpointMetadata,
+        blobs: dict[bytes, tuple[str, bytes]]
+    ) -> None:
+        writes = metadata.get("writes")
+        if not isinstance(writes, dict):
+            return
+        for node, output in writes.items():
+            if isinstance(output, dict) and _MARKER not in output:
+                for channel, value in output.items():
+                    output[channel] = self._unpack(value, blobs)
+            else:
+                writes[node] = self._unpack(output, blobs)
+
+    async def _hydrate(self, tuples: list[CheckpointTuple]) -> None:
+        blobs: dict[bytes, tuple[str, bytes]] = {}
+        values = [
+            value
+            for checkpoint_tuple in tuples
+            for value in [
+                *checkpoint_tuple.checkpoint["channel_values"].values(),
+                *self._metadata_values(checkpoint_tuple.metadata),
+                *(write[2] for write in checkpoint_tuple.pending_writes or [])]
+        ]
+        refs = [key for value in values for key, _ in self._refs(value)]
+        await self._fetch_blobs(refs, blobs)
+        # manifests point to the blobs of list items and text chunks
+        await self._fetch_blobs(
+            (
+                key
+                for ref in refs if blobs[ref][0] == "manifest"
+                for key in _split_keys(blobs[ref][1])
+            ),
+            blobs)
+        for checkpoint_tuple in tuples:
+            channel_values = checkpoint_tuple.checkpoint["channel_values"]
+            for channel, value in channel_values.items():
+                channel_values[channel] = self._unpack(value, blobs)
+            self._unpack_metadata(checkpoint_tuple.metadata, blobs)
+            pending_writes = checkpoint_tuple.pending_writes or []
+            for i, (task_id, channel, value) in enumerate(pending_writes):
+                pending_writes[i] = (
+                    task_id, channel, self._unpack(value, blobs))
+
+    def _remember_blob(self, key: bytes) -> None:
+        self._known_blobs[key] = None
+        self._known_blobs.move_to_end(key)
+        if len(self._known_blobs) > _KNOWN_BLOBS_SIZE:
+            self._known_blobs.popitem(last=False)
+
+    async def _insert_blobs(
+        self,
+        blobs: dict[bytes, tuple[str, bytes]]
+    ) -> None:
+        # committed along with the row that refers to them, by the parent;
+        # only the blobs not in the database yet are sent, and counted
+        if not blobs:
+            return
+        async with self.lock:
+            # a write first, so that no garbage collection starts before the
+            # commit, and one that ran before is seen
+            await self.conn.execute(
+                "UPDATE rw_blobs_gc SET generation = generation WHERE 0")
+            async with self.conn.execute(
+                    "SELECT generation FROM rw_blobs_gc") as cur:
+                row = await cur.fetchone()
+            generation = row[0] if row is not None else 0
+            if generation != self._gc_generation:
+                self._known_blobs.clear()
+                self._gc_generation = generation
+            unknown = [key for key in blobs if key not in self._known_blobs]
+            existing: set[bytes] = set()
+            for i in range(0, len(unknown), _SQL_BATCH):
+                batch = unknown[i:i + _SQL_BATCH]
+                async with self.conn.execute(
+                    "SELECT key FROM rw_blobs WHERE key IN "
+                    f"({', '.join('?' * len(batch))})",
+                    batch,
+                ) as cur:
+                    existing.update(key for (key,) in await cur.fetchall())
+            new = [key for key in unknown if key not in existing]
+            if new:
+                await self.conn.executemany(
+                    "INSERT OR IGNORE INTO rw_blobs (key, type, data) "
+                    "VALUES (?, ?, ?)",
+                    [(key, *blobs[key]) for key in new])
+            for key in blobs:
+                self._remember_blob(key)
+        metrics.add_checkpoint_bytes(
+            sum(len(blobs[key][1]) for key in new))
+
+    # checkpointer interface
+
+    async def aget_tuple(
+        self,
+        config: RunnableConfig
+    ) -> CheckpointTuple | None:
+        checkpoint_tuple = await super().aget_tuple(config)
+        if checkpoint_tuple is not None:
+            await self._hydrate([checkpoint_tuple])
+        return checkpoint_tuple
+
+    async def alist(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        # the parent holds the connection lock while it iterates, so blobs
+        # can only be fetched once it is done
+        tuples = [
+            checkpoint_tuple
+            async for checkpoint_tuple in super().alist(
+                config, filter=filter, before=before, limit=limit)
+        ]
+        await self._hydrate(tuples)
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        await self.setup()
+        blobs: dict[bytes, tuple[str, bytes]] = {}
+        compact_checkpoint = {
+            **checkpoint,
+            "channel_values": {
+                channel: self._pack(value, blobs)
+                for channel, value in checkpoint["channel_values"].items()},
+        }
+        compact_metadata = self._pack_metadata(metadata, blobs)
+        await self._insert_blobs(blobs)
+        next_config = await super().aput(
+            config, compact_checkpoint, compact_metadata, new_versions)
+        await self._maybe_prune(str(config["configurable"]["thread_id"]))
+        return next_config
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        *args: Any,
+        **kwargs: Any
+    ) -> None:
+        await self.setup()
+        blobs: dict[bytes, tuple[str, bytes]] = {}
+        compact_writes = [
+            (channel, self._pack(value, blobs)) for channel, value in writes]
+        await self._insert_blobs(blobs)
+        await super().aput_writes(
+            config, compact_writes, task_id, *args, **kwargs)
+
+    # retention and compaction
+
+    async def _maybe_prune(self, thread_id: str) -> None:
+        if not CHECKPOINT_KEEP_LAST:
+            return
+        puts = self._puts_since_prune.get(thread_id, 0) + 1
+        self._puts_since_prune[thread_id] = puts % _PRUNE_EVERY
+        if puts >= _PRUNE_EVERY:
+            await self.prune(CHECKPOINT_KEEP_LAST, thread_id)
+
+    async def prune(self, keep_last: int, thread_id: str | None = None) -> int:
+        # deletes all but the last `keep_last` checkpoints of each thread,
+        # and their pending writes; returns the number of checkpoints deleted
+        await self.setup()
+        where = "WHERE thread_id = ?" if thread_id is not None else ""
+        params = (thread_id,) if thread_id is not None else ()
+        async with self.lock:
+            async with self.conn.execute(
+                f"""
+                SELECT thread_id, checkpoint_ns, checkpoint_id FROM (
+                    SELECT thread_id, checkpoint_ns, checkpoint_id,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY thread_id, checkpoint_ns
+                            ORDER BY checkpoint_id DESC) AS position
+                    FROM checkpoints {where})
+                WHERE position > ?
+                """,
+                (*params, keep_last),
+            ) as cur:
+                stale = list(await cur.fetchall())
+            await self.conn.executemany(
+                "DELETE FROM checkpoints WHERE thread_id = ? "
+                "AND checkpoint_ns = ? AND checkpoint_id = ?",
+                stale)
+            await self.conn.executemany(
+                "DELETE FROM writes WHERE thread_id = ? "
+                "AND checkpoint_ns = ? AND checkpoint_id = ?",
+                stale)
+            await self.conn.commit()
+        return len(stale)
+
+    async def collect_garbage(self) -> int:
+        # deletes the blobs no checkpoint refers to; returns their number.
+        # It runs in a single write transaction, so that no checkpoint can
+        # start referring to a blob between the scan and the deletion
+        await self.setup()
+        async with self.lock:
+            await self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                values: list[Any] = []
+                live: set[bytes] = set()
+                manifests: list[bytes] = []
+                async with self.conn.execute(
+                    "SELECT type, checkpoint, metadata FROM checkpoints"
+                ) as cur:
+                    async for type_, data, metadata in cur:
+                        checkpoint = self.serde.loads_typed((type_, data))
+                        values.extend(checkpoint["channel_values"].values())
+                        if metadata is not None:
+                            values.extend(self._metadata_values(
+                                self.jsonplus_serde.loads(metadata)))
+                async with self.conn.execute(
+                        "SELECT type, value FROM writes") as cur:
+                    async for type_, data in cur:
+                        values.append(self.serde.loads_typed((type_, data)))
+                for value in values:
+                    for key, is_manifest in self._refs(value):
+                        live.add(key)
+                        if is_manifest:
+                            manifests.append(key)
+                blobs: dict[bytes, tuple[str, bytes]] = {}
+                await self._select_blobs(manifests, blobs)
+                for key in manifests:
+                    live.update(_split_keys(blobs[key][1]))
+                async with self.conn.execute(
+                        "SELECT key FROM rw_blobs") as cur:
+                    dead = [(key,) async for (key,) in cur if key not in live]
+                await self.conn.executemany(
+                    "DELETE FROM rw_blobs WHERE key = ?", dead)
+                # the blobs other savers know may be gone
+                await self.conn.execute(
+                    "UPDATE rw_blobs_gc SET generation = generation + 1")
+                await self.conn.commit()
+                self._known_blobs.clear()
+            except BaseException:
+                await self.conn.rollback()
+                raise
+        return len(dead)
+
+    async def vacuum(self) -> None:
+        async with self.lock:
+            await self.conn.commit()
+            async with self.conn.execute("VACUUM"):
+                pass
+            async with self.conn.execute(
+                    "PRAGMA wal_checkpoint(TRUNCATE)"):
+                pass
+
+
+def database_size(path: str) -> int:
+    return sum(
+        os.path.getsize(path + suffix)
+        for suffix in ("", "-wal", "-shm")
+        if os.path.exists(path + suffix))
+
+
+async def _compact(path: str, keep_last: int, thread_id: str | None) -> None:
+    size = database_size(path)
+    async with CompactSqliteSaver.from_conn_string(path) as saver:
+        pruned = await saver.prune(keep_last, thread_id) if keep_last else 0
+        collected = await saver.collect_garbage()
+        await saver.vacuum()
+    print(
+        f"pruned {pruned} checkpoints, collected {collected} blobs, "
+        f"{size / 1e6:.2f} MB -> {database_size(path) / 1e6:.2f} MB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m rincewrite.storage",
+        description="Maintenance of the Rincewrite checkpoint database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact = subparsers.add_parser(
+        "compact",
+        help="prune old checkpoints, drop unreferenced blobs and vacuum")
+    compact.add_argument("--db", default="rincewrite.db")
+    compact.add_argument(
+        "--keep-last", type=int, default=CHECKPOINT_KEEP_LAST,
+        help="checkpoints to keep per thread (0 keeps them all)")
+    compact.add_argument("--thread", default=None)
+    args = parser.parse_args()
+    if args.command == "compact":
+        asyncio.run(_compact(args.db, args.keep_last, args.thread))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""Coalescing of streamed LLM tokens before they are sent to the frontend.
+
+Every Reflex `yield` sends a state delta over the websocket and re-renders
+the markdown of the message, so tokens are buffered and flushed on a time or
+size boundary. Setting both boundaries to 0 flushes every token.
+
+Structured outputs (the piece update) are streamed as tool call arguments,
+which are parsed while they arrive to display partial results. Each chunk
+of the arguments is scanned once, so that a long piece is not parsed again
+from its start at every flush.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from typing import Any
+
+from langchain_core.utils.json import parse_partial_json
+
+logger = logging.getLogger(__name__)
+
+STREAM_FLUSH_MS = float(os.getenv("RINCEWRITE_STREAM_FLUSH_MS", "50"))
+STREAM_FLUSH_CHARS = int(os.getenv("RINCEWRITE_STREAM_FLUSH_CHARS", "200"))
+
+
+class TokenBuffer:
+    """Buffers streamed chunks and tells when they are due for a flush."""
+
+    def __init__(
+        self,
+        flush_ms: float = STREAM_FLUSH_MS,
+        flush_chars: int = STREAM_FLUSH_CHARS
+    ) -> None:
+        self.flush_interval = flush_ms / 1000
+        self.flush_chars = flush_chars
+        self._chunks: list[str] = []
+        self._size = 0
+        self.started_at = time.perf_counter()
+        self._last_flush_at = self.started_at
+        self.first_token_at: float | None = None
+        self.flush_count = 0
+        self.chunk_count = 0
+        self.char_count = 0
+
+    def push(self, content: str) -> bool:
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self._chunks.append(content)
+        self._size += len(content)
+        self.chunk_count += 1
+        self.char_count += len(content)
+        return (
+            self._size >= self.flush_chars
+            or now - self._last_flush_at >= self.flush_interval
+        )
+
+    def flush(self) -> str:
+        if not self._chunks:
+            return ""
+        text = "".join(self._chunks)
+        self._chunks.clear()
+        self._size = 0
+        self._last_flush_at = time.perf_counter()
+        self.flush_count += 1
+        return text
+
+    @property
+    def time_to_first_token(self) -> float | None:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    def log_metrics(self, label: str) -> None:
+        ttft = self.time_to_first_token
+        logger.info(
+            "%s stream: ttft=%s flushes=%d chunks=%d chars=%d",
+            label,
+            "n/a" if ttft is None else f"{ttft * 1000:.0f}ms",
+            self.flush_count,
+            self.chunk_count,
+            self.char_count)
+
+
+# where a string may end or have an escape, and where a value nests or ends
+_STRING_SPECIAL = re.compile(r'["\\]')
+_VALUE_SPECIAL = re.compile(r'[\[\]{}",]')
+
+# where the scan of the arguments is
+_START, _KEY, _IN_KEY, _COLON, _VALUE, _IN_STRING, _IN_VALUE, _NEXT, _END = \
+    range(9)
+
+
+def _escape_end(text: str, i: int) -> int | None:
+    # end of the escape sequence at `i`, None when it is cut
+    if i + 1 >= len(text):
+        return None
+    if text[i + 1] != "u":
+        return i + 2
+    end = i + 6
+    if end > len(text):
+        return None
+    try:
+        code = int(text[i + 2:end], 16)
+    except ValueError:
+        return i + 2
+    if 0xD800 <= code < 0xDC00:
+        # a surrogate pair is decoded at once
+        if end + 2 > len(text):
+            return None
+        if text[end:end + 2] == "\\u":
+            return end + 6 if end + 6 <= len(text) else None
+    return end
+
+
+def _loads(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except ValueError:
+        try:
+            return parse_partial_json(text)
+        except ValueError:
+            return None
+
+
+class PartialArgs:
+    """The arguments of a streamed tool call, a JSON object, parsed as they
+    arrive.
+
+    A string value is decoded from its new text only, and the items of an
+    array value are parsed once each, when complete. Any other value, and
+    the item in progress, is parsed from its partial text again once that
+    has grown by half, so that a long value costs a linear time overall."""
+
+    def __init__(self) -> None:
+        self._values: dict[str, Any] = {}
+        # the end of the last chunk, an escape cut in two
+        self._tail = ""
+        self._state = _START
+        self._key = ""
+        # decoded parts of the key or string value in progress
+        self._string: list[str] = []
+        # text of the value in progress, or of its item in progress when it
+        # is an array
+        self._raw: list[str] = []
+        self._raw_size = 0
+        self._items: list[Any] | None = None
+        self._depth = 0
+        self._in_string = False
+        self._partial: Any = None
+        self._partial_size = 0
+
+    def push(self, chunk: str) -> None:
+        text = self._tail + chunk
+        self._tail = ""
+        i = 0
+        while i < len(text):
+            state = self._state
+            if state in (_IN_KEY, _IN_STRING):
+                i = self._scan_string(text, i)
+                continue
+            if state == _IN_VALUE:
+                i = self._scan_value(text, i)
+                continue
+            char = text[i]
+            if char.isspace():
+                pass
+            elif state == _START:
+                if char == "{":
+                    self._state = _KEY
+            elif state == _KEY:
+                if char == '"':
+                    self._state = _IN_KEY
+                elif char == "}":
+                    self._state = _END
+            elif state == _COLON:
+                if char == ":":
+                    self._state = _VALUE
+            elif state == _VALUE:
+                if char == '"':
+                    self._state = _IN_STRING
+                else:
+                    self._state = _IN_VALUE
+                    self._depth = 0
+                    self._in_string = False
+                    self._items = [] if char == "[" else None
+                    self._start_unit()
+                    continue
+            elif state == _NEXT:
+                if char == ",":
+                    self._state = _KEY
+                elif char == "}":
+                    self._state = _END
+            i += 1
+
+    @property
+    def values(self) -> dict[str, Any]:
+        values = dict(self._values)
+        if self._state == _IN_STRING:
+            text = "".join(self._string)
+            self._string = [text]
+            values[self._key] = text
+        elif self._state == _IN_VALUE:
+            partial = self._partial_unit()
+            if self._items is not None:
+                values[self._key] = (
+                    self._items if partial is None
+                    else [*self._items, partial])
+            elif partial is not None:
+                values[self._key] = partial
+        return values
+
+    def _scan_string(self, text: str, i: int) -> int:
+        while True:
+            match = _STRING_SPECIAL.search(text, i)
+            if match is None:
+                self._string.append(text[i:])
+                return len(text)
+            j = match.start()
+            if j > i:
+                self._string.append(text[i:j])
+            if text[j] == '"':
+                value = "".join(self._string)
+                self._string = []
+                if self._state == _IN_KEY:
+                    self._key = value
+                    self._state = _COLON
+                else:
+                    self._values[self._key] = value
+                    self._state = _NEXT
+                return j + 1
+            end = _escape_end(text, j)
+            if end is None:
+                self._tail = text[j:]
+                return len(text)
+            try:
+                self._string.append(json.loads(f'"{text[j:end]}"'))
+            except ValueError:
+                self._string.append(text[j:end])
+            i = end
+
+    def _scan_value(self, text: str, i: int) -> int:
+        start = i
+        while True:
+            if self._in_string:
+                match = _STRING_SPECIAL.search(text, i)
+                if match is None:
+                    break
+                j = match.start()
+                if text[j] == '"':
+                    self._in_string = False
+                    i = j + 1
+                elif j + 1 < len(text):
+                    i = j + 2
+                else:
+                    self._tail = "\\"
+                    self._add_raw(text[start:j])
+                    return len(text)
+                continue
+            match = _VALUE_SPECIAL.search(text, i)
+            if match is None:
+                break
+            j = match.start()
+            char = text[j]
+            i = j + 1
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+                if self._items is not None and self._depth == 1:
+                    # the items start after the bracket
+                    start = i
+            elif self._depth == 0:
+                # a comma or the end of the object after a number or a
+                # literal
+                self._add_raw(text[start:j])
+                self._end_value(_loads("".join(self._raw).strip()))
+                return j
+            elif char == "," and self._depth == 1 \
+                    and self._items is not None:
+                self._add_raw(text[start:j])
+                self._end_item()
+                start = i
+            elif char in "]}":
+                self._depth -= 1
+                if self._depth == 0:
+                    if self._items is not None:
+                        self._add_raw(text[start:j])
+                        self._end_item()
+                        self._end_value(self._items)
+                    else:
+                        self._add_raw(text[start:i])
+                        self._end_value(_loads("".join(self._raw)))
+                    return i
+        self._add_raw(text[start:])
+        return len(text)
+
+    def _start_unit(self) -> None:
+        self._raw = []
+        self._raw_size = 0
+        self._partial = None
+        self._partial_size = 0
+
+    def _add_raw(self, text: str) -> None:
+        if text:
+            self._raw.append(text)
+            self._raw_size += len(text)
+
+    def _end_item(self) -> None:
+        assert self._items is not None
+        text = "".join(self._raw).strip()
+        if text:
+            self._items.append(_loads(text))
+        self._start_unit()
+
+    def _end_value(self, value: Any) -> None:
+        self._values[self._key] = value
+        self._items = None
+        self._start_unit()
+        self._state = _NEXT
+
+    def _partial_unit(self) -> Any:
+        if self._raw_size >= max(self._partial_size * 1.5, 1):
+            text = "".join(self._raw)
+            self._raw = [text]
+            self._partial = _loads(text) if text.strip() else None
+            self._partial_size = self._raw_size
+        return self._partial
@@ -0,0 +1,156 @@
+"""Deterministic stand-in for the OpenAI chat model and the hub prompts.
+
+`FakeChatModel` streams a fixed reply, or fixed structured output arguments
+when tools are bound, one token at a time with a fixed delay, so that
+benchmarks, tests and `python -m rincewrite.batch --fake-model` measure the
+app and not the provider. Run them with:
+
+    use_fake_llm(FakeChatModel(token_delay=0.01))
+"""
+
+import asyncio
+import json
+import tempfile
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, Sequence
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun)
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import (
+    agenerate_from_stream)
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+_WORDS = (
+    "the wizard looked at the luggage and the luggage looked back neither "
+    "of them blinked mostly because only one of them had eyes").split()
+
+# the variables of the hub prompts
+_PROMPT_VARIABLES = {
+    "welcome": ["user_name", "user_desc", "piece_title", "piece_desc"],
+    "update_piece": [
+        "user_name", "user_desc", "piece_title", "piece_desc", "piece_text"],
+    "chat": [
+        "user_name", "user_desc", "piece_title", "piece_desc", "piece_text",
+        "new_piece_title", "new_piece_desc", "new_piece_text"],
+}
+
+
+def words(count: int) -> str:
+    return " ".join(_WORDS[i % len(_WORDS)] for i in range(count))
+
+
+class FakeChatModel(BaseChatModel):
+    """Streams `reply_tokens` words, or a tool call whose string arguments
+    are `piece_tokens` words long, after `first_token_delay` seconds and
+    then every `token_delay` seconds."""
+
+    reply_tokens: int = 60
+    piece_tokens: int = 400
+    first_token_delay: float = 0.0
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> Any:
+        return self.bind(
+            tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _tool_args(self, tool: dict[str, Any]) -> str:
+        args: dict[str, Any] = {}
+        for name, schema in tool["function"]["parameters"][
+                "properties"].items():
+            if schema.get("type") == "array":
+                args[name] = []
+            elif schema.get("type") == "boolean":
+                args[name] = True
+            elif name.endswith("text"):
+                args[name] = words(self.piece_tokens)
+            else:
+                args[name] = words(4)
+        return json.dumps(args)
+
+    def _chunks(self, tools: list[dict[str, Any]] | None) -> Iterator[
+            AIMessageChunk]:
+        if not tools:
+            for i, word in enumerate(words(self.reply_tokens).split()):
+                yield AIMessageChunk(content=word if i == 0 else " " + word)
+            return
+        # about one token per word, as the real arguments stream
+        args = self._tool_args(tools[0])
+        pieces = args.split(" ")
+        for i, piece in enumerate(pieces):
+            yield AIMessageChunk(content="", tool_call_chunks=[{
+                "name": tools[0]["function"]["name"] if i == 0 else None,
+                "args": piece if i == 0 else " " + piece,
+                "id": "call_fake" if i == 0 else None,
+                "index": 0,
+            }])
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        raise NotImplementedError("FakeChatModel is async only")
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.first_token_delay)
+        for i, chunk in enumerate(self._chunks(kwargs.get("tools"))):
+            if i and self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                await run_manager.on_llm_new_token(
+                    str(chunk.content), chunk=generation)
+            yield generation
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(
+            self._astream(messages, stop, run_manager, **kwargs))
+
+
+def use_fake_llm(model: FakeChatModel) -> None:
+    """Makes the graph use `model` and stub prompts, without network."""
+    from . import graph, prompts
+
+    cache_dir = Path(tempfile.mkdtemp(prefix="rincewrite-prompts-"))
+    prompts.PROMPT_CACHE_DIR = cache_dir
+    prompts.PROMPTS_OFFLINE = True
+    prompts._prompts.clear()
+    for name, ref in prompts.PROMPTS.items():
+        system = "\n".join(f"{{{v}}}" for v in _PROMPT_VARIABLES[name])
+        prompts._write_cache(ref, ChatPromptTemplate.from_messages([
+            ("system", system),
+            MessagesPlaceholder("messages", optional=True),
+        ]))
+
+    graph.model = model
+    for chain in (
+        graph._welcome_chain,
+        graph._update_piece_chain,
+        graph._patch_piece_chain,
+        graph._chat_chain,
+        graph._summary_chain,
+        graph._route_chain,
+    ):
+        chain.cache_clear()
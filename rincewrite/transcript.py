@@ -0,0 +1,28 @@
+"""Display form of the conversation, for the chat pane.
+
+The chat pane only holds a window of the conversation in the Reflex state:
+the last `RINCEWRITE_CHAT_WINDOW` messages (50 by default) once a turn is
+over. Earlier messages stay in the graph state and are loaded back on
+request, `RINCEWRITE_CHAT_PAGE` at a time (20 by default), up to
+`RINCEWRITE_CHAT_MAX_MESSAGES` in the pane (200 by default), past which the
+most recent ones are dropped until the user goes back to them. The state of
+a connection therefore stays bounded, whatever the length of the session.
+"""
+
+import os
+
+from langchain_core.messages.base import BaseMessage
+
+CHAT_WINDOW = int(os.getenv("RINCEWRITE_CHAT_WINDOW", "50"))
+CHAT_PAGE = int(os.getenv("RINCEWRITE_CHAT_PAGE", "20"))
+CHAT_MAX_MESSAGES = max(
+    int(os.getenv("RINCEWRITE_CHAT_MAX_MESSAGES", "200")), CHAT_WINDOW)
+
+_DISPLAY_TYPES = {"human": "user", "ai": "ai"}
+
+
+def display_messages(messages: list[BaseMessage]) -> list[dict[str, str]]:
+    # the graph only holds the user's and the assistant's messages
+    return [
+        {"type": _DISPLAY_TYPES[message.type], "msg": str(message.content)}
+        for message in messages if message.type in _DISPLAY_TYPES]
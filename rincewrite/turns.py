@@ -0,0 +1,301 @@
+"""Coordination of the turns of each conversation.
+
+A user's conversation is one checkpoint thread, whichever tab it is used
+from. Its turns are run one at a time, so that two of them never update and
+resume the same thread together.
+
+The version of a conversation is the id of its last checkpoint, and a
+submission carries the version the tab displayed when it was made. A
+submission made on an older version, after another tab went on with the
+conversation, is rejected and the tab shows the conversation as it is. As
+the version is read from the checkpointer, it holds across worker restarts
+and whichever worker a tab is connected to. The same submission made again
+while its turn is running on the same worker (from another tab, or a
+reconnection) joins it: the turn is run once and every tab displays its
+stream. Made again once its turn is over (a double click), it is dropped.
+
+With the SQLite backend, a turn also holds a lease on its thread in the
+checkpoint database, so that the workers run the turns of a conversation
+one at a time too. The lease is renewed while the turn runs and expires
+`RINCEWRITE_TURN_LEASE_TTL` seconds (30 by default) after a worker that
+stopped. A turn that waited `RINCEWRITE_TURN_LEASE_WAIT` seconds (60 by
+default) for the lease of another worker is rejected. Joins, rejections
+and waits are part of the metrics.
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import aiosqlite
+
+from . import metrics
+
+TURN_LEASE_TTL = float(os.getenv("RINCEWRITE_TURN_LEASE_TTL", "30"))
+TURN_LEASE_WAIT = float(os.getenv("RINCEWRITE_TURN_LEASE_WAIT", "60"))
+# how often a worker waiting for a lease tries again
+_LEASE_POLL = 0.1
+# threads whose last turn is kept to drop double clicks, older ones are
+# rejected as stale instead
+_LAST_TURNS = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+class TurnRejected(Exception):
+    """A submission that is not run."""
+
+
+class StaleTurn(TurnRejected):
+    """A submission made on an older version of the conversation."""
+
+
+class DuplicateTurn(TurnRejected):
+    """A submission of the turn that was just run."""
+
+
+class TurnBusy(TurnRejected):
+    """A submission whose thread stayed leased by another worker."""
+
+
+class Turn:
+    """A turn in flight, its updates fanned out to the tabs that joined it."""
+
+    def __init__(self, key: tuple[str, str] | None) -> None:
+        self.key = key
+        self.followers = 0
+        self.snapshot: Any = None
+        self.done = False
+        # the version the turn left the conversation at, when known, or why
+        # it was not run
+        self.version: str | None = None
+        self.rejected: TurnRejected | None = None
+        self._changed = asyncio.Event()
+
+    def publish(self, snapshot: Any, done: bool = False) -> None:
+        self.snapshot = snapshot
+        self.done = self.done or done
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def updates(self) -> AsyncIterator[Any]:
+        # the last snapshot each time it changes, those published meanwhile
+        # are skipped
+        while True:
+            changed = self._changed
+            if self.snapshot is not None:
+                yield self.snapshot
+            if self.done:
+                return
+            await changed.wait()
+
+
+class TurnCoordinator:
+    """Running turns of the threads of a worker, and their leases."""
+
+    def __init__(
+        self,
+        lease_ttl: float = TURN_LEASE_TTL,
+        lease_wait: float = TURN_LEASE_WAIT
+    ) -> None:
+        self.lease_ttl = lease_ttl
+        self.lease_wait = lease_wait
+        self._holder = uuid.uuid4().hex
+        self._conn: aiosqlite.Connection | None = None
+        # one transaction at a time on the connection
+        self.lock = asyncio.Lock()
+        # the lock of each thread with turns running or waiting, and how
+        # many
+        self._locks: dict[str, tuple[asyncio.Lock, int]] = {}
+        self._running: dict[str, Turn] = {}
+        # key of the last turn of the threads used last
+        self._last: OrderedDict[str, tuple[str, str] | None] = OrderedDict()
+        self.turns = 0
+        self.waits = 0
+        self.lease_waits = 0
+        self.joins = 0
+        self.stale = 0
+        self.duplicates = 0
+        self.busy = 0
+
+    async def attach(self, conn: aiosqlite.Connection) -> None:
+        async with conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS rw_turn_lease (
+                thread_id TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            """
+        ):
+            await conn.commit()
+        self._conn = conn
+
+    def detach(self) -> None:
+        self._conn = None
+
+    def join(
+        self,
+        thread_id: str,
+        text: str,
+        version: str | None
+    ) -> Turn | None:
+        # the running turn of the same submission, if any
+        turn = self._running.get(thread_id)
+        if (version is None or turn is None or turn.done
+                or turn.key != (version, text)):
+            return None
+        turn.followers += 1
+        self.joins += 1
+        return turn
+
+    @contextlib.asynccontextmanager
+    async def run(
+        self,
+        thread_id: str,
+        text: str = "",
+        version: str | None = None,
+        current: Callable[[], Awaitable[str]] | None = None
+    ) -> AsyncIterator[Turn]:
+        # a turn of the thread, once the previous ones are over; `version`
+        # None runs it whatever the version, otherwise it must be the one
+        # `current` reads
+        async with self._thread_lock(thread_id):
+            key = None if version is None else (version, text)
+            if key is not None and key == self._last.get(thread_id):
+                self.duplicates += 1
+                raise DuplicateTurn(f"{thread_id}: {text!r} already sent")
+            # the same submission can join it from now on, while the lease
+            # is claimed
+            turn = Turn(key)
+            self._running[thread_id] = turn
+            run = False
+            try:
+                async with self._lease(thread_id):
+                    if version is not None and current is not None:
+                        now = await current()
+                        if version != now:
+                            self.stale += 1
+                            raise StaleTurn(
+                                f"{thread_id}: version {version}, now {now}")
+                    run = True
+                    self.turns += 1
+                    yield turn
+            except TurnRejected as e:
+                turn.rejected = e
+                raise
+            finally:
+                if run:
+                    self._last[thread_id] = key
+                    self._last.move_to_end(thread_id)
+                    while len(self._last) > _LAST_TURNS:
+                        self._last.popitem(last=False)
+                del self._running[thread_id]
+                turn.publish(turn.snapshot, done=True)
+
+    @contextlib.asynccontextmanager
+    async def _thread_lock(self, thread_id: str) -> AsyncIterator[None]:
+        # dropped once no turn of the thread runs or waits
+        lock, users = self._locks.get(thread_id, (asyncio.Lock(), 0))
+        self._locks[thread_id] = (lock, users + 1)
+        if lock.locked():
+            self.waits += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[thread_id]
+            if users == 1:
+                del self._locks[thread_id]
+            else:
+                self._locks[thread_id] = (lock, users - 1)
+
+    @contextlib.asynccontextmanager
+    async def _lease(self, thread_id: str) -> AsyncIterator[None]:
+        # the thread for this worker alone, while it runs a turn
+        conn = self._conn
+        if conn is None:
+            yield
+            return
+        deadline = time.monotonic() + self.lease_wait
+        waited = False
+        while not await self._claim(conn, thread_id):
+            if not waited:
+                waited = True
+                self.lease_waits += 1
+            if time.monotonic() >= deadline:
+                self.busy += 1
+                raise TurnBusy(
+                    f"{thread_id}: leased by another worker for "
+                    f"{self.lease_wait:g}s")
+            await asyncio.sleep(_LEASE_POLL)
+        renew = asyncio.create_task(self._renew(conn, thread_id))
+        try:
+            yield
+        finally:
+            renew.cancel()
+            await asyncio.gather(renew, return_exceptions=True)
+            # released even if the turn is cancelled meanwhile
+            await asyncio.shield(self._release(conn, thread_id))
+
+    async def _claim(self, conn: aiosqlite.Connection, thread_id: str) -> bool:
+        async with self.lock:
+            now = time.time()
+            async with conn.execute(
+                "INSERT INTO rw_turn_lease (thread_id, holder, expires_at) "
+                "VALUES (?, ?, ?) ON CONFLICT (thread_id) DO UPDATE SET "
+                "holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE rw_turn_lease.expires_at < ?",
+                (thread_id, self._holder, now + self.lease_ttl, now),
+            ) as cur:
+                claimed = cur.rowcount == 1
+            await conn.commit()
+        return claimed
+
+    async def _release(
+        self,
+        conn: aiosqlite.Connection,
+        thread_id: str
+    ) -> None:
+        # the lease expires anyway if it cannot be released
+        try:
+            async with self.lock:
+                await conn.execute(
+                    "DELETE FROM rw_turn_lease "
+                    "WHERE thread_id = ? AND holder = ?",
+                    (thread_id, self._holder))
+                await conn.commit()
+        except Exception as e:
+            logger.warning("Could not release the lease of %s: %s",
+                           thread_id, e)
+
+    async def _renew(self, conn: aiosqlite.Connection, thread_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            async with self.lock:
+                await conn.execute(
+                    "UPDATE rw_turn_lease SET expires_at = ? "
+                    "WHERE thread_id = ? AND holder = ?",
+                    (time.time() + self.lease_ttl, thread_id, self._holder))
+                await conn.commit()
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "running": len(self._running),
+            "turns": self.turns,
+            "waits": self.waits,
+            "lease_waits": self.lease_waits,
+            "joins": self.joins,
+            "stale": self.stale,
+            "duplicates": self.duplicates,
+            "busy": self.busy,
+        }
+
+
+turns = TurnCoordinator()
+metrics.registry.add_source("turns", turns.status)
@@ -0,0 +1,92 @@
+import pytest
+
+from rincewrite.patches import (
+    EditOperation, PatchError, apply_patch, text_diff)
+
+TEXT = """# Title
+
+Intro line.
+
+## One
+
+First section.
+
+### One bis
+
+Nested.
+
+## Two
+
+Second section.
+"""
+
+
+def edit(op: str, anchor: str, text: str = "") -> EditOperation:
+    return EditOperation(op=op, anchor=anchor, text=text)
+
+
+def test_replace_passage() -> None:
+    assert apply_patch(TEXT, [edit("replace", "Intro line.", "Hello.")]) \
+        == TEXT.replace("Intro line.", "Hello.")
+
+
+def test_insert_around_passage() -> None:
+    text = apply_patch(TEXT, [
+        edit("insert_before", "First section.", "Before. "),
+        edit("insert_after", "First section.", " After."),
+    ])
+    assert "Before. First section. After." in text
+
+
+def test_heading_stands_for_its_section() -> None:
+    # up to the next heading of the same level, subsections included
+    text = apply_patch(TEXT, [edit("delete", "## One")])
+    assert text == "# Title\n\nIntro line.\n\n## Two\n\nSecond section.\n"
+
+
+def test_last_section_ends_with_text() -> None:
+    text = apply_patch(TEXT, [edit("replace", "## Two", "## 2\n\nNew.\n")])
+    assert text.endswith("## 2\n\nNew.\n")
+    assert "Second section." not in text
+
+
+def test_empty_anchor_is_start_or_end() -> None:
+    text = apply_patch("body", [
+        edit("insert_before", "", "start "),
+        edit("insert_after", "", " end"),
+    ])
+    assert text == "start body end"
+    with pytest.raises(PatchError):
+        apply_patch("body", [edit("delete", "")])
+
+
+def test_passage_with_reflowed_whitespace() -> None:
+    text = apply_patch("a quick\nbrown fox", [
+        edit("replace", "quick brown", "slow red")])
+    assert text == "a slow red fox"
+
+
+def test_ambiguous_or_missing_anchor() -> None:
+    with pytest.raises(PatchError, match="not unique"):
+        apply_patch("x and x", [edit("delete", "x")])
+    with pytest.raises(PatchError, match="not found"):
+        apply_patch(TEXT, [edit("delete", "Missing passage")])
+
+
+def test_heading_not_found_falls_back_to_passage() -> None:
+    text = apply_patch("see # 1 here", [edit("replace", "# 1", "#2")])
+    assert text == "see #2 here"
+
+
+def test_edits_apply_in_order() -> None:
+    text = apply_patch("one", [
+        edit("replace", "one", "two"),
+        edit("replace", "two", "three"),
+    ])
+    assert text == "three"
+
+
+def test_text_diff() -> None:
+    diff = text_diff("a\nb\n", "a\nc\n")
+    assert "-b" in diff and "+c" in diff
+    assert text_diff("same", "same") == ""
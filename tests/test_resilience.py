@@ -0,0 +1,115 @@
+import asyncio
+from collections import deque
+from typing import Any
+
+import pytest
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+
+from rincewrite import resilience as resilience_module
+from rincewrite.resilience import (
+    RETRY_EVENT, LLMTimeout, Resilience, RetryBudget)
+from rincewrite.testing import FakeChatModel
+
+
+@pytest.fixture(autouse=True)
+def short_deadlines(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(resilience_module, "LLM_FIRST_TOKEN_TIMEOUT", 0.1)
+    monkeypatch.setattr(resilience_module, "BACKOFF_BASE", 0.001)
+
+
+def models(*first_token_delays: float) -> list[FakeChatModel]:
+    return [
+        FakeChatModel(reply_tokens=3, first_token_delay=delay)
+        for delay in first_token_delays]
+
+
+def run(
+    resilience: Resilience,
+    attempts: list[FakeChatModel],
+    kind: str = "chat"
+) -> tuple[Any, list[str]]:
+    # the reply of the call, each attempt sent to the next model, and the
+    # custom events streamed meanwhile
+    async def call(config: RunnableConfig) -> Any:
+        model = attempts.pop(0) if len(attempts) > 1 else attempts[0]
+        return await model.ainvoke("hello", config)
+
+    async def node(_: Any, config: RunnableConfig) -> Any:
+        return await resilience.ainvoke(call, config, kind)
+
+    async def stream() -> tuple[Any, list[str]]:
+        events = []
+        output = None
+        async for event in RunnableLambda(node).astream_events(
+                None, version="v2"):
+            if event["event"] == "on_custom_event":
+                events.append(event["name"])
+            elif event["event"] == "on_chain_end":
+                output = event["data"]["output"]
+        return output, events
+
+    return asyncio.run(stream())
+
+
+def test_fast_call_is_not_retried() -> None:
+    resilience = Resilience()
+    reply, events = run(resilience, models(0))
+    assert reply.content == "the wizard looked"
+    assert resilience.retries == 0 and events == []
+
+
+def test_slow_first_token_is_retried() -> None:
+    resilience = Resilience()
+    reply, events = run(resilience, models(0.5, 0))
+    assert reply.content == "the wizard looked"
+    assert resilience.retries == 1
+    assert resilience.timeouts == {"chat first token": 1}
+    assert events == [RETRY_EVENT]
+
+
+def test_retries_are_bounded() -> None:
+    resilience = Resilience(max_retries=2)
+    with pytest.raises(LLMTimeout):
+        run(resilience, models(0.5))
+    assert resilience.retries == 2
+    assert resilience.timeouts == {"chat first token": 3}
+
+
+def test_retries_draw_from_the_budget() -> None:
+    resilience = Resilience(budget=RetryBudget(ratio=0, max_balance=0))
+    with pytest.raises(LLMTimeout):
+        run(resilience, models(0.5, 0))
+    assert resilience.retries == 0
+    assert resilience.retries_denied == 1
+
+
+def test_completion_deadline(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setitem(resilience_module.LLM_TIMEOUTS, "chat", 0.2)
+    slow = FakeChatModel(reply_tokens=20, token_delay=0.05)
+    resilience = Resilience(max_retries=0)
+    with pytest.raises(LLMTimeout, match="completion"):
+        run(resilience, [slow])
+
+
+def test_hedge_wins_over_slow_request(
+    monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # slower than the hedge delay, not than the deadline
+    monkeypatch.setattr(resilience_module, "LLM_FIRST_TOKEN_TIMEOUT", 5)
+    resilience = Resilience(hedge=True)
+    resilience._ttfts["chat"] = deque(
+        [0.01] * resilience_module.HEDGE_MIN_SAMPLES)
+    reply, events = run(resilience, models(1, 0))
+    assert reply.content == "the wizard looked"
+    assert resilience.hedges == 1 and resilience.hedge_wins == 1
+    assert resilience.retries == 0 and events == []
+
+
+def test_retry_budget() -> None:
+    budget = RetryBudget(ratio=0.5, max_balance=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
@@ -0,0 +1,85 @@
+import asyncio
+
+from rincewrite.scheduler import LLMScheduler
+
+
+async def served_order(
+    scheduler: LLMScheduler,
+    calls: list[tuple[str, str]]
+) -> list[tuple[str, str]]:
+    # the order `calls` are served in, all queued behind a running call
+    served: list[tuple[str, str]] = []
+    release = asyncio.Event()
+
+    async def hold() -> None:
+        async with scheduler.slot("busy", "chat", 1):
+            await release.wait()
+
+    async def call(thread_id: str, kind: str) -> None:
+        async with scheduler.slot(thread_id, kind, 1):
+            served.append((thread_id, kind))
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    tasks = [asyncio.create_task(call(*c)) for c in calls]
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(holder, *tasks)
+    return served
+
+
+def test_conversations_are_served_in_turn() -> None:
+    calls = [("a", "chat")] * 3 + [("b", "chat"), ("c", "chat")]
+    served = asyncio.run(served_order(LLMScheduler(max_concurrency=1), calls))
+    assert [thread_id for thread_id, _ in served] == ["a", "b", "c", "a", "a"]
+
+
+def test_replies_go_first() -> None:
+    calls = [("a", "summarize"), ("b", "update_piece"), ("c", "chat")]
+    served = asyncio.run(served_order(
+        LLMScheduler(max_concurrency=1, max_priority_wait=60), calls))
+    assert served[0] == ("c", "chat")
+
+
+def test_long_waits_go_first() -> None:
+    calls = [("a", "update_piece"), ("b", "chat")]
+    served = asyncio.run(served_order(
+        LLMScheduler(max_concurrency=1, max_priority_wait=0), calls))
+    assert served == calls
+
+
+def test_speculation_comes_last() -> None:
+    calls = [("a", "speculation"), ("b", "summarize"), ("c", "chat")]
+    served = asyncio.run(served_order(
+        LLMScheduler(max_concurrency=1, max_priority_wait=0), calls))
+    assert served[-1] == ("a", "speculation")
+
+
+def test_cancelled_wait_frees_its_place() -> None:
+    async def run() -> None:
+        scheduler = LLMScheduler(max_concurrency=1)
+        async with scheduler.slot("a", "chat", 1):
+            waiting = asyncio.create_task(
+                scheduler.slot("b", "chat", 1).__aenter__())
+            await asyncio.sleep(0)
+            assert scheduler.status()["queued"] == {"chat": 1}
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.status()["in_flight"] == 0
+        async with scheduler.slot("c", "chat", 1):
+            assert scheduler.status()["in_flight"] == 1
+
+    asyncio.run(run())
+
+
+def test_token_budget_delays_calls() -> None:
+    async def run() -> float:
+        # 100 tokens a second, all spent by the first call
+        scheduler = LLMScheduler(max_concurrency=0, tokens_per_minute=6000)
+        async with scheduler.slot("a", "chat", 6000):
+            pass
+        started = asyncio.get_running_loop().time()
+        async with scheduler.slot("b", "chat", 30):
+            return asyncio.get_running_loop().time() - started
+
+    assert asyncio.run(run()) >= 0.25
@@ -0,0 +1,103 @@
+import asyncio
+import sqlite3
+from pathlib import Path
+from typing import Any
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import empty_checkpoint
+
+from rincewrite.storage import CompactSqliteSaver
+
+_PARAGRAPH = "The luggage looked back. " * 40
+
+
+def checkpoint(turn: int) -> Any:
+    value = empty_checkpoint()
+    value["channel_values"] = {
+        "piece_text": "\n\n".join(
+            f"## Part {i}\n\n{_PARAGRAPH}" for i in range(turn + 1)),
+        "messages": [
+            message
+            for i in range(turn + 1)
+            for message in (
+                HumanMessage(content=f"turn {i}", id=f"h{i}"),
+                AIMessage(content=_PARAGRAPH, id=f"a{i}"))],
+    }
+    return value
+
+
+async def put_turns(
+    saver: CompactSqliteSaver,
+    thread_id: str,
+    turns: int
+) -> RunnableConfig:
+    config = RunnableConfig(
+        {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}})
+    for turn in range(turns):
+        config = await saver.aput(config, checkpoint(turn), {"step": turn}, {})
+    return config
+
+
+def blob_count(path: Path) -> int:
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM rw_blobs").fetchone()[0]
+
+
+def test_round_trip(tmp_path: Path) -> None:
+    async def run() -> None:
+        async with CompactSqliteSaver.from_conn_string(
+                str(tmp_path / "t.db")) as saver:
+            config = await put_turns(saver, "t", 3)
+            saved = await saver.aget_tuple(config)
+            assert saved is not None
+            assert saved.checkpoint["channel_values"] \
+                == checkpoint(2)["channel_values"]
+            assert saved.metadata["step"] == 2
+            listed = [
+                t.metadata["step"]
+                async for t in saver.alist(
+                    {"configurable": {"thread_id": "t"}})]
+            assert listed == [2, 1, 0]
+
+    asyncio.run(run())
+
+
+def test_blobs_are_written_once(tmp_path: Path) -> None:
+    async def run() -> None:
+        path = tmp_path / "t.db"
+        async with CompactSqliteSaver.from_conn_string(str(path)) as saver:
+            await put_turns(saver, "t", 5)
+            blobs = blob_count(path)
+            # the same values again, from another thread
+            await put_turns(saver, "u", 5)
+            assert blob_count(path) == blobs
+
+    asyncio.run(run())
+
+
+def test_prune_and_collect_garbage(tmp_path: Path) -> None:
+    async def run() -> None:
+        path = tmp_path / "t.db"
+        async with CompactSqliteSaver.from_conn_string(str(path)) as saver:
+            await put_turns(saver, "t", 5)
+            await put_turns(saver, "u", 2)
+            assert await saver.prune(1, "t") == 4
+            listed = [
+                t async for t in saver.alist(
+                    {"configurable": {"thread_id": "t"}})]
+            assert len(listed) == 1
+            assert await saver.collect_garbage() > 0
+            # nothing is left to collect, and what is left still reads back
+            assert await saver.collect_garbage() == 0
+            assert listed[0].checkpoint["channel_values"] == (
+                await saver.aget_tuple(listed[0].config)
+            ).checkpoint["channel_values"]
+            # blobs collected are written again when referred to again
+            await put_turns(saver, "v", 5)
+            async for saved in saver.alist(
+                    {"configurable": {"thread_id": "v"}}):
+                assert saved.checkpoint["channel_values"] == checkpoint(
+                    saved.metadata["step"])["channel_values"]
+
+    asyncio.run(run())
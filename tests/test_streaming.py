@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from rincewrite.streaming import PartialArgs, TokenBuffer
+
+
+def test_token_buffer_flushes_on_size() -> None:
+    buffer = TokenBuffer(flush_ms=60_000, flush_chars=10)
+    assert not buffer.push("hello")
+    assert buffer.push(" world")
+    assert buffer.flush() == "hello world"
+    assert buffer.flush() == ""
+    assert buffer.flush_count == 1
+    assert buffer.chunk_count == 2
+    assert buffer.char_count == 11
+
+
+def test_token_buffer_flushes_on_time() -> None:
+    buffer = TokenBuffer(flush_ms=0, flush_chars=1_000)
+    assert buffer.push("a")
+    assert buffer.time_to_first_token is not None
+
+
+def test_token_buffer_keeps_whitespace() -> None:
+    # the end of a reply is flushed as streamed, line separators included
+    buffer = TokenBuffer(flush_ms=60_000, flush_chars=1_000)
+    for chunk in ("a ", "b\n", " "):
+        buffer.push(chunk)
+    assert buffer.flush() == "a b\n "
+
+
+def test_token_buffer_time_to_first_token() -> None:
+    buffer = TokenBuffer()
+    assert buffer.time_to_first_token is None
+    buffer.push("")
+    assert buffer.time_to_first_token is not None
+
+
+ARGS = {
+    "new_title": "A \"quoted\" title",
+    "new_desc": "caf\u00e9 \U0001F9D9 and a line\u2028separator",
+    "new_text": "# Part\n\nSome text, with [brackets] and {braces}.\n",
+    "edits": [
+        {"op": "replace", "anchor": "a, b", "text": "c"},
+        {"op": "delete", "anchor": "[x]", "text": ""},
+    ],
+    "done": True,
+    "count": 12,
+}
+
+
+def stream(chunk_size: int) -> PartialArgs:
+    args = PartialArgs()
+    text = json.dumps(ARGS)
+    for i in range(0, len(text), chunk_size):
+        args.push(text[i:i + chunk_size])
+    return args
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1000])
+def test_partial_args_parse_whole_object(chunk_size: int) -> None:
+    assert stream(chunk_size).values == ARGS
+
+
+def test_partial_args_keep_escapes_cut_between_chunks() -> None:
+    args = PartialArgs()
+    for chunk in ('{"t": "a', "\\", "u00e9", '\\u', "d83e\\udd", 'd9"}'):
+        args.push(chunk)
+    assert args.values == {"t": "a\u00e9\U0001F9D9"}
+
+
+def test_partial_args_values_while_streaming() -> None:
+    args = PartialArgs()
+    args.push('{"new_title": "Ti')
+    assert args.values == {"new_title": "Ti"}
+    args.push('tle", "edits": [{"op": "delete", "anchor": "x"}, {"op": ')
+    values = args.values
+    assert values["new_title"] == "Title"
+    assert values["edits"][0] == {"op": "delete", "anchor": "x"}
+    args.push('"replace"}], "new_text": "line\\n')
+    values = args.values
+    assert values["edits"][1] == {"op": "replace"}
+    assert values["new_text"] == "line\n"
+
+
+def test_partial_args_keep_trailing_whitespace() -> None:
+    args = PartialArgs()
+    args.push('{"new_text": "a \u2028')
+    assert args.values["new_text"] == "a \u2028"
@@ -0,0 +1,159 @@
+import asyncio
+import contextlib
+from pathlib import Path
+
+import pytest
+
+from rincewrite.persistence import connect_sqlite
+from rincewrite.turns import (
+    DuplicateTurn, StaleTurn, TurnBusy, TurnCoordinator)
+
+
+def test_turns_of_a_thread_run_one_at_a_time() -> None:
+    async def run() -> list[str]:
+        coordinator = TurnCoordinator()
+        events: list[str] = []
+
+        async def turn(name: str) -> None:
+            async with coordinator.run("t"):
+                events.append(f"{name} start")
+                await asyncio.sleep(0.01)
+                events.append(f"{name} end")
+
+        await asyncio.gather(turn("a"), turn("b"))
+        assert coordinator.status()["waits"] == 1
+        assert coordinator._locks == {}
+        return events
+
+    assert asyncio.run(run()) == ["a start", "a end", "b start", "b end"]
+
+
+def test_same_submission_joins_running_turn() -> None:
+    async def run() -> None:
+        coordinator = TurnCoordinator()
+        async with coordinator.run("t", "hi", "v1") as turn:
+            assert coordinator.join("t", "other", "v1") is None
+            joined = coordinator.join("t", "hi", "v1")
+            assert joined is turn
+            turn.publish("partial")
+            updates = joined.updates()
+            assert await updates.__anext__() == "partial"
+        assert turn.done
+        assert [u async for u in updates] == []
+        # a tab joining late gets the last snapshot
+        assert [u async for u in joined.updates()] == ["partial"]
+        assert coordinator.join("t", "hi", "v1") is None
+        assert coordinator.status()["joins"] == 1
+
+    asyncio.run(run())
+
+
+def test_same_submission_after_its_turn_is_dropped() -> None:
+    async def run() -> None:
+        coordinator = TurnCoordinator()
+        async with coordinator.run("t", "hi", "v1"):
+            pass
+        with pytest.raises(DuplicateTurn):
+            async with coordinator.run("t", "hi", "v1"):
+                pass
+        # the same text on another version is a new turn
+        async with coordinator.run("t", "hi", "v2"):
+            pass
+        assert coordinator.status()["duplicates"] == 1
+
+    asyncio.run(run())
+
+
+def test_submission_on_older_version_is_stale() -> None:
+    async def run() -> None:
+        coordinator = TurnCoordinator()
+
+        async def current() -> str:
+            return "v2"
+
+        with pytest.raises(StaleTurn):
+            async with coordinator.run("t", "hi", "v1", current):
+                pass
+        async with coordinator.run("t", "hi", "v2", current) as turn:
+            assert turn.rejected is None
+        assert coordinator.status()["stale"] == 1
+
+    asyncio.run(run())
+
+
+def test_followers_learn_of_rejection() -> None:
+    async def run() -> None:
+        coordinator = TurnCoordinator()
+        started = asyncio.Event()
+
+        async def current() -> str:
+            started.set()
+            await asyncio.sleep(0.01)
+            return "v2"
+
+        async def submit() -> None:
+            async with coordinator.run("t", "hi", "v1", current):
+                pass
+
+        task = asyncio.create_task(submit())
+        await started.wait()
+        joined = coordinator.join("t", "hi", "v1")
+        assert joined is not None
+        with pytest.raises(StaleTurn):
+            await task
+        assert isinstance(joined.rejected, StaleTurn)
+
+    asyncio.run(run())
+
+
+def test_lease_across_workers(tmp_path: Path) -> None:
+    async def run() -> None:
+        path = str(tmp_path / "t.db")
+        async with contextlib.AsyncExitStack() as exit_stack:
+            first, second = TurnCoordinator(), TurnCoordinator(lease_wait=0.2)
+            await first.attach(
+                await connect_sqlite(exit_stack, path, read_only=False))
+            await second.attach(
+                await connect_sqlite(exit_stack, path, read_only=False))
+            leased = asyncio.Event()
+
+            async def hold() -> None:
+                async with first.run("t"):
+                    leased.set()
+                    await asyncio.sleep(10)
+
+            holder = asyncio.create_task(hold())
+            await leased.wait()
+            with pytest.raises(TurnBusy):
+                async with second.run("t"):
+                    pass
+            assert second.status()["busy"] == 1
+            # another thread is not held back
+            async with second.run("u"):
+                pass
+            # the lease of a cancelled turn is released
+            holder.cancel()
+            await asyncio.gather(holder, return_exceptions=True)
+            async with second.run("t"):
+                pass
+
+    asyncio.run(run())
+
+
+def test_expired_lease_is_taken_over(tmp_path: Path) -> None:
+    async def run() -> None:
+        path = str(tmp_path / "t.db")
+        async with contextlib.AsyncExitStack() as exit_stack:
+            stopped = TurnCoordinator(lease_ttl=0.1)
+            conn = await connect_sqlite(exit_stack, path, read_only=False)
+            await stopped.attach(conn)
+            # a worker that stopped without releasing its lease
+            assert await stopped._claim(conn, "t")
+            other = TurnCoordinator(lease_wait=1)
+            await other.attach(
+                await connect_sqlite(exit_stack, path, read_only=False))
+            async with other.run("t"):
+                pass
+            assert other.status()["lease_waits"] == 1
+
+    asyncio.run(run())